@@ -0,0 +1,72 @@
+"""
+Benchmark of the event loop backends: the call_action throughput and the
+event ingestion throughput of the suite scenarios on the asyncio event loop
+and on uvloop (if installed).
+
+Usage: PYTHONPATH=. python benchmarks/event_loop.py [--quick]
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from suite import bench_call_action, bench_event_latency  # noqa: E402
+
+from efb_qq_plugin_napcat.napcat.event_loop import (  # noqa: E402
+    new_event_loop,
+    select_backend,
+)
+
+
+def run(backend: str, quick: bool) -> dict[str, Any]:
+    loop = new_event_loop({"event_loop": backend})
+    try:
+        # No injected latency, so the overhead of the loop dominates
+        call_action = loop.run_until_complete(
+            bench_call_action(
+                calls=2000 if quick else 20000,
+                concurrency=16,
+                latency=0.0,
+                error_rate=0.0,
+            )
+        )
+        events = 2000 if quick else 20000
+        event_latency = loop.run_until_complete(
+            bench_event_latency(events=events, rate=1_000_000)
+        )
+    finally:
+        loop.close()
+
+    return {
+        "call_action_per_s": call_action["throughput_per_s"],
+        "call_action_p99_ms": call_action["latency_ms"]["p99"],
+        "events_per_s": event_latency["achieved_rate_per_s"],
+        "event_p99_ms": event_latency["latency_ms"]["p99"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true")
+    args = parser.parse_args()
+
+    backends = ["asyncio"]
+    if select_backend({"event_loop": "auto"}) == "uvloop":
+        backends.append("uvloop")
+    else:
+        print("uvloop is not installed, only asyncio is measured", file=sys.stderr)
+
+    results = {backend: run(backend, args.quick) for backend in backends}
+    print(json.dumps(results, indent=2))
+
+    if len(results) == 2:
+        for key, value in results["asyncio"].items():
+            print(f"{key:20} asyncio {value:>10} uvloop {results['uvloop'][key]:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Memory benchmark of the friend store.
+
+It compares the bytes per contact of the old store (a dict per friend,
+kept both in a list and in the uid index) with NapCatFriendManager,
+using synthetic "get_friend_list" responses decoded from JSON like the
+real ones.
+
+Usage: python benchmarks/friend_store_memory.py [--contacts 100000]
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+from typing import Any, Callable
+
+from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager
+
+
+def make_response(contacts: int) -> list[dict[str, Any]]:
+    friends = []
+    for uid in range(10000, 10000 + contacts):
+        friends.append(
+            {
+                "user_id": uid,
+                "nickname": f"nickname-{uid % (contacts // 2 or 1)}",
+                # Most friends have no remark, the remark is the nickname then
+                "remark": f"remark-{uid}" if uid % 4 == 0 else "",
+                "sex": "unknown",
+                "age": 0,
+                "level": 0,
+                "birthday_year": 0,
+                "birthday_month": 0,
+                "birthday_day": 0,
+                "phone_num": "-",
+                "email": "",
+                "category_id": 0,
+            }
+        )
+
+    return json.loads(json.dumps(friends))
+
+
+def old_store(response: list[dict[str, Any]]) -> Any:
+    friend_list = []
+    uid_to_friend = {}
+    for qq_friend in response:
+        friend = {
+            "user_id": qq_friend["user_id"],
+            "nickname": qq_friend["nickname"],
+            "remark": (
+                qq_friend["remark"]
+                if qq_friend["remark"] != ""
+                else qq_friend["nickname"]
+            ),
+        }
+        friend_list.append(friend)
+        uid_to_friend[friend["user_id"]] = friend
+
+    return friend_list, uid_to_friend
+
+
+def new_store(response: list[dict[str, Any]]) -> Any:
+    manager = NapCatFriendManager.__new__(NapCatFriendManager)
+    manager._uid_to_friend = {}
+    manager._update_friend_list_callback(response)
+    return manager
+
+
+def measure(build: Callable[[list[dict[str, Any]]], Any], contacts: int) -> float:
+    """
+    Measure the bytes retained by the store after the response is freed,
+    including the strings of the response kept by the store.
+    """
+
+    gc.collect()
+    tracemalloc.start()
+
+    response = make_response(contacts)
+    store = build(response)
+    del response
+    gc.collect()
+
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+
+    return retained / contacts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", type=int, default=100000)
+    args = parser.parse_args()
+
+    result = {
+        "contacts": args.contacts,
+        "old_bytes_per_contact": round(measure(old_store, args.contacts), 1),
+        "new_bytes_per_contact": round(measure(new_store, args.contacts), 1),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
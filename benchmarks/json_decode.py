@@ -0,0 +1,109 @@
+"""
+CPU and allocation benchmark of the decoding of the contact lists.
+
+It decodes a synthetic "get_friend_list" response body (with all the
+fields NapCat sends) and applies it to NapCatFriendManager, like a
+refresh of the friend list. The "current" path is the one before the
+JSON backends: `json.loads` and `_handle_api_result`, as `httpx` and
+aiocqhttp do it. The others go through NapCatJsonDecoder with each
+backend installed; with msgspec, only the fields of the schema are
+decoded.
+
+Usage: PYTHONPATH=. python benchmarks/json_decode.py [--contacts 50000] [--rounds 5]
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from aiocqhttp.api_impl import _handle_api_result  # noqa: E402
+from friend_store_memory import make_response  # noqa: E402
+
+from efb_qq_plugin_napcat.napcat import json_decoder  # noqa: E402
+from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager  # noqa: E402
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot  # noqa: E402
+
+_CONFIG = {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 1}
+
+
+def make_body(contacts: int) -> bytes:
+    return json.dumps(
+        {
+            "status": "ok",
+            "retcode": 0,
+            "data": make_response(contacts),
+            "message": "",
+            "wording": "",
+        },
+        ensure_ascii=False,
+    ).encode()
+
+
+def refresh(decode: Callable[[bytes], Any]) -> Callable[[bytes], Any]:
+    """
+    Get a function decoding a body and applying it to a new friend manager.
+    """
+
+    def run(body: bytes) -> Any:
+        manager = NapCatFriendManager.__new__(NapCatFriendManager)
+        manager._uid_to_friend = {}
+        manager._update_friend_list_callback(decode(body))
+        return manager
+
+    return run
+
+
+def measure(func: Callable[[bytes], Any], body: bytes, rounds: int) -> dict[str, float]:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(body)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"ms": round(best * 1000, 1), "peak_mb": round(peak / 2**20, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", type=int, default=50000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    body = make_body(args.contacts)
+    result: dict[str, Any] = {
+        "contacts": args.contacts,
+        "body_mb": round(len(body) / 2**20, 1),
+        "current": measure(
+            refresh(lambda body: _handle_api_result(json.loads(body))), body, args.rounds
+        ),
+    }
+
+    for backend in ("json", "orjson", "msgspec"):
+        if backend != "json" and not json_decoder._installed(backend):
+            continue
+
+        bot = NapCatBot(_CONFIG | {"json_backend": backend})
+        NapCatFriendManager(bot)  # registers the schema of get_friend_list
+        decoder = bot.json_decoder
+        result[backend] = measure(
+            refresh(lambda body: decoder.decode_result("get_friend_list", body)),
+            body,
+            args.rounds,
+        )
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Peak RSS benchmark of the media transfer.
+
+It downloads a file of `--size` MB from a local HTTP server and compares
+the peak RSS growth per transferred MB of:
+
+- buffer: read the whole response into memory and encode it into a
+  "base64://" uri, the naive approach.
+- stream: NapCatMediaIO.download, which streams the response to a
+  temporary file in chunks and passes it by "file://" path.
+
+Every mode runs in a fresh subprocess, so the peaks do not affect each
+other.
+
+Usage: python benchmarks/media_rss.py [--size 100]
+"""
+
+import argparse
+import asyncio
+import base64
+import functools
+import http.server
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def _serve(directory: str) -> http.server.ThreadingHTTPServer:
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def run_mode(mode: str, directory: str) -> float:
+    import httpx
+
+    from efb_qq_plugin_napcat.napcat.media import NapCatMediaIO
+    from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+    server = _serve(directory)
+    url = f"http://127.0.0.1:{server.server_address[1]}/media.bin"
+    config = {"api_root": url, "access_token": "", "api_timeout": 60}
+
+    async def buffer() -> None:
+        async with httpx.AsyncClient() as client:
+            resp = await client.get(url)
+            uri = "base64://" + base64.b64encode(resp.content).decode()
+            assert len(uri) > 0
+
+    async def stream() -> None:
+        bot = NapCatBot(config)
+        media = NapCatMediaIO(bot, config, Path(directory) / "media")
+        path = await media.download(url)
+        assert media.file_uri(path).startswith("file://")
+        await bot.close()
+
+    baseline = _peak_rss_mb()
+    asyncio.run(buffer() if mode == "buffer" else stream())
+
+    return _peak_rss_mb() - baseline
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100, help="the media size in MB")
+    parser.add_argument("--mode", choices=("buffer", "stream"))
+    parser.add_argument("--dir")
+    args = parser.parse_args()
+
+    if args.mode:
+        print(run_mode(args.mode, args.dir))
+        return
+
+    result: dict[str, float] = {"size_mb": args.size}
+    with tempfile.TemporaryDirectory() as directory:
+        with open(Path(directory) / "media.bin", "wb") as f:
+            for _ in range(args.size):
+                f.write(b"\0" * 1024 * 1024)
+
+        for mode in ("buffer", "stream"):
+            output = subprocess.check_output(
+                [sys.executable, __file__, "--mode", mode, "--dir", directory]
+            )
+            growth = float(output)
+            result[f"{mode}_peak_rss_mb"] = round(growth, 1)
+            result[f"{mode}_peak_rss_per_mb"] = round(growth / args.size, 3)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
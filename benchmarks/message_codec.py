@@ -0,0 +1,129 @@
+"""
+Throughput benchmark of the message codec.
+
+It parses and serializes a corpus of mixed-segment messages (text with
+CJK and escaped characters, mentions, faces, images with long urls,
+replies and voices) in the CQ-code and the array formats, with the
+codec of the plugin and with `aiocqhttp.message.Message`, which parses
+with a regex and unescapes with chained replacements.
+
+Usage: python benchmarks/message_codec.py [--messages 10000] [--rounds 5]
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Any, Callable
+
+from aiocqhttp.message import Message
+
+from efb_qq_plugin_napcat.napcat import codec
+
+_TEXTS = [
+    "好的",
+    "明天早上九点开会, 记得带电脑",
+    "lol",
+    "[图片] 这个是什么 & 那个呢?",
+    "see https://example.com/a?b=1&c=2",
+    "哈哈哈哈哈哈哈哈哈哈哈哈",
+    "ok, [1] done",
+]
+
+
+def make_corpus(messages: int, seed: int = 0) -> list[list[dict[str, Any]]]:
+    """
+    Build the messages in the array format, mostly short texts like a
+    real group chat, with a mention, a reply or a media from time to time.
+    """
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(messages):
+        segments: list[dict[str, Any]] = []
+        if rng.random() < 0.15:
+            segments.append({"type": "reply", "data": {"id": str(rng.getrandbits(31))}})
+        if rng.random() < 0.2:
+            qq = "all" if rng.random() < 0.05 else str(rng.randrange(10**8, 10**10))
+            segments.append({"type": "at", "data": {"qq": qq}})
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            segments.append({"type": "text", "data": {"text": rng.choice(_TEXTS)}})
+            if rng.random() < 0.2:
+                segments.append({"type": "face", "data": {"id": str(rng.randrange(300))}})
+        if rng.random() < 0.1:
+            name = f"{rng.getrandbits(128):032X}.jpg"
+            segments.append(
+                {
+                    "type": "image",
+                    "data": {
+                        "file": name,
+                        "url": "https://multimedia.nt.qq.com.cn/download?appid=1407"
+                        f"&fileid={rng.getrandbits(256):064x}&rkey=CAQSKAB6JW",
+                        "summary": "[动画表情]" if i % 2 else "",
+                        "file_size": str(rng.randrange(10**6)),
+                    },
+                }
+            )
+        if rng.random() < 0.02:
+            segments = [{"type": "record", "data": {"file": f"{i}.amr", "url": "u"}}]
+        corpus.append(segments)
+
+    return corpus
+
+
+def measure(func: Callable[[Any], Any], inputs: list[Any], rounds: int) -> float:
+    """
+    Get the best messages per second of the rounds.
+    """
+
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for value in inputs:
+            func(value)
+        best = min(best, time.perf_counter() - start)
+
+    return len(inputs) / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    arrays = make_corpus(args.messages)
+    strings = [codec.to_cq(codec.parse_array(array)) for array in arrays]
+    parsed = [codec.parse_cq(string) for string in strings]
+    messages = [Message(string) for string in strings]
+
+    # Both codecs must read the same segments from the corpus
+    for segments, message in zip(parsed, messages):
+        assert [s.type for s in segments] == [s["type"] for s in message]
+
+    rounds = args.rounds
+    result = {
+        "messages": args.messages,
+        "cq_chars": sum(map(len, strings)),
+        "parse_cq": {
+            "codec": round(measure(codec.parse_cq, strings, rounds)),
+            "aiocqhttp": round(measure(Message, strings, rounds)),
+        },
+        "to_cq": {
+            "codec": round(measure(codec.to_cq, parsed, rounds)),
+            "aiocqhttp": round(measure(str, messages, rounds)),
+        },
+        "parse_array": {
+            "codec": round(measure(codec.parse_array, arrays, rounds)),
+            "aiocqhttp": round(measure(Message, arrays, rounds)),
+        },
+        # aiocqhttp keeps the segments as dicts, there is nothing to compare
+        "to_array": {
+            "codec": round(measure(codec.to_array, parsed, rounds)),
+        },
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Overhead benchmark of the action instrumentation.
+
+It calls NapCatBot._call_action_wrapper against an in-process fake API,
+so only the wrapper itself is measured, with the instrumentation
+disabled (the default) and with the in-process metrics enabled.
+
+Usage: python benchmarks/metrics_overhead.py [--calls 200000]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Any
+
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+
+class _FakeApi:
+    async def call_action(self, action: str, **params: Any) -> Any:
+        return {"online": True, "good": True}
+
+
+def measure(calls: int, metrics: bool) -> float:
+    bot = NapCatBot(
+        {
+            "api_root": "http://localhost:6700",
+            "access_token": "",
+            "api_timeout": 1,
+            "metrics": metrics,
+        }
+    )
+    bot._qq_api = _FakeApi()  # type: ignore[assignment]
+
+    async def run() -> float:
+        start = time.perf_counter()
+        for _ in range(calls):
+            await bot._call_action_wrapper("get_status")
+        return time.perf_counter() - start
+
+    return asyncio.run(run()) / calls * 1e6
+
+
+def measure_baseline(calls: int) -> float:
+    api = _FakeApi()
+
+    async def run() -> float:
+        start = time.perf_counter()
+        for _ in range(calls):
+            await api.call_action("get_status")
+        return time.perf_counter() - start
+
+    return asyncio.run(run()) / calls * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+
+    baseline = measure_baseline(args.calls)
+    disabled = measure(args.calls, metrics=False)
+    enabled = measure(args.calls, metrics=True)
+
+    print(
+        json.dumps(
+            {
+                "calls": args.calls,
+                "fake_api_us": round(baseline, 3),
+                "disabled_overhead_us": round(disabled - baseline, 3),
+                "enabled_overhead_us": round(enabled - baseline, 3),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
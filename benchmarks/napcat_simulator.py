@@ -0,0 +1,308 @@
+"""
+A configurable local NapCat simulator for the benchmarks.
+
+It speaks enough OneBot 11 for the plugin: the HTTP API and the forward
+WebSocket ("ws" transport), with
+
+- an injected latency (plus a random jitter) before every response,
+- an injected error rate, the failed actions get `retcode` 1200,
+- synthetic friend, group and member lists of any size,
+- an "offline" switch, every connection is refused while it is set,
+- pushing message events to the connected WebSocket clients, every event
+  carries the `time_ns` it was sent at.
+
+It can also run standalone: python benchmarks/napcat_simulator.py --help
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Any, Optional
+
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:  # pragma: no cover
+
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode()
+
+
+class NapCatSimulator:
+    def __init__(
+        self,
+        friends: int = 100,
+        groups: int = 10,
+        members_per_group: int = 100,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.friends = friends
+        self.groups = groups
+        self.members_per_group = members_per_group
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.offline = False
+        self.calls: dict[str, int] = {}
+
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._cache: dict[str, bytes] = {}
+        self._http_server: Optional[asyncio.AbstractServer] = None
+        self._ws_server: Any = None
+        self._ws_clients: set[Any] = set()
+
+    # The data
+
+    def _friend_list(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "user_id": 10000 + i,
+                "nickname": f"nickname-{i}",
+                "remark": f"remark-{i}" if i % 4 == 0 else "",
+                "sex": "unknown",
+                "age": 0,
+                "level": 0,
+                "birthday_year": 0,
+                "birthday_month": 0,
+                "birthday_day": 0,
+                "phone_num": "-",
+                "email": "",
+                "category_id": 0,
+            }
+            for i in range(self.friends)
+        ]
+
+    def _group_list(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "group_id": 900000 + i,
+                "group_name": f"group-{i}",
+                "member_count": self.members_per_group,
+                "max_member_count": 2000,
+            }
+            for i in range(self.groups)
+        ]
+
+    def _member_list(self, group_id: int) -> list[dict[str, Any]]:
+        return [
+            {
+                "group_id": group_id,
+                "user_id": 10000 + i,
+                "nickname": f"nickname-{i}",
+                "card": f"card-{i}" if i % 3 == 0 else "",
+                "role": "member",
+            }
+            for i in range(self.members_per_group)
+        ]
+
+    async def handle_action(self, action: str, params: dict[str, Any]) -> bytes:
+        """
+        Get the encoded OneBot response of an action after the latency.
+        """
+
+        self.calls[action] = self.calls.get(action, 0) + 1
+
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self._random.random() < self.error_rate:
+            return _dumps({"status": "failed", "retcode": 1200, "data": None})
+
+        # The large lists are encoded once, like NapCat serving its cache
+        if action == "get_friend_list":
+            return self._cached(action, self._friend_list)
+        if action == "get_group_list":
+            return self._cached(action, self._group_list)
+        if action == "get_group_member_list":
+            group_id = int(params.get("group_id", 0))
+            return self._cached(
+                f"{action}:{group_id}", lambda: self._member_list(group_id)
+            )
+
+        data: Any
+        if action == "get_status":
+            data = {"online": True, "good": True}
+        elif action == "get_login_info":
+            data = {"user_id": 10000, "nickname": "bot"}
+        elif action.startswith("send_"):
+            data = {"message_id": next(self._message_ids)}
+        else:
+            data = None
+
+        return _dumps({"status": "ok", "retcode": 0, "data": data})
+
+    def _cached(self, key: str, build: Any) -> bytes:
+        body = self._cache.get(key)
+        if body is None:
+            body = self._cache[key] = _dumps(
+                {"status": "ok", "retcode": 0, "data": build()}
+            )
+
+        return body
+
+    def message_event(self, user_id: int, text: str) -> dict[str, Any]:
+        return {
+            "post_type": "message",
+            "message_type": "private",
+            "sub_type": "friend",
+            "time": int(time.time()),
+            "time_ns": time.perf_counter_ns(),
+            "self_id": 10000,
+            "message_id": next(self._message_ids),
+            "user_id": user_id,
+            "message": [{"type": "text", "data": {"text": text}}],
+            "raw_message": text,
+            "sender": {"user_id": user_id, "nickname": f"nickname-{user_id}"},
+        }
+
+    # The HTTP API
+
+    async def _handle_http(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                if self.offline:
+                    break
+
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                path = request_line.split(" ")[1].split("?")[0]
+                params = json.loads(body) if body else {}
+
+                response = await self.handle_action(path.strip("/"), params)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(response)}\r\n\r\n".encode()
+                    + response
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # The forward WebSocket
+
+    async def _handle_ws(self, connection: Any) -> None:
+        if self.offline:
+            await connection.close()
+            return
+
+        self._ws_clients.add(connection)
+        try:
+            async for frame in connection:
+                request = json.loads(frame)
+                asyncio.ensure_future(self._reply_ws(connection, request))
+        except Exception:
+            pass
+        finally:
+            self._ws_clients.discard(connection)
+
+    async def _reply_ws(self, connection: Any, request: dict[str, Any]) -> None:
+        response = json.loads(
+            await self.handle_action(request["action"], request.get("params") or {})
+        )
+        response["echo"] = request.get("echo")
+        try:
+            await connection.send(_dumps(response).decode())
+        except Exception:
+            pass
+
+    async def push_event(self, event: dict[str, Any]) -> None:
+        frame = _dumps(event).decode()
+        for connection in list(self._ws_clients):
+            await connection.send(frame)
+
+    # The servers
+
+    async def start(self, host: str = "127.0.0.1", http_port: int = 0, ws_port: int = 0):
+        self._http_server = await asyncio.start_server(self._handle_http, host, http_port)
+
+        try:
+            from websockets.asyncio.server import serve
+        except ImportError:  # pragma: no cover
+            self._ws_server = None
+        else:
+            self._ws_server = await serve(self._handle_ws, host, ws_port)
+
+    @property
+    def api_root(self) -> str:
+        assert self._http_server is not None
+        host, port = self._http_server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def ws_url(self) -> str:
+        assert self._ws_server is not None
+        host, port = list(self._ws_server.sockets)[0].getsockname()[:2]
+        return f"ws://{host}:{port}"
+
+    async def wait_ws_client(self, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while not self._ws_clients:
+            if time.monotonic() > deadline:
+                raise TimeoutError("No WebSocket client connected")
+            await asyncio.sleep(0.01)
+
+    async def close(self) -> None:
+        if self._http_server is not None:
+            self._http_server.close()
+        if self._ws_server is not None:
+            self._ws_server.close()
+            await self._ws_server.wait_closed()
+
+
+async def _serve_forever(args: argparse.Namespace) -> None:
+    simulator = NapCatSimulator(
+        friends=args.friends,
+        groups=args.groups,
+        members_per_group=args.members,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    await simulator.start(args.host, args.http_port, args.ws_port)
+    print(f"HTTP API: {simulator.api_root}")
+    if simulator._ws_server is not None:
+        print(f"WebSocket: {simulator.ws_url}")
+
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--http-port", type=int, default=6700)
+    parser.add_argument("--ws-port", type=int, default=6701)
+    parser.add_argument("--friends", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(_serve_forever(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Benchmark suite of the plugin against the local NapCat simulator.
+
+Scenarios:
+
+- call_action: the throughput and latency of NapCatBot.call_action over
+  HTTP with an injected latency and error rate.
+- friend_list: the refresh time and the retained memory of
+  NapCatFriendManager at 1k/10k/100k contacts.
+- health_recovery: how long the bot takes to notice NapCat is up again
+  after a short outage.
+- event_latency: the end-to-end latency from NapCat pushing an event over
+  the forward WebSocket to the event pipeline delivering it.
+
+The results are saved as JSON, and can be compared with the results of
+another version:
+
+    PYTHONPATH=. python benchmarks/suite.py --output new.json
+    PYTHONPATH=. python benchmarks/suite.py --output new.json --compare old.json
+
+Use --quick for a short run (1k/10k contacts, fewer calls and events).
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from napcat_simulator import NapCatSimulator  # noqa: E402
+
+import efb_qq_plugin_napcat  # noqa: E402
+from efb_qq_plugin_napcat.napcat.event_pipeline import NapCatEventPipeline  # noqa: E402
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatException  # noqa: E402
+from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager  # noqa: E402
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot  # noqa: E402
+
+
+def _bot(simulator: NapCatSimulator, **config: Any) -> NapCatBot:
+    bot = NapCatBot(
+        {
+            "api_root": simulator.api_root,
+            "access_token": "",
+            "api_timeout": 10,
+        }
+        | config
+    )
+    bot._logged_in = True
+    bot._connected = True
+
+    return bot
+
+
+def _percentiles(samples: list[float]) -> dict[str, float]:
+    if len(samples) < 2:
+        value = round(samples[0], 3) if samples else 0.0
+        return {"p50": value, "p99": value, "max": value}
+
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "p50": round(quantiles[49], 3),
+        "p99": round(quantiles[98], 3),
+        "max": round(max(samples), 3),
+    }
+
+
+async def bench_call_action(
+    calls: int, concurrency: int, latency: float, error_rate: float
+) -> dict[str, Any]:
+    simulator = NapCatSimulator(latency=latency, error_rate=error_rate)
+    await simulator.start()
+    bot = _bot(simulator, max_concurrent_actions=concurrency)
+
+    latencies: list[float] = []
+    failures = 0
+    remaining = iter(range(calls))
+
+    async def worker() -> None:
+        nonlocal failures
+        for i in remaining:
+            start = time.perf_counter()
+            try:
+                await bot.call_action("send_msg", user_id=10000, message=str(i))
+            except NapCatException:
+                failures += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    await bot.close()
+    await simulator.close()
+
+    return {
+        "calls": calls,
+        "concurrency": concurrency,
+        "injected_latency_ms": latency * 1000,
+        "injected_error_rate": error_rate,
+        "throughput_per_s": round(calls / elapsed, 1),
+        "latency_ms": _percentiles(latencies),
+        "failures": failures,
+    }
+
+
+async def bench_friend_list(contacts: int) -> dict[str, Any]:
+    simulator = NapCatSimulator(friends=contacts)
+    await simulator.start()
+    bot = _bot(simulator, api_timeout=120)
+
+    # Warm the simulator so its encoding is not measured
+    await bot.call_action("get_friend_list")
+
+    durations = []
+    for _ in range(3):
+        friend_manager = NapCatFriendManager(bot)
+        start = time.perf_counter()
+        await friend_manager.update_friend_list()
+        durations.append(time.perf_counter() - start)
+
+    refresh_start = time.perf_counter()
+    await friend_manager.update_friend_list()
+    refresh = time.perf_counter() - refresh_start
+
+    del friend_manager
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    friend_manager = NapCatFriendManager(bot)
+    await friend_manager.update_friend_list()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    await bot.close()
+    await simulator.close()
+
+    return {
+        "contacts": contacts,
+        "cold_load_s": round(min(durations), 4),
+        "refresh_s": round(refresh, 4),
+        "retained_bytes": retained,
+        "bytes_per_contact": round(retained / contacts, 1),
+    }
+
+
+async def bench_health_recovery(outage: float) -> dict[str, Any]:
+    simulator = NapCatSimulator()
+    await simulator.start()
+    bot = _bot(simulator, api_timeout=2)
+    monitor = asyncio.ensure_future(bot.check_status_periodically())
+
+    await asyncio.sleep(0.1)
+    simulator.offline = True
+    # A real action notices the outage, the monitor probes at once
+    try:
+        await bot.call_action("send_msg", user_id=10000, message="lost")
+    except NapCatException:
+        pass
+    while bot.is_connected():
+        await asyncio.sleep(0.01)
+
+    await asyncio.sleep(outage)
+    simulator.offline = False
+    up_at = time.perf_counter()
+    while not bot.is_connected():
+        await asyncio.sleep(0.01)
+    recovery = time.perf_counter() - up_at
+
+    monitor.cancel()
+    await asyncio.gather(monitor, return_exceptions=True)
+    await bot.close()
+    await simulator.close()
+
+    return {
+        "outage_s": outage,
+        "recovery_s": round(recovery, 3),
+        "failed_probes": len([t for t in bot.health.transitions if t["state"] == "down"]),
+        "answered_status_probes": simulator.calls.get("get_status", 0),
+    }
+
+
+async def bench_event_latency(events: int, rate: float) -> dict[str, Any]:
+    simulator = NapCatSimulator(friends=1000)
+    await simulator.start()
+    bot = NapCatBot(
+        {
+            "transport": "ws",
+            "ws_url": simulator.ws_url,
+            "api_root": simulator.api_root,
+            "access_token": "",
+            "api_timeout": 10,
+        }
+    )
+    bot._logged_in = True
+    bot._connected = True
+    friend_manager = NapCatFriendManager(bot)
+
+    latencies: list[float] = []
+    done = asyncio.Event()
+
+    async def convert(event: dict[str, Any]) -> dict[str, Any]:
+        remark = await friend_manager.get_friend_remark(event["user_id"])
+        return {"event": event, "remark": remark}
+
+    async def deliver(message: dict[str, Any]) -> None:
+        latencies.append((time.perf_counter_ns() - message["event"]["time_ns"]) / 1e6)
+        if len(latencies) == events:
+            done.set()
+
+    pipeline: NapCatEventPipeline[dict[str, Any]] = NapCatEventPipeline(
+        {}, convert, deliver
+    )
+    bot.on_event(pipeline.submit)
+    await bot.start()
+    await simulator.wait_ws_client()
+    await friend_manager.update_friend_list()
+
+    start = time.perf_counter()
+    for i in range(events):
+        await simulator.push_event(simulator.message_event(10000 + i % 1000, f"m{i}"))
+        delay = start + (i + 1) / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await asyncio.wait_for(done.wait(), 30)
+    elapsed = time.perf_counter() - start
+
+    await pipeline.close()
+    await bot.close()
+    await simulator.close()
+
+    return {
+        "events": events,
+        "target_rate_per_s": rate,
+        "achieved_rate_per_s": round(events / elapsed, 1),
+        "latency_ms": _percentiles(latencies),
+    }
+
+
+def _flatten(result: Any, prefix: str = "") -> dict[str, float]:
+    flat: dict[str, float] = {}
+    if isinstance(result, dict):
+        for key, value in result.items():
+            flat |= _flatten(value, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(result, list):
+        for i, value in enumerate(result):
+            flat |= _flatten(value, f"{prefix}[{i}]")
+    elif isinstance(result, (int, float)) and not isinstance(result, bool):
+        flat[prefix] = result
+
+    return flat
+
+
+def compare(old: dict[str, Any], new: dict[str, Any]) -> None:
+    old_flat = _flatten(old["results"])
+    new_flat = _flatten(new["results"])
+
+    print(f"{'metric':60} {'old':>12} {'new':>12} {'change':>8}")
+    for key, new_value in new_flat.items():
+        old_value = old_flat.get(key)
+        if old_value is None:
+            continue
+        change = f"{(new_value - old_value) / old_value:+.1%}" if old_value else "n/a"
+        print(f"{key:60} {old_value:>12} {new_value:>12} {change:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="the results of another version")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument(
+        "--scenarios",
+        default="call_action,friend_list,health_recovery,event_latency",
+    )
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    scenarios: dict[str, Callable[[], Any]] = {
+        "call_action": lambda: bench_call_action(
+            calls=500 if args.quick else 5000,
+            concurrency=16,
+            latency=args.latency,
+            error_rate=args.error_rate,
+        ),
+        "friend_list": lambda: _sequence(
+            [
+                bench_friend_list(contacts)
+                for contacts in ((1000, 10000) if args.quick else (1000, 10000, 100000))
+            ]
+        ),
+        "health_recovery": lambda: bench_health_recovery(outage=1.0),
+        "event_latency": lambda: bench_event_latency(
+            events=1000 if args.quick else 10000, rate=2000
+        ),
+    }
+
+    results = {}
+    for name in args.scenarios.split(","):
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = asyncio.run(scenarios[name]())
+
+    report = {
+        "version": efb_qq_plugin_napcat.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "quick": args.quick,
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(json.dumps(report, indent=2))
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), report)
+
+
+async def _sequence(coros: list[Any]) -> list[Any]:
+    return [await coro for coro in coros]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,65 @@
 import asyncio
+import functools
 import logging
+import mimetypes
 import threading
-from typing import Any, Dict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
 from efb_qq_slave import BaseClient, QQMessengerChannel
-from ehforwarderbot import Message, Status
+from efb_qq_slave.ChatMgr import ChatMgr
+from efb_qq_slave.CustomTypes import EFBGroupChat, EFBGroupMember, EFBPrivateChat
+from ehforwarderbot import Message, MsgType, Status, coordinator
+from ehforwarderbot import utils as efb_utils
+from ehforwarderbot.chat import Chat, ChatMember
+from ehforwarderbot.exceptions import (
+    EFBChatNotFound,
+    EFBMessageNotFound,
+    EFBMessageTypeNotSupported,
+)
+from ehforwarderbot.status import ChatUpdates, MessageRemoval
+from ehforwarderbot.types import ChatID, MessageID
+
+# The subsystems (the HTTP and WebSocket clients, the persistence, the media,
+# the codec, the metrics and the snapshot) are only imported when the client is
+# set up in `poll`, so loading the plugin at the boot of EFB stays cheap.
+if TYPE_CHECKING:
+    from efb_qq_plugin_napcat.napcat.codec import MessageSegment
+    from efb_qq_plugin_napcat.napcat.event_pipeline import NapCatEventPipeline
+    from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager
+    from efb_qq_plugin_napcat.napcat.group_manager import NapCatGroupManager
+    from efb_qq_plugin_napcat.napcat.loop_bridge import NapCatLoopBridge
+    from efb_qq_plugin_napcat.napcat.media import NapCatMediaIO
+    from efb_qq_plugin_napcat.napcat.media_cache import NapCatMediaCache
+    from efb_qq_plugin_napcat.napcat.message_index import NapCatMessageIndex
+    from efb_qq_plugin_napcat.napcat.metrics import MetricsSink
+    from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+    from efb_qq_plugin_napcat.napcat.outbox import NapCatOutbox, OutboxEntry
+    from efb_qq_plugin_napcat.napcat.runtime import NapCatRuntime
+    from efb_qq_plugin_napcat.napcat.send_queue import ChatTarget, NapCatSendQueue
+    from efb_qq_plugin_napcat.napcat.types.friend import Friend, FriendListDiff
+    from efb_qq_plugin_napcat.napcat.types.group import Group
+
+OUTBOX_ID_PREFIX = "outbox_"
+"""
+The same as `outbox.OUTBOX_ID_PREFIX`, without importing the outbox
+"""
+
+_OUTBOUND_SEGMENT_TYPES = {
+    MsgType.Image: "image",
+    MsgType.Sticker: "image",
+    MsgType.Animation: "image",
+    MsgType.Voice: "record",
+    MsgType.Video: "video",
+    MsgType.File: "file",
+}
+
+_INBOUND_MSG_TYPES = {
+    "image": MsgType.Image,
+    "record": MsgType.Voice,
+    "video": MsgType.Video,
+    "file": MsgType.File,
+}
 
 
 class NapCat(BaseClient):
@@ -15,6 +70,48 @@ class NapCat(BaseClient):
     channel: QQMessengerChannel
     logger: logging.Logger
 
+    napcat_bot: "NapCatBot"
+
+    bridge: "NapCatLoopBridge"
+
+    friend_manager: "NapCatFriendManager"
+
+    group_manager: "NapCatGroupManager"
+
+    chat_manager: ChatMgr
+
+    event_pipeline: "NapCatEventPipeline[Message]"
+
+    send_queue: "NapCatSendQueue"
+
+    media: "NapCatMediaIO"
+
+    media_cache: "Optional[NapCatMediaCache]"
+
+    outbox: "Optional[NapCatOutbox]"
+
+    message_index: "Optional[NapCatMessageIndex]"
+
+    snapshot_path: Optional[Path]
+
+    runtime: "Optional[NapCatRuntime]"
+
+    _reconcile_task: Optional["asyncio.Future[Any]"]
+
+    _health_task: Optional["asyncio.Task[None]"]
+
+    _metrics_server: Optional[asyncio.AbstractServer]
+
+    _metrics_port: Optional[int]
+
+    _metrics_host: str
+
+    _polling: bool
+
+    _setup_done: bool
+
+    _setup_lock: threading.Lock
+
     def __init__(
         self, client_id: str, config: Dict[str, Any], channel: QQMessengerChannel
     ):
@@ -22,10 +119,117 @@ class NapCat(BaseClient):
 
         self.channel = channel
         self.logger = logging.getLogger(__name__)
+        self.chat_manager = ChatMgr(self.channel)
+
+        napcat_config = self.client_config[self.client_id]
+        self._polling = False
+        self._reconcile_task = None
+        self._health_task = None
+        self._metrics_server = None
+        self._metrics_port = napcat_config.get("metrics_port")
+        self._metrics_host = napcat_config.get("metrics_host", "127.0.0.1")
+        self.snapshot_path = None
+        if napcat_config.get("contact_snapshot", True):
+            data_path = efb_utils.get_data_path(self.channel.channel_id)
+            self.snapshot_path = data_path / "contacts.snapshot"
+
+        # The event loop, the connections and the persistence are set up by
+        # `poll` (or by the first call needing them), not at the boot of EFB.
+        self._setup_done = False
+        self._setup_lock = threading.Lock()
+
+    def _setup(self) -> None:
+        """
+        Create the event loop and the subsystems of the client, once.
+        """
+
+        if self._setup_done:
+            return
+
+        with self._setup_lock:
+            if not self._setup_done:
+                self._create_subsystems()
+                self._setup_done = True
+
+    def _create_subsystems(self) -> None:
+        from efb_qq_plugin_napcat.napcat.event_loop import new_event_loop
+        from efb_qq_plugin_napcat.napcat.event_pipeline import NapCatEventPipeline
+        from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager
+        from efb_qq_plugin_napcat.napcat.group_manager import NapCatGroupManager
+        from efb_qq_plugin_napcat.napcat.loop_bridge import NapCatLoopBridge
+        from efb_qq_plugin_napcat.napcat.media import NapCatMediaIO
+        from efb_qq_plugin_napcat.napcat.media_cache import NapCatMediaCache
+        from efb_qq_plugin_napcat.napcat.message_index import NapCatMessageIndex
+        from efb_qq_plugin_napcat.napcat.metrics import instrumented
+        from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+        from efb_qq_plugin_napcat.napcat.outbox import NapCatOutbox
+        from efb_qq_plugin_napcat.napcat.runtime import acquire_runtime
+        from efb_qq_plugin_napcat.napcat.send_queue import NapCatSendQueue
 
-        # Create a new event loop for the slave instance to isolate the event loop
-        self.event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.event_loop)
+        napcat_config = self.client_config[self.client_id]
+        data_path = efb_utils.get_data_path(self.channel.channel_id)
+        account = self.channel.channel_id
+
+        # Several accounts (EFB instances of the channel) with the same
+        # `shared_runtime` name share one event loop thread, one HTTP
+        # connection pool and one media cache.
+        self.runtime = None
+        shared_runtime = napcat_config.get("shared_runtime")
+        if shared_runtime:
+            module_path = efb_utils.get_data_path(account.partition("#")[0])
+            self.runtime = acquire_runtime(
+                "default" if shared_runtime is True else str(shared_runtime),
+                account,
+                napcat_config,
+                module_path / "napcat-media",
+            )
+            self.event_loop = self.runtime.loop
+        else:
+            # Create a new event loop for the slave instance to isolate the
+            # event loop. It only becomes the current loop of the poll thread,
+            # the loop of the EFB thread is left alone.
+            self.event_loop = new_event_loop(napcat_config)
+
+        # The connections of the bot are created lazily in the event loop above
+
+        # The actions called while NapCat is offline are buffered on disk
+        self.outbox = None
+        if napcat_config.get("outbox", True):
+            self.outbox = NapCatOutbox(data_path / "outbox.sqlite3", napcat_config)
+        self.napcat_bot = NapCatBot(napcat_config, self.outbox, self.runtime, account)
+
+        # The QQ ids of the messages for the replies, the recalls and the edits
+        self.message_index = None
+        if napcat_config.get("message_index", True):
+            self.message_index = NapCatMessageIndex(
+                data_path / "messages.sqlite3", napcat_config
+            )
+        self.bridge = NapCatLoopBridge(self.event_loop, napcat_config)
+        self.friend_manager = NapCatFriendManager(self.napcat_bot, napcat_config)
+        self.friend_manager.on_friend_list_changed(self._update_friend_chats)
+        self.group_manager = NapCatGroupManager(self.napcat_bot, napcat_config)
+        self.send_queue = NapCatSendQueue(self.napcat_bot, napcat_config)
+        self.media_cache = None
+        if self.runtime is not None:
+            self.media_cache = self.runtime.media_cache
+        elif napcat_config.get("media_cache", True):
+            self.media_cache = NapCatMediaCache(data_path / "media", napcat_config)
+        self.media = NapCatMediaIO(self.napcat_bot, napcat_config, cache=self.media_cache)
+        self.media.purge_stale()
+        # Measured here, the metrics are not imported with the plugin
+        event_to_message = instrumented("client.event_to_message")(
+            type(self)._event_to_message
+        )
+        self.event_pipeline = NapCatEventPipeline(
+            napcat_config,
+            functools.partial(event_to_message, self),
+            self._deliver_message,
+        )
+
+    @property
+    def metrics(self) -> "Optional[MetricsSink]":
+        self._setup()
+        return self.napcat_bot.metrics
 
     def login(self) -> None:
         raise NotImplementedError
@@ -36,37 +240,536 @@ class NapCat(BaseClient):
     def relogin(self) -> None:
         raise NotImplementedError
 
+    @staticmethod
+    def _chat_target(chat_uid: str) -> "ChatTarget":
+        """
+        Get the chat to send to from the uid of the EFB chat, which is
+        "private_<user id>" or "group_<group id>".
+        """
+
+        message_type, _, target_id = chat_uid.partition("_")
+        if message_type not in ("private", "group") or not target_id.isdigit():
+            raise EFBChatNotFound()
+
+        return message_type, int(target_id)  # type: ignore[return-value]
+
     def send_message(self, msg: Message) -> Message:
-        raise NotImplementedError
+        """
+        Send the message through the send queue, which keeps the order of
+        the chat, limits the rate and merges consecutive texts. Only the
+        EFB thread sending this message waits for the message id.
+
+        QQ cannot edit a message, so an edited message is sent again and the
+        old one is recalled, the EFB uid of the message stays the same.
+        """
+
+        self._setup()
+        target = self._chat_target(msg.chat.uid)
+
+        old_qq_id = None
+        if msg.edit:
+            old_qq_id = self._resolve_qq_id(str(msg.uid))
+            if old_qq_id is None:
+                raise EFBMessageNotFound()
+
+        segments: list[dict[str, Any]] = []
+        if msg.target is not None:
+            reply_id = self._resolve_qq_id(str(msg.target.uid))
+            if reply_id is not None and not reply_id.startswith(OUTBOX_ID_PREFIX):
+                segments.append({"type": "reply", "data": {"id": reply_id}})
+
+        if msg.type != MsgType.Text:
+            segment_type = _OUTBOUND_SEGMENT_TYPES.get(msg.type)
+            if segment_type is None or msg.path is None:
+                raise EFBMessageTypeNotSupported()
+            # The media are passed by path (or encoded in this EFB thread for
+            # a remote NapCat), they are never read into the event loop.
+            segments.append(self.media.media_segment(segment_type, Path(msg.path)))
+
+        if msg.text:
+            segments.append({"type": "text", "data": {"text": msg.text}})
+
+        qq_id = str(self.bridge.call(self.send_queue.send(target, segments)))
+        if old_qq_id is not None:
+            self.bridge.fire_and_forget(self._recall(old_qq_id))
+        else:
+            msg.uid = MessageID(qq_id)
+
+        if self.message_index is not None:
+            self.message_index.record(str(msg.uid), qq_id, msg.chat.uid, msg.author.uid)
+
+        return msg
+
+    def _resolve_qq_id(self, efb_uid: str) -> Optional[str]:
+        """
+        Get the QQ id (or the outbox uid) of a message by its EFB uid.
+        """
+
+        if self.message_index is not None:
+            return self.message_index.resolve_qq_id(efb_uid)
+
+        return efb_uid
 
     def send_status(self, status: Status) -> None:
+        """
+        EFB does not wait for the result of a status, so the status is sent
+        in the fire-and-forget mode and the master thread is never blocked.
+        """
+
+        self._setup()
+        if isinstance(status, MessageRemoval):
+            efb_uid = str(status.message.uid)
+            qq_id = self._resolve_qq_id(efb_uid)
+            if qq_id is None:
+                raise EFBMessageNotFound()
+
+            self.bridge.fire_and_forget(self._recall(qq_id, efb_uid))
+            return
+
         raise NotImplementedError
 
+    async def _recall(self, qq_id: str, efb_uid: Optional[str] = None) -> None:
+        """
+        Recall a message in QQ. A message still in the outbox is taken out of
+        it instead, if it was sent in the meantime, its QQ id is looked up
+        again by the EFB uid.
+        """
+
+        if qq_id.startswith(OUTBOX_ID_PREFIX) and self.outbox is not None:
+            if self.outbox.cancel(int(qq_id.removeprefix(OUTBOX_ID_PREFIX))):
+                return
+
+            resolved = self._resolve_qq_id(efb_uid) if efb_uid is not None else None
+            if resolved is None or resolved.startswith(OUTBOX_ID_PREFIX):
+                self.logger.warning(f"The buffered message {qq_id} cannot be recalled")
+                return
+            qq_id = resolved
+
+        await self.napcat_bot.call_action("delete_msg", message_id=int(qq_id))
+
+    def _on_replayed(self, entry: "OutboxEntry", response: Any) -> None:
+        """
+        Record the QQ id of a message sent from the outbox.
+        """
+
+        if self.message_index is None or not entry["action"].startswith("send_"):
+            return
+
+        if isinstance(response, dict) and "message_id" in response:
+            self.message_index.reassign_qq_id(
+                f"{OUTBOX_ID_PREFIX}{entry['outbox_id']}", str(response["message_id"])
+            )
+
+    async def _event_to_message(self, event: dict[str, Any]) -> Optional[Message]:
+        """
+        Convert a OneBot message event into an EFB message. The other events
+        are ignored at the moment.
+        """
+
+        if event.get("post_type") != "message":
+            return None
+
+        user_id = event["user_id"]
+        sender = event.get("sender") or {}
+
+        if event.get("message_type") == "group":
+            group_id = event["group_id"]
+            group_name = await self.group_manager.get_group_name(group_id)
+            chat = self.chat_manager.build_efb_chat_as_group(
+                EFBGroupChat(uid=ChatID(f"group_{group_id}"), name=group_name or "")
+            )
+
+            # The card in the event is up to date, the member list of the
+            # group is only loaded when the event does not carry a name.
+            member_name = sender.get("card") or sender.get("nickname")
+            if not member_name:
+                member_name = await self.group_manager.get_member_name(group_id, user_id)
+            author = self.chat_manager.build_efb_chat_as_member(
+                chat, EFBGroupMember(uid=ChatID(str(user_id)), name=member_name or "")
+            )
+        else:
+            remark = await self.friend_manager.get_friend_remark(user_id)
+            chat = self.chat_manager.build_efb_chat_as_private(
+                EFBPrivateChat(
+                    uid=ChatID(f"private_{user_id}"),
+                    name=sender.get("nickname") or str(user_id),
+                    alias=remark,
+                )
+            )
+            author = chat.other
+
+        msg = Message(
+            uid=MessageID(str(event["message_id"])),
+            chat=chat,
+            author=author,
+            type=MsgType.Text,
+            text=event.get("raw_message", ""),
+            deliver_to=coordinator.master,
+        )
+        # The message is an array of segments, or a CQ-code string when
+        # NapCat posts the messages as strings
+        from efb_qq_plugin_napcat.napcat.codec import parse_message
+
+        segments = parse_message(event.get("message"))
+        msg.target = self._reply_target(chat, segments)
+        await self._attach_media(msg, segments)
+
+        if self.message_index is not None:
+            self.message_index.record(msg.uid, msg.uid, chat.uid, author.uid)
+
+        return msg
+
+    def _reply_target(
+        self, chat: Chat, segments: "list[MessageSegment]"
+    ) -> Optional[Message]:
+        """
+        Get the message quoted by the reply segment from the message index,
+        None if the message does not reply or the quoted one is unknown.
+        """
+
+        from efb_qq_plugin_napcat.napcat.codec import ReplySegment
+
+        if self.message_index is None:
+            return None
+
+        reply = next((s for s in segments if isinstance(s, ReplySegment)), None)
+        if reply is None:
+            return None
+
+        record = self.message_index.by_qq_id(reply.id)
+        if record is None or record.chat_uid != chat.uid:
+            return None
+
+        return Message(
+            uid=MessageID(record.efb_uid),
+            chat=chat,
+            author=self._chat_member(chat, record.author_uid),
+        )
+
+    def _chat_member(self, chat: Chat, author_uid: str) -> ChatMember:
+        try:
+            return chat.get_member(ChatID(author_uid))
+        except KeyError:
+            return self.chat_manager.build_efb_chat_as_member(
+                chat, EFBGroupMember(uid=ChatID(author_uid), name=author_uid)
+            )
+
+    async def _handle_recall(self, event: dict[str, Any]) -> None:
+        """
+        Remove a message recalled in QQ from the master channel, if the
+        message index knows it.
+        """
+
+        if event.get("post_type") != "notice" or event.get("notice_type") not in (
+            "group_recall",
+            "friend_recall",
+        ):
+            return
+
+        record = None
+        if self.message_index is not None:
+            record = self.message_index.by_qq_id(str(event.get("message_id")))
+        if record is None:
+            self.logger.debug(f"Unknown recalled message {event.get('message_id')}")
+            return
+
+        chat: Chat
+        if record.chat_uid.startswith("group_"):
+            group_id = int(record.chat_uid.removeprefix("group_"))
+            group_name = await self.group_manager.get_group_name(group_id)
+            chat = self.chat_manager.build_efb_chat_as_group(
+                EFBGroupChat(uid=ChatID(record.chat_uid), name=group_name or "")
+            )
+        else:
+            user_id = int(record.chat_uid.removeprefix("private_"))
+            chat = self.chat_manager.build_efb_chat_as_private(
+                EFBPrivateChat(
+                    uid=ChatID(record.chat_uid),
+                    name=str(user_id),
+                    alias=await self.friend_manager.get_friend_remark(user_id),
+                )
+            )
+
+        removal = MessageRemoval(
+            source_channel=self.channel,
+            destination_channel=coordinator.master,
+            message=Message(
+                uid=MessageID(record.efb_uid),
+                chat=chat,
+                author=self._chat_member(chat, record.author_uid),
+            ),
+        )
+        await asyncio.get_running_loop().run_in_executor(
+            None, coordinator.send_status, removal
+        )
+
+    async def _update_friend_chats(self, diff: "FriendListDiff") -> None:
+        """
+        Inform the master channel of the private chats added, removed or
+        renamed by a refresh of the friend list.
+        """
+
+        def chat_uids(friends: "list[Friend]") -> list[ChatID]:
+            return [ChatID(f"private_{friend.user_id}") for friend in friends]
+
+        try:
+            updates = ChatUpdates(
+                self.channel,
+                new_chats=chat_uids(diff["added"]),
+                removed_chats=chat_uids(diff["removed"]),
+                modified_chats=chat_uids(diff["updated"]),
+            )
+            await asyncio.get_running_loop().run_in_executor(
+                None, coordinator.send_status, updates
+            )
+        except Exception as e:
+            # The friend list is refreshed anyway
+            self.logger.warning(f"Failed to send the chat updates: {e!r}")
+
+    async def _attach_media(self, msg: Message, segments: "list[MessageSegment]") -> None:
+        """
+        If the message is one media segment, attach the media to the
+        message, from the media cache or streamed from its url.
+        """
+
+        if len(segments) != 1:
+            return
+
+        msg_type = _INBOUND_MSG_TYPES.get(segments[0].type)
+        if msg_type is None:
+            return
+        data = segments[0].to_dict()["data"]
+        if not data.get("url"):
+            return
+
+        try:
+            path = await self.media.fetch(data)
+        except Exception as e:
+            # Deliver the message anyway, with the url of the media
+            self.logger.warning(f"Failed to fetch the media of {msg.uid}: {e!r}")
+            msg.text = f"[{segments[0].type}] {data['url']}"
+            return
+        name = data.get("file") or path.name
+
+        msg.type = msg_type
+        msg.text = ""
+        msg.path = path
+        msg.filename = name
+        msg.mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        msg.file = self.media.open(path)
+
+    async def _deliver_message(self, msg: Message) -> None:
+        """
+        Deliver the message to the master channel. `coordinator.send_message`
+        is blocking, so it runs in the default executor to keep the event
+        loop free. The media attached is released once delivered.
+        """
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, coordinator.send_message, msg
+            )
+        finally:
+            if msg.path is not None:
+                await self.media.release(Path(msg.path), msg.file)
+
     def receive_message(self) -> None:
-        raise NotImplementedError
+        """
+        Stream the events of NapCat into the event pipeline, which converts
+        them into EFB messages and delivers them to the master channel.
+        Only the WebSocket transports receive events.
+        """
 
-    def get_friends(self) -> None:
-        raise NotImplementedError
+        self.napcat_bot.on_event(self.event_pipeline.submit)
+        self.napcat_bot.on_event(self._handle_recall)
+        self.napcat_bot.on_replayed(self._on_replayed)
 
-    def get_groups(self) -> None:
-        raise NotImplementedError
+    def get_friends(self) -> "list[Friend]":
+        self._setup()
+        if not self.friend_manager.uid_to_friend:
+            self.bridge.call(self.friend_manager.update_friend_list())
+
+        return list(self.friend_manager.friend_list)
+
+    def get_groups(self) -> "list[Group]":
+        """
+        Get the groups of the qq account. The member lists are not loaded
+        here, they are loaded lazily when a member name is needed.
+        """
+
+        self._setup()
+        if not self.group_manager.gid_to_group:
+            self.bridge.call(self.group_manager.update_group_list())
+
+        return list(self.group_manager.group_list)
 
     def get_login_info(self) -> dict[Any, Any]:
-        raise NotImplementedError
+        self._setup()
+        return self.bridge.call(self.napcat_bot.call_action("get_login_info")) or {}
+
+    def _load_contact_snapshot(self) -> None:
+        """
+        Restore the contacts saved by the last run, so the first message
+        does not wait for the whole contact list. They are reconciled with
+        NapCat in the background after the bot starts.
+        """
+
+        from efb_qq_plugin_napcat.napcat.snapshot import load_snapshot
+
+        if self.snapshot_path is None:
+            return
+
+        sections = load_snapshot(self.snapshot_path)
+        self.friend_manager.restore_snapshot_records(sections.get("friends", []))
+        self.group_manager.restore_snapshot_records(sections.get("groups", []))
+
+    def _save_contact_snapshot(self) -> None:
+        from efb_qq_plugin_napcat.napcat.snapshot import dump_snapshot
+
+        if self.snapshot_path is None:
+            return
+
+        try:
+            dump_snapshot(
+                self.snapshot_path,
+                {
+                    "friends": self.friend_manager.snapshot_records(),
+                    "groups": self.group_manager.snapshot_records(),
+                },
+            )
+        except OSError as e:
+            self.logger.warning(f"Failed to save the contact snapshot: {e}")
+
+    def _save_media_cache(self) -> None:
+        if self.media_cache is None:
+            return
+
+        try:
+            self.media_cache.save()
+        except OSError as e:
+            self.logger.warning(f"Failed to save the media cache index: {e}")
+
+        self.logger.debug(
+            "Media cache hit rate: %.1f%%, %s",
+            self.media_cache.hit_rate * 100,
+            self.media_cache.stats,
+        )
+
+    async def _start(self) -> None:
+        # The health monitor probes NapCat in the background, the first probe
+        # included: a NapCat not reachable yet is picked up by the backoff,
+        # and NapCat going down and coming back replays the outbox.
+        self._health_task = asyncio.ensure_future(
+            self.napcat_bot.check_status_periodically()
+        )
+
+        # Reconcile the restored contacts with NapCat in the background, once
+        # it is up
+        self._reconcile_task = asyncio.ensure_future(self._reconcile())
+        self._reconcile_task.add_done_callback(self._reconcile_done)
+
+        await self.napcat_bot.start()
+        await self._start_metrics_server()
+
+    async def _reconcile(self) -> list[Any]:
+        await self.napcat_bot.health.wait_up()
+
+        return await asyncio.gather(
+            self.friend_manager.update_friend_list(),
+            self.group_manager.update_group_list(),
+            return_exceptions=True,
+        )
+
+    def _reconcile_done(self, future: "asyncio.Future[Any]") -> None:
+        # Cancelled by _close
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        for result in future.result():
+            if isinstance(result, BaseException):
+                self.logger.warning(f"Failed to reconcile the contacts: {result!r}")
+
+    async def _start_metrics_server(self) -> None:
+        """
+        Serve the metrics to Prometheus on `metrics_port`, when the in-process
+        metrics are enabled.
+        """
+
+        from efb_qq_plugin_napcat.napcat.metrics import (
+            find_in_memory_metrics,
+            serve_prometheus,
+        )
+
+        metrics = find_in_memory_metrics(self.napcat_bot.metrics)
+        if self._metrics_port is None or metrics is None:
+            return
+
+        try:
+            self._metrics_server = await serve_prometheus(
+                metrics, self._metrics_host, self._metrics_port
+            )
+        except OSError as e:
+            self.logger.warning(f"Failed to serve the metrics: {e}")
+
+    async def _close(self) -> None:
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+            await asyncio.gather(self._reconcile_task, return_exceptions=True)
+
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+
+        await self.send_queue.close()
+        await self.napcat_bot.close()
+        await self.event_pipeline.close()
 
     def poll(self) -> None:
         """
         EFB will create a thread for each slave instance to call this method to start
         the slave. However, we need to create a new thread to isolate the event loop.
         Otherwise, there may be some unexpected behaviors.
+
+        The event loop and the subsystems are created here, not when EFB loads
+        the plugin.
         """
 
-        def _run():
-            self.event_loop.run_forever()
+        self._setup()
+        self._polling = True
+        self._load_contact_snapshot()
+        self.receive_message()
+
+        if self.runtime is not None:
+            # The loop thread and the media cache are shared with the other
+            # accounts, they are only started by the first one.
+            self.runtime.start()
+        else:
+            if self.media_cache is not None:
+                self.media_cache.load()
+
+            def _run():
+                asyncio.set_event_loop(self.event_loop)
+                self.event_loop.run_forever()
+
+            self.t = threading.Thread(target=_run)
+            self.t.daemon = True
+            self.t.start()
 
-        self.t = threading.Thread(target=_run)
-        self.t.daemon = True
-        self.t.start()
+        # The bridge rejects the calls until the event loop runs
+        if not self.bridge.wait_running(timeout=10):
+            self.logger.error("The event loop of the NapCat client did not start")
+            return
+
+        # This connects to NapCat (with the WebSocket transport, it also starts
+        # receiving the events in the event loop) and checks its status.
+        try:
+            self.bridge.call(self._start(), timeout=10)
+        except Exception as e:
+            self.logger.warning(f"Failed to start the NapCat bot: {e}")
 
     def stop_polling(self) -> None:
         """
@@ -75,9 +778,36 @@ class NapCat(BaseClient):
         outside the current thread where the event loop is running, it may cause
         deadlock. So we need to use `call_soon_threadsafe` to call
         `self.event_loop.stop()` in the event loop thread to avoid deadlock.
+
+        Before stopping the event loop, we close the connections of the bot
+        in the event loop, because they are bound to it.
         """
 
+        if not self._setup_done:
+            return
+
         self.logger.debug("Stopping the NapCat client...")
 
-        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
-        self.t.join()
+        # A client set up by a call without polling has no loop running, and
+        # has not loaded the contact snapshot and the media cache to save.
+        polling, self._polling = self._polling, False
+        if polling:
+            try:
+                self.bridge.call(self._close(), timeout=10)
+            except Exception as e:
+                self.logger.warning(f"Failed to close the NapCat bot: {e}")
+
+        if self.runtime is not None:
+            # The last account stops the shared loop and saves the media cache
+            self.runtime.release(self.channel.channel_id)
+        elif polling:
+            self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+            self.t.join()
+            self._save_media_cache()
+
+        if polling:
+            self._save_contact_snapshot()
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.message_index is not None:
+            self.message_index.close()
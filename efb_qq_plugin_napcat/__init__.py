@@ -1,3 +1,13 @@
-from . import NapCat  # type: ignore # noqa: F401
+import importlib
+from typing import Any
 
 __version__ = "0.0.1"
+
+
+def __getattr__(name: str) -> Any:
+    # The client module is imported when EFB loads the plugin by its entry
+    # point, not when the package is imported (e.g. for the version).
+    if name == "NapCat":
+        return importlib.import_module(f"{__name__}.NapCat")
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,366 @@
+"""
+Codec of the OneBot messages, as CQ-code strings or segment arrays
+"""
+
+from typing import Any, Iterable, Optional, Union
+
+_ESCAPE = str.maketrans({"&": "&amp;", "[": "&#91;", "]": "&#93;"})
+"""
+The escaping of the text outside the CQ-codes
+"""
+
+_ESCAPE_PARAM = str.maketrans({"&": "&amp;", "[": "&#91;", "]": "&#93;", ",": "&#44;"})
+"""
+The escaping of the parameter values of the CQ-codes
+"""
+
+_UNESCAPE = {"&amp;": "&", "&#91;": "[", "&#93;": "]", "&#44;": ","}
+
+_CQ_PREFIX = "[CQ:"
+
+_IMAGE_FIELDS = frozenset(("file", "url", "summary"))
+
+
+def escape(text: str, param: bool = False) -> str:
+    """
+    Escape the text for a CQ-code string, `param` escapes the commas too
+    for a parameter value.
+    """
+
+    return text.translate(_ESCAPE_PARAM if param else _ESCAPE)
+
+
+def unescape(text: str) -> str:
+    """
+    Unescape the text of a CQ-code string in one pass. An "&" not starting
+    a known entity is kept as it is.
+    """
+
+    if "&" not in text:
+        return text
+
+    parts = []
+    pos = 0
+    amp = text.find("&")
+    while amp >= 0:
+        # The entities are at most 5 characters long, e.g. "&#91;"
+        end = text.find(";", amp + 1, amp + 5) + 1
+        char = _UNESCAPE.get(text[amp:end]) if end else None
+        if char is None:
+            amp = text.find("&", amp + 1)
+            continue
+
+        parts.append(text[pos:amp])
+        parts.append(char)
+        pos = end
+        amp = text.find("&", pos)
+
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+class MessageSegment:
+    """
+    A segment of a OneBot message. The segments are `__slots__` records,
+    the known types have typed fields, the others are kept as
+    `OtherSegment` with the raw data.
+    """
+
+    __slots__ = ()
+
+    type: str
+    """
+    The type of the segment, e.g. "text" or "image"
+    """
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Get the segment in the array format sent to NapCat.
+        """
+
+        raise NotImplementedError
+
+    def to_cq(self) -> str:
+        """
+        Get the segment as a CQ-code (or the escaped text).
+        """
+
+        raise NotImplementedError
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({fields})"
+
+
+class TextSegment(MessageSegment):
+    __slots__ = ("text",)
+
+    type = "text"
+
+    text: str
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"type": "text", "data": {"text": self.text}}
+
+    def to_cq(self) -> str:
+        return self.text.translate(_ESCAPE)
+
+
+class AtSegment(MessageSegment):
+    __slots__ = ("qq",)
+
+    type = "at"
+
+    qq: str
+    """
+    The user id mentioned, or "all"
+    """
+
+    def __init__(self, qq: str) -> None:
+        self.qq = qq
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"type": "at", "data": {"qq": self.qq}}
+
+    def to_cq(self) -> str:
+        return f"[CQ:at,qq={self.qq.translate(_ESCAPE_PARAM)}]"
+
+
+class FaceSegment(MessageSegment):
+    __slots__ = ("id",)
+
+    type = "face"
+
+    id: int
+    """
+    The id of the QQ face
+    """
+
+    def __init__(self, id: int) -> None:
+        self.id = id
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"type": "face", "data": {"id": str(self.id)}}
+
+    def to_cq(self) -> str:
+        return f"[CQ:face,id={self.id}]"
+
+
+class ImageSegment(MessageSegment):
+    __slots__ = ("file", "url", "summary", "extra")
+
+    type = "image"
+
+    file: str
+    """
+    The file name of the image received, or the file to send (a path, a
+    url or base64)
+    """
+
+    url: Optional[str]
+    """
+    The url to download the image received
+    """
+
+    summary: Optional[str]
+    """
+    The summary of a sticker, e.g. "[动画表情]"
+    """
+
+    extra: Optional[dict[str, Any]]
+    """
+    The other fields of the data (e.g. "file_unique", which identifies the
+    image in the media cache), None if there are none
+    """
+
+    def __init__(
+        self,
+        file: str,
+        url: Optional[str] = None,
+        summary: Optional[str] = None,
+        extra: Optional[dict[str, Any]] = None,
+    ) -> None:
+        self.file = file
+        self.url = url
+        self.summary = summary
+        self.extra = extra
+
+    def to_dict(self) -> dict[str, Any]:
+        data = {"file": self.file}
+        if self.url is not None:
+            data["url"] = self.url
+        if self.summary is not None:
+            data["summary"] = self.summary
+        if self.extra is not None:
+            data.update(self.extra)
+
+        return {"type": "image", "data": data}
+
+    def to_cq(self) -> str:
+        cq = "[CQ:image,file=" + self.file.translate(_ESCAPE_PARAM)
+        if self.url is not None:
+            cq += ",url=" + self.url.translate(_ESCAPE_PARAM)
+        if self.summary is not None:
+            cq += ",summary=" + self.summary.translate(_ESCAPE_PARAM)
+        if self.extra is not None:
+            for key, value in self.extra.items():
+                cq += f",{key}=" + str(value).translate(_ESCAPE_PARAM)
+
+        return cq + "]"
+
+
+class ReplySegment(MessageSegment):
+    __slots__ = ("id",)
+
+    type = "reply"
+
+    id: str
+    """
+    The QQ id of the message replied to
+    """
+
+    def __init__(self, id: str) -> None:
+        self.id = id
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"type": "reply", "data": {"id": self.id}}
+
+    def to_cq(self) -> str:
+        return f"[CQ:reply,id={self.id.translate(_ESCAPE_PARAM)}]"
+
+
+class OtherSegment(MessageSegment):
+    """
+    A segment of a type without typed fields (e.g. "record" or "json").
+    """
+
+    __slots__ = ("type", "data")
+
+    data: dict[str, Any]
+
+    def __init__(self, type: str, data: dict[str, Any]) -> None:
+        self.type = type
+        self.data = data
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"type": self.type, "data": self.data}
+
+    def to_cq(self) -> str:
+        parts = [_CQ_PREFIX, self.type]
+        for key, value in self.data.items():
+            if value is None:
+                continue
+            parts.append(",")
+            parts.append(key)
+            parts.append("=")
+            parts.append(str(value).translate(_ESCAPE_PARAM))
+        parts.append("]")
+
+        return "".join(parts)
+
+
+def _build(kind: str, data: dict[str, Any]) -> MessageSegment:
+    """
+    Build the typed segment of the type, a segment missing its fields is
+    kept as an `OtherSegment`.
+    """
+
+    try:
+        if kind == "text":
+            return TextSegment(str(data["text"]))
+        if kind == "at":
+            return AtSegment(str(data["qq"]))
+        if kind == "face":
+            return FaceSegment(int(data["id"]))
+        if kind == "image":
+            url = data.get("url")
+            summary = data.get("summary")
+            extra = {k: v for k, v in data.items() if k not in _IMAGE_FIELDS}
+            return ImageSegment(
+                str(data["file"]),
+                None if url is None else str(url),
+                None if summary is None else str(summary),
+                extra or None,
+            )
+        if kind == "reply":
+            return ReplySegment(str(data["id"]))
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    return OtherSegment(kind, data)
+
+
+def parse_cq(message: str) -> list[MessageSegment]:
+    """
+    Parse a CQ-code string into segments in one pass: the scanner jumps
+    from one "[CQ:" to the next, the text between is one text segment.
+    An unterminated CQ-code is taken as text.
+    """
+
+    segments: list[MessageSegment] = []
+    pos = 0
+    length = len(message)
+
+    while pos < length:
+        start = message.find(_CQ_PREFIX, pos)
+        end = message.find("]", start) if start >= 0 else -1
+        if end < 0:
+            segments.append(TextSegment(unescape(message[pos:])))
+            break
+
+        if start > pos:
+            segments.append(TextSegment(unescape(message[pos:start])))
+
+        # The values are escaped, so the commas and "=" split the parameters
+        start += len(_CQ_PREFIX)
+        kind, *params = message[start:end].split(",")
+        data = {}
+        for param in params:
+            key, _, value = param.partition("=")
+            data[key] = unescape(value)
+        segments.append(_build(kind, data))
+
+        pos = end + 1
+
+    return segments
+
+
+def parse_array(message: Iterable[dict[str, Any]]) -> list[MessageSegment]:
+    """
+    Parse a message in the array format into segments.
+    """
+
+    return [_build(segment["type"], segment.get("data") or {}) for segment in message]
+
+
+def parse_message(
+    message: Union[str, Iterable[dict[str, Any]], None],
+) -> list[MessageSegment]:
+    """
+    Parse the "message" of an event, in the array format or as a CQ-code
+    string (when NapCat posts the messages as strings).
+    """
+
+    if message is None:
+        return []
+    if isinstance(message, str):
+        return parse_cq(message)
+
+    return parse_array(message)
+
+
+def to_cq(segments: Iterable[MessageSegment]) -> str:
+    return "".join([segment.to_cq() for segment in segments])
+
+
+def to_array(segments: Iterable[MessageSegment]) -> list[dict[str, Any]]:
+    return [segment.to_dict() for segment in segments]
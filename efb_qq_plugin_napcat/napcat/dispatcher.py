@@ -0,0 +1,203 @@
+"""
+Dispatch layer for NapCat actions
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional, TypedDict
+
+_READ_ONLY_PREFIXES = ("get_", "can_")
+
+
+def is_read_only_action(action_name: str) -> bool:
+    """
+    Whether the action only reads the state of the NapCat client. OneBot
+    names all these actions with the "get_" or "can_" prefix. Only these
+    actions are safe to be merged, merging two identical "send_msg" calls
+    would silently drop a message.
+    """
+
+    return action_name.startswith(_READ_ONLY_PREFIXES)
+
+
+class ActionDispatchStats(TypedDict):
+    calls: int
+    """
+    The number of calls submitted to the dispatcher
+    """
+
+    merged: int
+    """
+    The number of calls merged into an identical in-flight call
+    """
+
+    queue_wait_total: float
+    """
+    The total seconds calls waited for a concurrency slot
+    """
+
+    queue_wait_max: float
+    """
+    The longest seconds a call waited for a concurrency slot
+    """
+
+
+class NapCatActionDispatcher:
+    """
+    The NapCatActionDispatcher sits between `NapCatBot.call_action` and
+    the real request. It provides the following functionalities:
+
+    1. Merge identical in-flight read-only calls into one request. The
+       key is the action name plus the keyword arguments.
+    2. Cap the number of concurrent calls for each action.
+    3. Record how many calls were merged and how long the calls waited
+       in the queue.
+    """
+
+    _in_flight: dict[str, "asyncio.Task[Any]"]
+    """
+    The mapping from the call key to the in-flight call
+    """
+
+    _semaphores: dict[str, asyncio.Semaphore]
+    """
+    The mapping from the action name to its concurrency limit
+    """
+
+    _default_concurrency: int
+    """
+    The concurrency limit for actions not in `_action_concurrency`
+    """
+
+    _action_concurrency: dict[str, int]
+    """
+    The concurrency limit configured for specific actions
+    """
+
+    _coalesce: bool
+    """
+    Whether to merge identical in-flight calls
+    """
+
+    _stats: dict[str, ActionDispatchStats]
+    """
+    The statistics of every action
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self._in_flight = {}
+        self._semaphores = {}
+        self._default_concurrency = config.get("max_concurrent_actions", 8)
+        self._action_concurrency = dict(config.get("action_concurrency", {}))
+        self._coalesce = config.get("coalesce_actions", True)
+        self._stats = {}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def stats(self) -> dict[str, ActionDispatchStats]:
+        return self._stats
+
+    def _get_stats(self, action_name: str) -> ActionDispatchStats:
+        stats = self._stats.get(action_name)
+        if stats is None:
+            stats = ActionDispatchStats(
+                calls=0, merged=0, queue_wait_total=0.0, queue_wait_max=0.0
+            )
+            self._stats[action_name] = stats
+
+        return stats
+
+    def set_default_concurrency(self, action_name: str, limit: int) -> None:
+        """
+        Set the concurrency limit of an action, unless `action_concurrency`
+        configures one. It should be called before the action is dispatched.
+        """
+
+        self._action_concurrency.setdefault(action_name, limit)
+
+    def _get_semaphore(self, action_name: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(action_name)
+        if semaphore is None:
+            limit = self._action_concurrency.get(action_name, self._default_concurrency)
+            semaphore = asyncio.Semaphore(limit)
+            self._semaphores[action_name] = semaphore
+
+        return semaphore
+
+    @staticmethod
+    def _make_key(action_name: str, kwargs: dict[str, Any]) -> Optional[str]:
+        """
+        Build the key for merging calls. If the arguments cannot be
+        serialized, the call will never be merged.
+        """
+
+        try:
+            params = json.dumps(kwargs, sort_keys=True, separators=(",", ":"))
+        except (TypeError, ValueError):
+            return None
+
+        return f"{action_name}:{params}"
+
+    async def _run(
+        self,
+        action_name: str,
+        kwargs: dict[str, Any],
+        call: Callable[..., Awaitable[Any]],
+    ) -> Any:
+        stats = self._get_stats(action_name)
+
+        start = time.perf_counter()
+        async with self._get_semaphore(action_name):
+            wait = time.perf_counter() - start
+            stats["queue_wait_total"] += wait
+            stats["queue_wait_max"] = max(stats["queue_wait_max"], wait)
+
+            return await call(action_name, **kwargs)
+
+    async def dispatch(
+        self,
+        action_name: str,
+        kwargs: dict[str, Any],
+        call: Callable[..., Awaitable[Any]],
+    ) -> Any:
+        """
+        Dispatch the call. For the merged calls, the real request runs in
+        a separate task, so cancelling one caller will not cancel the
+        request for the others.
+        """
+
+        self._get_stats(action_name)["calls"] += 1
+
+        if not self._coalesce or not is_read_only_action(action_name):
+            return await self._run(action_name, kwargs, call)
+
+        key = self._make_key(action_name, kwargs)
+        if key is None:
+            return await self._run(action_name, kwargs, call)
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._get_stats(action_name)["merged"] += 1
+            self._logger.debug("Merged the call of %s into the in-flight one", key)
+        else:
+            task = asyncio.ensure_future(self._run(action_name, kwargs, call))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._call_done(key, t))
+
+        return await asyncio.shield(task)
+
+    def _call_done(self, key: str, task: "asyncio.Task[Any]") -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+        # Retrieve the exception, so asyncio will not complain about it when
+        # every caller has been cancelled. The callers still get it.
+        if not task.cancelled():
+            task.exception()
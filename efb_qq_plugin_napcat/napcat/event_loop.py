@@ -0,0 +1,66 @@
+"""
+Selectable backends of the event loop of napcat
+"""
+
+import asyncio
+import logging
+from typing import Any, Literal
+
+EventLoopBackend = Literal["asyncio", "uvloop"]
+
+logger = logging.getLogger(__name__)
+
+
+def _uvloop_installed() -> bool:
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+
+def select_backend(config: dict[str, Any]) -> EventLoopBackend:
+    """
+    Select the backend of the event loop by `event_loop`:
+
+    1. "asyncio" (the default): the event loop of the standard library.
+    2. "uvloop": the event loop of the "uvloop" package (the optional
+       dependency "uvloop"), which spends less CPU on the sockets and the
+       callbacks. It falls back to "asyncio" with a warning when the package
+       is not installed.
+    3. "auto": "uvloop" if it is installed, otherwise "asyncio".
+    """
+
+    backend = config.get("event_loop", "asyncio")
+    if backend not in ("asyncio", "uvloop", "auto"):
+        raise ValueError(f"Unknown event loop backend: {backend!r}")
+
+    if backend == "asyncio":
+        return "asyncio"
+
+    if _uvloop_installed():
+        return "uvloop"
+
+    if backend == "uvloop":
+        logger.warning("uvloop is not installed, using the asyncio event loop")
+
+    return "asyncio"
+
+
+def new_event_loop(config: dict[str, Any]) -> asyncio.AbstractEventLoop:
+    """
+    Create a new event loop of the backend selected by `select_backend`.
+
+    Only the loop is created, neither the event loop policy nor the current
+    event loop of any thread is changed, so the other channels of EFB keep
+    their own loops. The thread running the loop should set it as its
+    current event loop.
+    """
+
+    if select_backend(config) == "uvloop":
+        import uvloop
+
+        return uvloop.new_event_loop()
+
+    return asyncio.new_event_loop()
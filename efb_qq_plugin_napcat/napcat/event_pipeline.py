@@ -0,0 +1,309 @@
+"""
+Ingestion pipeline for the events of napcat
+"""
+
+import asyncio
+import collections
+import logging
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Generic,
+    Hashable,
+    Optional,
+    TypedDict,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+Event = dict[str, Any]
+
+
+def default_chat_key(event: Event) -> Hashable:
+    """
+    The events of one group or one user are in the same chat. The events
+    not belonging to any chat (e.g. heartbeats) share one chat.
+    """
+
+    group_id = event.get("group_id")
+    if group_id is not None:
+        return ("group", group_id)
+
+    user_id = event.get("user_id")
+    if user_id is not None:
+        return ("private", user_id)
+
+    return None
+
+
+class EventPipelineStats(TypedDict):
+    received: int
+    """
+    The number of events submitted to the pipeline
+    """
+
+    delivered: int
+    """
+    The number of converted events delivered
+    """
+
+    failed: int
+    """
+    The number of events failed to be converted or delivered
+    """
+
+    queue_depth: int
+    """
+    The number of events in the pipeline now
+    """
+
+    queue_depth_max: int
+    """
+    The most events in the pipeline at the same time
+    """
+
+    queue_wait_total: float
+    """
+    The total seconds events waited before being converted
+    """
+
+    queue_wait_max: float
+    """
+    The longest seconds an event waited before being converted
+    """
+
+    convert_total: float
+    """
+    The total seconds of the convert stage
+    """
+
+    convert_max: float
+    """
+    The longest seconds of the convert stage
+    """
+
+    deliver_total: float
+    """
+    The total seconds of the deliver stage
+    """
+
+    deliver_max: float
+    """
+    The longest seconds of the deliver stage
+    """
+
+
+class NapCatEventPipeline(Generic[T]):
+    """
+    The NapCatEventPipeline sits between the transport and the consumer of
+    the events. Every event goes through two stages:
+
+    1. convert: convert the OneBot event into the result (e.g. an EFB
+       message), None means the event is ignored.
+    2. deliver: hand the result to the consumer.
+
+    The pipeline provides the following functionalities:
+
+    1. Backpressure: at most `event_queue_size` events are in the pipeline,
+       `submit` waits when the pipeline is full, so a burst slows down the
+       transport instead of growing the memory without limit.
+    2. Per-chat ordering: the events of one chat are converted and
+       delivered one by one in the order they are submitted.
+    3. Parallelism across chats: up to `event_workers` chats are processed
+       at the same time.
+    4. Statistics of the queue depth and the latency of every stage.
+    """
+
+    _convert: Callable[[Event], Awaitable[Optional[T]]]
+    """
+    The convert stage
+    """
+
+    _deliver: Callable[[T], Awaitable[None]]
+    """
+    The deliver stage
+    """
+
+    _chat_key: Callable[[Event], Hashable]
+    """
+    The function to get the chat of an event
+    """
+
+    _max_pending: int
+    """
+    The most events in the pipeline at the same time
+    """
+
+    _max_workers: int
+    """
+    The most chats processed at the same time
+    """
+
+    _slots: Optional[asyncio.Semaphore]
+    """
+    The free slots of the pipeline, created in the running loop
+    """
+
+    _workers: Optional[asyncio.Semaphore]
+    """
+    The limit of the chats processed at the same time, created in the
+    running loop
+    """
+
+    _chats: dict[Hashable, "collections.deque[tuple[Event, float]]"]
+    """
+    The mapping from the chat to its waiting events and their submission
+    time, a chat is here only when it has a worker
+    """
+
+    _tasks: set["asyncio.Task[None]"]
+    """
+    The running workers
+    """
+
+    _stats: EventPipelineStats
+    """
+    The statistics of the pipeline
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        convert: Callable[[Event], Awaitable[Optional[T]]],
+        deliver: Callable[[T], Awaitable[None]],
+        chat_key: Callable[[Event], Hashable] = default_chat_key,
+    ) -> None:
+        self._convert = convert
+        self._deliver = deliver
+        self._chat_key = chat_key
+        self._max_pending = config.get("event_queue_size", 1024)
+        self._max_workers = config.get("event_workers", 16)
+        self._slots = None
+        self._workers = None
+        self._chats = {}
+        self._tasks = set()
+        self._stats = EventPipelineStats(
+            received=0,
+            delivered=0,
+            failed=0,
+            queue_depth=0,
+            queue_depth_max=0,
+            queue_wait_total=0.0,
+            queue_wait_max=0.0,
+            convert_total=0.0,
+            convert_max=0.0,
+            deliver_total=0.0,
+            deliver_max=0.0,
+        )
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def stats(self) -> EventPipelineStats:
+        return self._stats
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_pending)
+
+        return self._slots
+
+    def _get_workers(self) -> asyncio.Semaphore:
+        if self._workers is None:
+            self._workers = asyncio.Semaphore(self._max_workers)
+
+        return self._workers
+
+    async def submit(self, event: Event) -> None:
+        """
+        Submit one event. It waits when the pipeline is full.
+        """
+
+        await self._get_slots().acquire()
+
+        stats = self._stats
+        stats["received"] += 1
+        stats["queue_depth"] += 1
+        stats["queue_depth_max"] = max(stats["queue_depth_max"], stats["queue_depth"])
+
+        key = self._chat_key(event)
+        events = self._chats.get(key)
+        if events is not None:
+            events.append((event, time.perf_counter()))
+            return
+
+        self._chats[key] = collections.deque([(event, time.perf_counter())])
+        task = asyncio.ensure_future(self._run_chat(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_chat(self, key: Hashable) -> None:
+        """
+        Process the events of one chat until there is none left.
+        """
+
+        events = self._chats[key]
+        async with self._get_workers():
+            while events:
+                event, submitted_at = events.popleft()
+                try:
+                    await self._process(event, submitted_at)
+                finally:
+                    self._stats["queue_depth"] -= 1
+                    self._get_slots().release()
+
+        del self._chats[key]
+
+    async def _process(self, event: Event, submitted_at: float) -> None:
+        stats = self._stats
+
+        start = time.perf_counter()
+        wait = start - submitted_at
+        stats["queue_wait_total"] += wait
+        stats["queue_wait_max"] = max(stats["queue_wait_max"], wait)
+
+        try:
+            result = await self._convert(event)
+            converted = time.perf_counter()
+            stats["convert_total"] += converted - start
+            stats["convert_max"] = max(stats["convert_max"], converted - start)
+
+            if result is None:
+                return
+
+            await self._deliver(result)
+            delivered = time.perf_counter()
+            stats["deliver_total"] += delivered - converted
+            stats["deliver_max"] = max(stats["deliver_max"], delivered - converted)
+            stats["delivered"] += 1
+        except Exception:
+            stats["failed"] += 1
+            self._logger.exception("Failed to process the NapCat event")
+
+    async def join(self) -> None:
+        """
+        Wait until all the submitted events are processed.
+        """
+
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def close(self) -> None:
+        """
+        Cancel the events in the pipeline.
+        """
+
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+        self._chats.clear()
+        self._stats["queue_depth"] = 0
+        self._slots = None
@@ -49,6 +49,14 @@ class NapCatAPIFailureException(NapCatException):
 
         super().__init__(formatted_message)
 
+    @property
+    def status_code(self) -> Optional[int]:
+        return self._status_code
+
+    @property
+    def ret_code(self) -> Optional[int]:
+        return self._ret_code
+
 
 class NapCatCookieExpiredException(NapCatAPIFailureException):
     pass
@@ -64,3 +72,18 @@ class NapCatDisconnectedException(NapCatException):
 
 class NapCatUnknownException(NapCatException):
     pass
+
+
+class NapCatTimeoutException(NapCatException):
+    pass
+
+
+class NapCatMediaException(NapCatException):
+    pass
+
+
+class NapCatCircuitOpenException(NapCatDisconnectedException):
+    """
+    Exception raised at once without calling the action, because the recent
+    calls could not reach the NapCat client and the circuit breaker is open.
+    """
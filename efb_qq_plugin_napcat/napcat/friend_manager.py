@@ -1,15 +1,50 @@
+import asyncio
 import logging
-from typing import Optional, TypedDict
+import sys
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Iterable,
+    KeysView,
+    Optional,
+    TypedDict,
+    ValuesView,
+)
 
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatException
+from efb_qq_plugin_napcat.napcat.metrics import MetricsSink, instrumented
 from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
-from efb_qq_plugin_napcat.napcat.types.friend import Friend
+from efb_qq_plugin_napcat.napcat.snapshot import ContactRecord
+from efb_qq_plugin_napcat.napcat.types.friend import (
+    Friend,
+    FriendListDiff,
+    ResolvedContact,
+)
 
 
 class _GetFriendListRequest(TypedDict):
     no_cache: bool
 
 
-_GetFriendListResponse = list[Friend]
+class _FriendResponse(TypedDict):
+    user_id: int
+    nickname: str
+    remark: str
+
+
+_GetFriendListResponse = list[_FriendResponse]
+
+
+class _GetStrangerInfoRequest(TypedDict):
+    user_id: int
+
+
+class _GetStrangerInfoResponse(TypedDict):
+    user_id: int
+    nickname: str
 
 
 class NapCatFriendManager:
@@ -19,14 +54,76 @@ class NapCatFriendManager:
     The NapCatBot instance
     """
 
-    _friend_list: list[Friend]
+    _uid_to_friend: dict[int, Friend]
     """
-    The friend list of the qq account
+    The mapping from the user id to the friend instance, it is the only
+    place where the friends are stored
     """
 
-    _uid_to_friend: dict[int, Friend]
+    _diff_handlers: list[Callable[[FriendListDiff], Awaitable[None]]]
     """
-    The mapping from the user id to the friend instance
+    The handlers called when the friend list changes
+    """
+
+    _ttl: float
+    """
+    The seconds the friend list is fresh after a refresh. A stale friend
+    is still returned, but a refresh is started in the background.
+    """
+
+    _negative_ttl: float
+    """
+    The seconds a uid not in the friend list is remembered as a stranger
+    """
+
+    _min_refresh_interval: float
+    """
+    The minimum seconds between two refreshes forced by a missed uid
+    """
+
+    _refreshed_at: Optional[float]
+    """
+    The monotonic time of the last successful refresh
+    """
+
+    _forced_refresh_at: Optional[float]
+    """
+    The monotonic time of the last refresh forced by a missed uid
+    """
+
+    _strangers: dict[int, float]
+    """
+    The mapping from the uid not in the friend list to the monotonic time
+    it expires from the negative cache
+    """
+
+    _refresh_task: Optional["asyncio.Task[Optional[FriendListDiff]]"]
+    """
+    The in-flight refresh, shared by all the callers
+    """
+
+    _stranger_nicknames: "OrderedDict[int, tuple[str, float]]"
+    """
+    The LRU cache from the uid of a stranger to its nickname and the
+    monotonic time the nickname expires, the most recently used uid is at
+    the end
+    """
+
+    _stranger_info_ttl: float
+    """
+    The seconds the nickname of a stranger is cached
+    """
+
+    _stranger_info_cache_size: int
+    """
+    The most nicknames of strangers cached, the least recently used ones
+    are evicted
+    """
+
+    _stranger_lookups: dict[int, "asyncio.Task[Optional[str]]"]
+    """
+    The mapping from the uid of a stranger to the in-flight lookup of its
+    nickname, shared by all the callers
     """
 
     _logger: logging.Logger
@@ -34,20 +131,56 @@ class NapCatFriendManager:
     The logger instance
     """
 
-    def __init__(self, napcat_bot: NapCatBot) -> None:
+    def __init__(
+        self, napcat_bot: NapCatBot, config: Optional[dict[str, Any]] = None
+    ) -> None:
+        config = config or {}
+
         self._napcat_bot = napcat_bot
-        self._friend_list = []
         self._uid_to_friend = {}
+        self._diff_handlers = []
+        self._ttl = config.get("friend_list_ttl", 3600.0)
+        self._negative_ttl = config.get("friend_negative_ttl", 600.0)
+        self._min_refresh_interval = config.get("friend_min_refresh_interval", 60.0)
+        self._refreshed_at = None
+        self._forced_refresh_at = None
+        self._strangers = {}
+        self._refresh_task = None
+        self._stranger_nicknames = OrderedDict()
+        self._stranger_info_ttl = config.get("stranger_info_ttl", 3600.0)
+        self._stranger_info_cache_size = config.get("stranger_info_cache_size", 4096)
+        self._stranger_lookups = {}
         self._logger = logging.getLogger(__name__)
 
+        # The lookups of the strangers are limited by the dispatcher
+        napcat_bot.limit_action_concurrency(
+            "get_stranger_info", config.get("stranger_info_concurrency", 8)
+        )
+
+        # Only the fields above are decoded from the responses (with msgspec)
+        napcat_bot.register_response_type("get_friend_list", _GetFriendListResponse)
+        napcat_bot.register_response_type("get_stranger_info", _GetStrangerInfoResponse)
+
+    @property
+    def friend_list(self) -> ValuesView[Friend]:
+        """
+        A live view of the friends, not a copy.
+        """
+
+        return self._uid_to_friend.values()
+
     @property
-    def friend_list(self) -> list[Friend]:
-        return self._friend_list
+    def friend_uids(self) -> KeysView[int]:
+        return self._uid_to_friend.keys()
 
     @property
     def uid_to_friend(self) -> dict[int, Friend]:
         return self._uid_to_friend
 
+    @property
+    def metrics(self) -> Optional[MetricsSink]:
+        return self._napcat_bot.metrics
+
     async def _get_friend_list(
         self, request: _GetFriendListRequest
     ) -> _GetFriendListResponse:
@@ -58,72 +191,336 @@ class NapCatFriendManager:
         res = await self._napcat_bot.call_action("get_friend_list", **request)
         return res
 
-    def _update_friend_list_callback(self, qq_friends: _GetFriendListResponse) -> None:
+    def snapshot_records(self) -> list[ContactRecord]:
+        """
+        Get the friends as the records of the contact snapshot.
+        """
+
+        return [
+            (friend.user_id, friend.nickname, friend.remark)
+            for friend in self._uid_to_friend.values()
+        ]
+
+    def restore_snapshot_records(self, records: list[ContactRecord]) -> None:
+        """
+        Restore the friends from the records of the contact snapshot. It
+        should be called before the first refresh. The restored friend list
+        is stale, so the first lookup returns the restored remark and
+        starts a refresh in the background to reconcile with NapCat.
+        """
+
+        if self._uid_to_friend:
+            return
+
+        for user_id, nickname, remark in records:
+            self._uid_to_friend[user_id] = Friend(
+                user_id=user_id, nickname=nickname, remark=remark
+            )
+
+        self._logger.debug("Restored %d friends from the snapshot", len(records))
+
+    def on_friend_list_changed(
+        self, handler: Callable[[FriendListDiff], Awaitable[None]]
+    ) -> None:
+        """
+        Register a handler called with the diff when a refresh changes the
+        friend list, so the chats can be updated incrementally.
         """
-        When successfully updating the friend list, we will update the
-        `_friend_list` and `_uid_to_friend` attributes. Because the
-        `response` may contain many unused fields. It's not suitable just
-        assign the `response` to the `_friend_list` attribute. Because
-        Python is a dynamic language, it will cost a lot of memory to
-        store the unused fields. So we will only store the fields we need.
 
-        Then we populate the mapping from the user id to the friend instance.
-        We will never clear the mapping. We will only update the mapping
-        when we update the friend list.
+        self._diff_handlers.append(handler)
 
-        So there may be some friends that are not in the friend list but
-        in the mapping. However, we will not remove them from the mapping.
-        Only when you delete a friend from the QQ account, this situation
-        will happen, if you delete one, I guess you will not care about
-        this so called friend anymore. :)
+    def _update_friend_list_callback(
+        self, qq_friends: _GetFriendListResponse
+    ) -> FriendListDiff:
+        """
+        When successfully updating the friend list, we will diff the
+        `response` against `_uid_to_friend` instead of rebuilding it.
+        Because the `response` may contain many unused fields, we only
+        store the fields we need, and we only create a Friend instance
+        for a new friend. A friend whose nickname or remark changed is
+        updated in place, and the friends not in the `response` anymore
+        are deleted from `_uid_to_friend`. So a refresh without changes
+        allocates nothing but the set of seen uids.
         """
 
-        self._friend_list.clear()
+        diff = FriendListDiff(added=[], removed=[], updated=[])
+        seen: set[int] = set()
 
         for qq_friend in qq_friends:
+            uid = qq_friend["user_id"]
+            nickname = qq_friend["nickname"]
+            remark = qq_friend["remark"] if qq_friend["remark"] != "" else nickname
+            seen.add(uid)
 
-            new_friend = Friend(
-                user_id=qq_friend["user_id"],
-                nickname=qq_friend["nickname"],
-                remark=(
-                    qq_friend["remark"]
-                    if qq_friend["remark"] != ""
-                    else qq_friend["nickname"]
-                ),
-            )
+            friend = self._uid_to_friend.get(uid)
+            if friend is None:
+                friend = Friend(user_id=uid, nickname=nickname, remark=remark)
+                self._uid_to_friend[uid] = friend
+                diff["added"].append(friend)
+            elif friend.nickname != nickname or friend.remark != remark:
+                friend.nickname = sys.intern(nickname)
+                friend.remark = sys.intern(remark)
+                diff["updated"].append(friend)
 
-            self._friend_list.append(new_friend)
-            self._uid_to_friend[new_friend["user_id"]] = new_friend
+        if len(seen) != len(self._uid_to_friend):
+            for uid in [uid for uid in self._uid_to_friend if uid not in seen]:
+                diff["removed"].append(self._uid_to_friend.pop(uid))
 
-    async def update_friend_list(self, no_cache: bool = True) -> None:
+        return diff
+
+    @instrumented("friend_manager.update_friend_list")
+    async def update_friend_list(self, no_cache: bool = True) -> Optional[FriendListDiff]:
         """
         Get the friend list of the qq account. However, the res should
         never be None. If the res is None, we will log a warning message.
         It may be a bug from the NapCat upstream.
+
+        Return the diff of the friend list, or None if the update failed.
         """
 
         request: _GetFriendListRequest = {"no_cache": no_cache}
         qq_friends = await self._get_friend_list(request)
 
-        if qq_friends:
-            self._logger.debug("Updated friend list")
-
-            self._update_friend_list_callback(qq_friends)
-        else:
+        if not qq_friends:
             self._logger.warning("Failed to update the friend list")
+            return None
+
+        diff = self._update_friend_list_callback(qq_friends)
+        self._refreshed_at = time.monotonic()
+        self._logger.debug(
+            "Updated friend list: %d added, %d removed, %d updated",
+            len(diff["added"]),
+            len(diff["removed"]),
+            len(diff["updated"]),
+        )
+
+        if diff["added"] or diff["removed"] or diff["updated"]:
+            for handler in self._diff_handlers:
+                await handler(diff)
+
+        return diff
+
+    def _refresh(self) -> "asyncio.Task[Optional[FriendListDiff]]":
+        """
+        Start a refresh of the friend list, or join the in-flight one.
+        """
+
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self.update_friend_list())
+            self._refresh_task.add_done_callback(self._refresh_done)
+
+        return self._refresh_task
+
+    def _refresh_done(self, task: "asyncio.Task[Optional[FriendListDiff]]") -> None:
+        if task.cancelled():
+            return
+
+        if task.exception() is not None:
+            self._logger.warning(f"Failed to refresh the friend list: {task.exception()}")
+            return
+
+        # The friend list is fresh now, forget the expired strangers and the
+        # strangers who became friends.
+        now = time.monotonic()
+        self._strangers = {
+            uid: expire_at
+            for uid, expire_at in self._strangers.items()
+            if expire_at > now and uid not in self._uid_to_friend
+        }
+
+    def _is_stale(self, now: float) -> bool:
+        return self._refreshed_at is None or now - self._refreshed_at >= self._ttl
 
     async def get_friend_remark(self, uid: int) -> Optional[str]:
         """
-        Get the remark of one friend by uid. If we cannot find the friend,
-        we will first forcedly update the friend list and try again. If
-        we still cannot find the friend, we will return None. Otherwise,
-        we will return the remark of the friend.
+        Get the remark of one friend by uid. The friend list is cached with
+        the following policy:
+
+        1. If we can find the friend, we return the remark at once. If the
+           friend list is older than `friend_list_ttl`, we start a refresh
+           in the background (stale-while-revalidate).
+        2. If the uid was recently confirmed not to be a friend, we return
+           None at once (negative cache, `friend_negative_ttl`).
+        3. Otherwise we forcedly update the friend list and try again, but
+           at most once per `friend_min_refresh_interval`, concurrent
+           callers share the same refresh. If we still cannot find the
+           friend, we remember the uid as a stranger and return None.
         """
 
-        if (not self._friend_list) or (uid not in self._uid_to_friend):
-            await self.update_friend_list()
+        now = time.monotonic()
+        metrics = self._napcat_bot.metrics
+
+        friend = self._uid_to_friend.get(uid)
+        if friend is not None:
+            if metrics is not None:
+                metrics.cache_lookup("friend_remark", True)
+            if self._is_stale(now):
+                self._refresh()
+            return friend.remark
 
-        if uid not in self._uid_to_friend:
+        expire_at = self._strangers.get(uid)
+        if expire_at is not None and expire_at > now:
+            if metrics is not None:
+                metrics.cache_lookup("friend_remark", True)
             return None
 
-        return self._uid_to_friend[uid]["remark"]
+        if metrics is not None:
+            metrics.cache_lookup("friend_remark", False)
+
+        await self._refresh_for_miss(now)
+
+        friend = self._uid_to_friend.get(uid)
+        if friend is None:
+            self._strangers[uid] = time.monotonic() + self._negative_ttl
+            return None
+
+        return friend.remark
+
+    async def _refresh_for_miss(self, now: float) -> None:
+        """
+        Refresh the friend list for the missed uids, join the in-flight
+        refresh or skip it within `friend_min_refresh_interval`.
+        """
+
+        in_flight = self._refresh_task is not None and not self._refresh_task.done()
+        if (
+            in_flight
+            or self._forced_refresh_at is None
+            or now - self._forced_refresh_at >= self._min_refresh_interval
+        ):
+            if not in_flight:
+                self._forced_refresh_at = now
+            await asyncio.shield(self._refresh())
+
+    async def get_remarks(self, uids: Iterable[int]) -> dict[int, Optional[str]]:
+        """
+        Get the remarks of many uids at once, e.g. the senders of a forwarded
+        message or the users mentioned in a group message. The cache policy
+        is the one of `get_friend_remark`, but the uids are answered from the
+        friend list in one pass, and all the misses share one refresh. The
+        remark of a uid not in the friend list is None.
+        """
+
+        now = time.monotonic()
+        metrics = self._napcat_bot.metrics
+        remarks: dict[int, Optional[str]] = {}
+        misses: list[int] = []
+        found = False
+
+        for uid in uids:
+            if uid in remarks:
+                continue
+
+            friend = self._uid_to_friend.get(uid)
+            if friend is not None:
+                remarks[uid] = friend.remark
+                found = hit = True
+            else:
+                remarks[uid] = None
+                expire_at = self._strangers.get(uid)
+                hit = expire_at is not None and expire_at > now
+                if not hit:
+                    misses.append(uid)
+
+            if metrics is not None:
+                metrics.cache_lookup("friend_remark", hit)
+
+        if misses:
+            await self._refresh_for_miss(now)
+
+            expire_at = time.monotonic() + self._negative_ttl
+            for uid in misses:
+                friend = self._uid_to_friend.get(uid)
+                if friend is None:
+                    self._strangers[uid] = expire_at
+                else:
+                    remarks[uid] = friend.remark
+        elif found and self._is_stale(now):
+            self._refresh()
+
+        return remarks
+
+    async def resolve_contacts(self, uids: Iterable[int]) -> dict[int, ResolvedContact]:
+        """
+        Resolve many uids into contacts at once. The friends are resolved by
+        `get_remarks`, the nicknames of the other uids are fetched by
+        "get_stranger_info" as one batch through the dispatcher, at most
+        `stranger_info_concurrency` calls at a time. Concurrent callers share
+        the lookup of the same uid, and the nicknames are cached for
+        `stranger_info_ttl` seconds, up to `stranger_info_cache_size` of
+        them. So the number of round trips to NapCat does not grow with the
+        friends resolved, nor with the callers.
+        """
+
+        remarks = await self.get_remarks(uids)
+        contacts: dict[int, ResolvedContact] = {}
+        strangers: list[int] = []
+        now = time.monotonic()
+
+        for uid, remark in remarks.items():
+            friend = self._uid_to_friend.get(uid)
+            if friend is not None:
+                contacts[uid] = ResolvedContact(
+                    user_id=uid, nickname=friend.nickname, remark=remark, is_friend=True
+                )
+                continue
+
+            cached = self._stranger_nicknames.get(uid)
+            if cached is not None and cached[1] > now:
+                self._stranger_nicknames.move_to_end(uid)
+                contacts[uid] = ResolvedContact(
+                    user_id=uid, nickname=cached[0], remark=None, is_friend=False
+                )
+            else:
+                strangers.append(uid)
+
+        if strangers:
+            nicknames = await asyncio.gather(
+                *(self._lookup_stranger(uid) for uid in strangers)
+            )
+            for uid, nickname in zip(strangers, nicknames):
+                contacts[uid] = ResolvedContact(
+                    user_id=uid,
+                    nickname=nickname or str(uid),
+                    remark=None,
+                    is_friend=False,
+                )
+
+        return contacts
+
+    async def _lookup_stranger(self, uid: int) -> Optional[str]:
+        """
+        Get the nickname of a stranger, or join the in-flight lookup.
+        """
+
+        task = self._stranger_lookups.get(uid)
+        if task is None:
+            task = asyncio.ensure_future(self._get_stranger_nickname(uid))
+            self._stranger_lookups[uid] = task
+            task.add_done_callback(lambda _: self._stranger_lookups.pop(uid, None))
+
+        return await asyncio.shield(task)
+
+    async def _get_stranger_nickname(self, uid: int) -> Optional[str]:
+        request: _GetStrangerInfoRequest = {"user_id": uid}
+        try:
+            res: Optional[_GetStrangerInfoResponse] = await self._napcat_bot.call_action(
+                "get_stranger_info", **request
+            )
+        except NapCatException as e:
+            self._logger.debug(f"Failed to get the stranger {uid}: {e!r}")
+            return None
+
+        if not res or not res.get("nickname"):
+            return None
+
+        nickname = sys.intern(res["nickname"])
+        self._stranger_nicknames[uid] = (
+            nickname,
+            time.monotonic() + self._stranger_info_ttl,
+        )
+        self._stranger_nicknames.move_to_end(uid)
+        while len(self._stranger_nicknames) > self._stranger_info_cache_size:
+            self._stranger_nicknames.popitem(last=False)
+
+        return nickname
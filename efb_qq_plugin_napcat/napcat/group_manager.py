@@ -0,0 +1,445 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Optional, TypedDict, ValuesView
+
+from efb_qq_plugin_napcat.napcat.metrics import MetricsSink, instrumented
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.snapshot import ContactRecord
+from efb_qq_plugin_napcat.napcat.types.group import Group, GroupMember
+
+
+class _GetGroupListRequest(TypedDict):
+    no_cache: bool
+
+
+class _GroupResponse(TypedDict):
+    group_id: int
+    group_name: str
+    member_count: int
+
+
+_GetGroupListResponse = list[_GroupResponse]
+
+
+class _GetGroupMemberListRequest(TypedDict):
+    group_id: int
+    no_cache: bool
+
+
+class _GetGroupMemberInfoRequest(TypedDict):
+    group_id: int
+    user_id: int
+    no_cache: bool
+
+
+class _GroupMemberResponse(TypedDict):
+    user_id: int
+    nickname: str
+    card: str
+
+
+_GetGroupMemberListResponse = list[_GroupMemberResponse]
+
+_MEMBER_INDEX_OVERHEAD = 100
+"""
+The approximate bytes of a member in the index besides the member
+itself: the hash table slot and the int key.
+"""
+
+
+class NapCatGroupManager:
+    """
+    The NapCatGroupManager caches the groups of the qq account and the
+    members of every group. The group list is small and is loaded as a
+    whole, but a group may have thousands of members, so the member list
+    of a group is only loaded when a member name of the group is needed.
+
+    The member lists are kept in an LRU cache with a memory budget
+    (`group_member_cache_bytes`), the least recently used member lists
+    are evicted when the budget is exceeded, and loaded again on demand.
+    """
+
+    _napcat_bot: NapCatBot
+    """
+    The NapCatBot instance
+    """
+
+    _gid_to_group: dict[int, Group]
+    """
+    The mapping from the group id to the group instance
+    """
+
+    _members: "OrderedDict[int, dict[int, GroupMember]]"
+    """
+    The LRU cache from the group id to the mapping from the user id to
+    the member, the most recently used group is at the end
+    """
+
+    _members_bytes: dict[int, int]
+    """
+    The approximate bytes of the cached member list of every group
+    """
+
+    _cache_bytes: int
+    """
+    The approximate bytes of all the cached member lists
+    """
+
+    _cache_budget: int
+    """
+    The memory budget of all the cached member lists
+    """
+
+    _loading: dict[int, "asyncio.Task[Optional[dict[int, GroupMember]]]"]
+    """
+    The mapping from the group id to the in-flight member list loading
+    """
+
+    _negative_ttl: float
+    """
+    The seconds a group id not in the group list is remembered as unknown
+    """
+
+    _min_refresh_interval: float
+    """
+    The minimum seconds between two refreshes forced by a missed group id
+    """
+
+    _forced_refresh_at: Optional[float]
+    """
+    The monotonic time of the last refresh forced by a missed group id
+    """
+
+    _unknown_groups: dict[int, float]
+    """
+    The mapping from the group id not in the group list to the monotonic
+    time it expires from the negative cache
+    """
+
+    _refresh_task: Optional["asyncio.Task[None]"]
+    """
+    The in-flight refresh forced by a missed group id, shared by all the
+    callers
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(
+        self, napcat_bot: NapCatBot, config: Optional[dict[str, Any]] = None
+    ) -> None:
+        config = config or {}
+
+        self._napcat_bot = napcat_bot
+        self._gid_to_group = {}
+        self._members = OrderedDict()
+        self._members_bytes = {}
+        self._cache_bytes = 0
+        self._cache_budget = config.get("group_member_cache_bytes", 32 * 1024 * 1024)
+        self._loading = {}
+        self._negative_ttl = config.get("group_negative_ttl", 600.0)
+        self._min_refresh_interval = config.get("group_min_refresh_interval", 60.0)
+        self._forced_refresh_at = None
+        self._unknown_groups = {}
+        self._refresh_task = None
+        self._logger = logging.getLogger(__name__)
+
+        # Only the fields above are decoded from the responses (with msgspec)
+        napcat_bot.register_response_type("get_group_list", _GetGroupListResponse)
+        napcat_bot.register_response_type(
+            "get_group_member_list", _GetGroupMemberListResponse
+        )
+        napcat_bot.register_response_type("get_group_member_info", _GroupMemberResponse)
+
+    @property
+    def group_list(self) -> ValuesView[Group]:
+        """
+        A live view of the groups, not a copy.
+        """
+
+        return self._gid_to_group.values()
+
+    @property
+    def gid_to_group(self) -> dict[int, Group]:
+        return self._gid_to_group
+
+    @property
+    def cache_bytes(self) -> int:
+        return self._cache_bytes
+
+    @property
+    def metrics(self) -> Optional[MetricsSink]:
+        return self._napcat_bot.metrics
+
+    def cached_member_groups(self) -> list[int]:
+        """
+        Get the ids of the groups whose member lists are cached, from the
+        least recently used to the most recently used.
+        """
+
+        return list(self._members)
+
+    def snapshot_records(self) -> list[ContactRecord]:
+        """
+        Get the groups as the records of the contact snapshot. The member
+        lists are not saved, they are loaded lazily anyway.
+        """
+
+        return [
+            (group.group_id, group.group_name, group.group_name)
+            for group in self._gid_to_group.values()
+        ]
+
+    def restore_snapshot_records(self, records: list[ContactRecord]) -> None:
+        """
+        Restore the groups from the records of the contact snapshot. It
+        should be called before the first update of the group list.
+        """
+
+        if self._gid_to_group:
+            return
+
+        for group_id, group_name, _ in records:
+            self._gid_to_group[group_id] = Group(
+                group_id=group_id, group_name=group_name, member_count=0
+            )
+
+        self._logger.debug("Restored %d groups from the snapshot", len(records))
+
+    @instrumented("group_manager.update_group_list")
+    async def update_group_list(self, no_cache: bool = True) -> None:
+        """
+        Get the group list of the qq account. The groups not in the group
+        list anymore are deleted with their cached member lists.
+        """
+
+        request: _GetGroupListRequest = {"no_cache": no_cache}
+        qq_groups: Optional[_GetGroupListResponse] = await self._napcat_bot.call_action(
+            "get_group_list", **request
+        )
+
+        if qq_groups is None:
+            self._logger.warning("Failed to update the group list")
+            return
+
+        seen: set[int] = set()
+        for qq_group in qq_groups:
+            group_id = qq_group["group_id"]
+            seen.add(group_id)
+
+            group = self._gid_to_group.get(group_id)
+            if group is None:
+                self._gid_to_group[group_id] = Group(
+                    group_id=group_id,
+                    group_name=qq_group["group_name"],
+                    member_count=qq_group["member_count"],
+                )
+            else:
+                if group.group_name != qq_group["group_name"]:
+                    group.group_name = sys.intern(qq_group["group_name"])
+                group.member_count = qq_group["member_count"]
+
+        for group_id in [gid for gid in self._gid_to_group if gid not in seen]:
+            del self._gid_to_group[group_id]
+            self._evict(group_id)
+
+        self._logger.debug("Updated group list: %d groups", len(self._gid_to_group))
+
+    async def get_group_name(self, group_id: int) -> Optional[str]:
+        """
+        Get the name of one group. If we cannot find the group, we will
+        update the group list and try again, with the policy of
+        `NapCatFriendManager.get_friend_remark`: a group id recently
+        confirmed unknown is answered None at once (`group_negative_ttl`),
+        and the misses force a refresh at most once per
+        `group_min_refresh_interval`, concurrent callers share it.
+        """
+
+        group = self._gid_to_group.get(group_id)
+        if group is not None:
+            return group.group_name
+
+        now = time.monotonic()
+        expire_at = self._unknown_groups.get(group_id)
+        if expire_at is not None and expire_at > now:
+            return None
+
+        await self._refresh_for_miss(now)
+
+        group = self._gid_to_group.get(group_id)
+        if group is None:
+            self._unknown_groups[group_id] = time.monotonic() + self._negative_ttl
+            return None
+
+        return group.group_name
+
+    async def _refresh_for_miss(self, now: float) -> None:
+        """
+        Refresh the group list for the missed group ids, join the in-flight
+        refresh or skip it within `group_min_refresh_interval`.
+        """
+
+        if self._refresh_task is None or self._refresh_task.done():
+            if (
+                self._forced_refresh_at is not None
+                and now - self._forced_refresh_at < self._min_refresh_interval
+            ):
+                return
+
+            self._forced_refresh_at = now
+            self._refresh_task = asyncio.ensure_future(self.update_group_list())
+            self._refresh_task.add_done_callback(self._refresh_done)
+
+        await asyncio.shield(self._refresh_task)
+
+    def _refresh_done(self, task: "asyncio.Task[None]") -> None:
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        # The group list is fresh now, forget the expired unknown groups and
+        # the groups joined meanwhile.
+        now = time.monotonic()
+        self._unknown_groups = {
+            group_id: expire_at
+            for group_id, expire_at in self._unknown_groups.items()
+            if expire_at > now and group_id not in self._gid_to_group
+        }
+
+    @staticmethod
+    def _estimate_bytes(members: dict[int, GroupMember]) -> int:
+        size = sys.getsizeof(members)
+        for member in members.values():
+            size += (
+                sys.getsizeof(member)
+                + sys.getsizeof(member.nickname)
+                + sys.getsizeof(member.card)
+                + _MEMBER_INDEX_OVERHEAD
+            )
+
+        return size
+
+    def _evict(self, group_id: int) -> None:
+        if self._members.pop(group_id, None) is not None:
+            self._cache_bytes -= self._members_bytes.pop(group_id)
+
+    def _cache_members(self, group_id: int, members: dict[int, GroupMember]) -> None:
+        self._evict(group_id)
+
+        size = self._estimate_bytes(members)
+        self._members[group_id] = members
+        self._members_bytes[group_id] = size
+        self._cache_bytes += size
+
+        # Evict the least recently used groups, but always keep the group
+        # just loaded, even if it alone exceeds the budget.
+        while self._cache_bytes > self._cache_budget and len(self._members) > 1:
+            evicted = next(iter(self._members))
+            self._evict(evicted)
+            self._logger.debug("Evicted the member list of group %d", evicted)
+
+    @instrumented("group_manager.load_members")
+    async def _load_members(self, group_id: int) -> Optional[dict[int, GroupMember]]:
+        request: _GetGroupMemberListRequest = {"group_id": group_id, "no_cache": False}
+        qq_members: Optional[_GetGroupMemberListResponse] = (
+            await self._napcat_bot.call_action("get_group_member_list", **request)
+        )
+
+        if qq_members is None:
+            self._logger.warning(f"Failed to get the member list of group {group_id}")
+            return None
+
+        members = {
+            qq_member["user_id"]: GroupMember(
+                user_id=qq_member["user_id"],
+                nickname=qq_member["nickname"],
+                card=qq_member.get("card") or "",
+            )
+            for qq_member in qq_members
+        }
+        self._cache_members(group_id, members)
+        self._logger.debug("Loaded %d members of group %d", len(members), group_id)
+
+        return members
+
+    async def get_members(self, group_id: int) -> Optional[dict[int, GroupMember]]:
+        """
+        Get the members of one group, loading them if they are not cached.
+        Concurrent callers share the same loading.
+        """
+
+        metrics = self._napcat_bot.metrics
+
+        members = self._members.get(group_id)
+        if members is not None:
+            if metrics is not None:
+                metrics.cache_lookup("group_members", True)
+            self._members.move_to_end(group_id)
+            return members
+
+        if metrics is not None:
+            metrics.cache_lookup("group_members", False)
+
+        task = self._loading.get(group_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load_members(group_id))
+            self._loading[group_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(group_id, None))
+
+        return await asyncio.shield(task)
+
+    async def _get_member_info(
+        self, group_id: int, user_id: int
+    ) -> Optional[GroupMember]:
+        """
+        Get one member who is not in the cached member list, e.g. a member
+        who joined the group after the member list was loaded.
+        """
+
+        request: _GetGroupMemberInfoRequest = {
+            "group_id": group_id,
+            "user_id": user_id,
+            "no_cache": False,
+        }
+        qq_member: Optional[_GroupMemberResponse] = await self._napcat_bot.call_action(
+            "get_group_member_info", **request
+        )
+
+        if not qq_member:
+            return None
+
+        return GroupMember(
+            user_id=qq_member["user_id"],
+            nickname=qq_member["nickname"],
+            card=qq_member.get("card") or "",
+        )
+
+    async def get_member_name(self, group_id: int, user_id: int) -> Optional[str]:
+        """
+        Get the name of one member in the group, which is the card of the
+        member or the nickname if the card is empty. The member list of
+        the group is loaded lazily by the first call.
+        """
+
+        members = await self.get_members(group_id)
+        if members is None:
+            return None
+
+        member = members.get(user_id)
+        if member is None:
+            member = await self._get_member_info(group_id, user_id)
+            if member is None:
+                return None
+
+            # The cached member list may have been evicted meanwhile
+            if self._members.get(group_id) is members:
+                members[user_id] = member
+                size = self._estimate_bytes({user_id: member}) - sys.getsizeof({})
+                self._members_bytes[group_id] += size
+                self._cache_bytes += size
+
+        return member.display_name
@@ -0,0 +1,241 @@
+"""
+Adaptive health monitor of the NapCat client
+"""
+
+import asyncio
+import collections
+import random
+import time
+from typing import Any, Literal, Optional, TypedDict
+
+HealthState = Literal["unknown", "up", "down"]
+
+
+class HealthTransition(TypedDict):
+    state: HealthState
+    """
+    The state entered
+    """
+
+    at: float
+    """
+    The wall-clock time of the transition, in seconds since the epoch
+    """
+
+    reason: str
+    """
+    Why the state was entered, e.g. the exception of the failed probe
+    """
+
+
+class NapCatHealthMonitor:
+    """
+    The NapCatHealthMonitor decides when to probe the status of the
+    NapCat client:
+
+    1. When the client is up, it is probed every `health_interval` seconds,
+       but every successful action counts as a liveness signal, so a busy
+       bot is not probed at all.
+    2. When the client is down, it is probed again with an exponential
+       backoff from `health_retry_min` to `health_retry_max` seconds, with
+       a random jitter of `health_retry_jitter` (a ratio of the delay), so
+       a short restart of NapCat is noticed in seconds.
+    3. A failed action (e.g. the connection is refused) wakes the monitor
+       up to probe at once instead of waiting for the next probe.
+
+    The recent state transitions are kept with their timestamps.
+    """
+
+    _interval: float
+    """
+    The seconds between the probes when the client is up
+    """
+
+    _retry_min: float
+    """
+    The first delay of the backoff when the client is down
+    """
+
+    _retry_max: float
+    """
+    The cap of the delay of the backoff
+    """
+
+    _jitter: float
+    """
+    The ratio of the random jitter of the backoff
+    """
+
+    _state: HealthState
+    """
+    The current state of the client
+    """
+
+    _last_alive: Optional[float]
+    """
+    The monotonic time of the last liveness signal
+    """
+
+    _failures: int
+    """
+    The number of consecutive failed probes
+    """
+
+    _transitions: "collections.deque[HealthTransition]"
+    """
+    The recent state transitions, the latest is at the end
+    """
+
+    _wake: Optional[asyncio.Event]
+    """
+    The event to wake the monitor up, created in the running loop
+    """
+
+    _up: Optional[asyncio.Event]
+    """
+    Set while the client is up, created in the running loop
+    """
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self._interval = config.get("health_interval", 300.0)
+        self._retry_min = config.get("health_retry_min", 2.0)
+        self._retry_max = config.get("health_retry_max", 300.0)
+        self._jitter = config.get("health_retry_jitter", 0.2)
+        self._state = "unknown"
+        self._last_alive = None
+        self._failures = 0
+        self._transitions = collections.deque(maxlen=32)
+        self._wake = None
+        self._up = None
+
+    @property
+    def state(self) -> HealthState:
+        return self._state
+
+    @property
+    def consecutive_failures(self) -> int:
+        return self._failures
+
+    @property
+    def transitions(self) -> list[HealthTransition]:
+        return list(self._transitions)
+
+    @property
+    def last_transition(self) -> Optional[HealthTransition]:
+        return self._transitions[-1] if self._transitions else None
+
+    def _get_wake(self) -> asyncio.Event:
+        if self._wake is None:
+            self._wake = asyncio.Event()
+
+        return self._wake
+
+    def _get_up(self) -> asyncio.Event:
+        if self._up is None:
+            self._up = asyncio.Event()
+            if self._state == "up":
+                self._up.set()
+
+        return self._up
+
+    async def wait_up(self) -> None:
+        """
+        Wait until the client is up.
+        """
+
+        await self._get_up().wait()
+
+    def _transit(self, state: HealthState, reason: str) -> None:
+        if state == self._state:
+            return
+
+        self._state = state
+        if self._up is not None:
+            if state == "up":
+                self._up.set()
+            else:
+                self._up.clear()
+        self._transitions.append(
+            HealthTransition(state=state, at=time.time(), reason=reason)
+        )
+
+    def mark_up(self) -> None:
+        """
+        Record a successful probe.
+        """
+
+        self._failures = 0
+        self._last_alive = time.monotonic()
+        self._transit("up", "probe succeeded")
+
+    def mark_down(self, reason: str) -> None:
+        """
+        Record a failed probe.
+        """
+
+        self._failures += 1
+        self._transit("down", reason)
+
+        # The failed probe may have woken the monitor up, wait for the backoff
+        if self._wake is not None:
+            self._wake.clear()
+
+    def record_alive(self) -> None:
+        """
+        Record a liveness signal, e.g. a successful action.
+        """
+
+        self._last_alive = time.monotonic()
+
+    def record_unreachable(self) -> None:
+        """
+        Record that an action could not reach the client. If the client
+        is thought to be up, the monitor probes at once, otherwise the
+        backoff goes on (the failed probes are also such actions).
+        """
+
+        if self._state != "up":
+            return
+
+        self._last_alive = None
+        self._get_wake().set()
+
+    def should_probe(self) -> bool:
+        """
+        Whether to probe now: the client is not known to be up, or there
+        is no liveness signal within `health_interval` seconds.
+        """
+
+        if self._state != "up" or self._last_alive is None:
+            return True
+
+        return time.monotonic() - self._last_alive >= self._interval
+
+    def next_delay(self) -> float:
+        """
+        The seconds to wait before the next check.
+        """
+
+        if self._state != "up":
+            delay = min(
+                self._retry_max, self._retry_min * 2 ** max(self._failures - 1, 0)
+            )
+            jitter = delay * self._jitter
+            return min(self._retry_max, delay + random.uniform(-jitter, jitter))
+
+        if self._last_alive is None:
+            return 0.0
+
+        return max(0.0, self._last_alive + self._interval - time.monotonic())
+
+    async def wait(self) -> None:
+        """
+        Wait until the next check or until the monitor is woken up.
+        """
+
+        wake = self._get_wake()
+        try:
+            await asyncio.wait_for(wake.wait(), self.next_delay())
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
@@ -0,0 +1,199 @@
+"""
+HTTP API with a persistent connection pool for napcat
+"""
+
+import asyncio
+import importlib.util
+import logging
+from typing import TYPE_CHECKING, Any, Optional
+
+import httpx
+from aiocqhttp.api import AsyncApi
+from aiocqhttp.exceptions import ApiNotAvailable, HttpFailed, NetworkError
+
+from efb_qq_plugin_napcat.napcat.json_decoder import NapCatJsonDecoder
+
+if TYPE_CHECKING:
+    from efb_qq_plugin_napcat.napcat.runtime import NapCatRuntime
+
+
+class NapCatHttpApi(AsyncApi):
+    """
+    The aiocqhttp `HttpApi` creates a new `httpx.AsyncClient` for every
+    action, so every action pays a new TCP handshake. NapCatHttpApi owns
+    one long-lived client with keep-alive connections instead.
+
+    The client is bound to the event loop where it is created, so it is
+    created lazily in the running loop (the event loop of the NapCat
+    client) when the first action is called. If the running loop changes,
+    a new client will be created for the new loop.
+
+    With a shared runtime (several accounts in one process), the client of
+    the runtime is used instead, and every request waits for its fair turn
+    in the connection pool.
+
+    The exceptions raised are the same as the aiocqhttp `HttpApi`, so the
+    caller can handle them in the same way.
+    """
+
+    _api_root: Optional[str]
+    """
+    The root url of the NapCat HTTP API, always ends with "/"
+    """
+
+    _headers: dict[str, str]
+    """
+    The headers sent with every action, passed per request: the client
+    also downloads the media from the QQ CDN, which must not get the
+    access token
+    """
+
+    _timeout_sec: float
+    """
+    The timeout of every request
+    """
+
+    _limits: httpx.Limits
+    """
+    The limits of the connection pool
+    """
+
+    _http2: bool
+    """
+    Whether to use HTTP/2
+    """
+
+    _client: Optional[httpx.AsyncClient]
+    """
+    The shared client, None before the first action is called
+    """
+
+    _client_loop: Optional[asyncio.AbstractEventLoop]
+    """
+    The event loop where `_client` is created
+    """
+
+    _runtime: Optional["NapCatRuntime"]
+    """
+    The runtime shared with the other accounts, None if the client is owned
+    """
+
+    _account: str
+    """
+    The account scheduled in the shared runtime
+    """
+
+    _decoder: NapCatJsonDecoder
+    """
+    The decoder of the response bodies
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        runtime: Optional["NapCatRuntime"] = None,
+        account: str = "",
+        decoder: Optional[NapCatJsonDecoder] = None,
+    ) -> None:
+        super().__init__()
+
+        api_root = config.get("api_root")
+        self._api_root = api_root.rstrip("/") + "/" if api_root else None
+
+        self._headers = {}
+        if config["access_token"]:
+            self._headers["Authorization"] = "Bearer " + config["access_token"]
+
+        self._timeout_sec = config["api_timeout"]
+        self._limits = httpx.Limits(
+            max_connections=config.get("http_max_connections", 16),
+            max_keepalive_connections=config.get("http_max_keepalive_connections", 8),
+            keepalive_expiry=config.get("http_keepalive_expiry", 60.0),
+        )
+        self._logger = logging.getLogger(__name__)
+
+        self._http2 = config.get("http2", False)
+        if self._http2 and importlib.util.find_spec("h2") is None:
+            self._logger.warning(
+                "HTTP/2 needs the 'h2' package, falling back to HTTP/1.1"
+            )
+            self._http2 = False
+
+        self._client = None
+        self._client_loop = None
+        self._runtime = runtime
+        self._account = account
+        self._decoder = decoder or NapCatJsonDecoder(config)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Get the shared client for the running event loop. It carries no
+        access token, so it can be used for the other hosts too.
+        """
+
+        if self._runtime is not None:
+            return self._runtime.client
+
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=self._timeout_sec,
+                limits=self._limits,
+                http2=self._http2,
+            )
+            self._client_loop = loop
+
+        return self._client
+
+    async def start(self) -> None:
+        """
+        Nothing to start, the client is created lazily by the first action.
+        HTTP does not push events, so no event is received in this mode.
+        """
+
+    async def call_action(self, action: str, **params: Any) -> Any:
+        if not self._api_root:
+            raise ApiNotAvailable
+
+        try:
+            if self._runtime is None:
+                resp = await self.client.post(
+                    self._api_root + action, json=params, headers=self._headers
+                )
+            else:
+                resp = await self._shared_post(self._api_root + action, params)
+            if 200 <= resp.status_code < 300:
+                return self._decoder.decode_result(action, resp.content)
+            raise HttpFailed(resp.status_code)
+        except httpx.InvalidURL:
+            raise NetworkError("API root url invalid")
+        except httpx.HTTPError:
+            raise NetworkError("HTTP request failed")
+
+    async def _shared_post(self, url: str, params: dict[str, Any]) -> httpx.Response:
+        runtime: NapCatRuntime = self._runtime  # type: ignore[assignment]
+        await runtime.scheduler.acquire(self._account)
+        try:
+            return await runtime.client.post(
+                url, json=params, headers=self._headers, timeout=self._timeout_sec
+            )
+        finally:
+            runtime.scheduler.release()
+
+    async def close(self) -> None:
+        """
+        Close the shared client and all its connections. It should be
+        called in the event loop where the client is created. The client
+        of a shared runtime is closed by the runtime.
+        """
+
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._client_loop = None
@@ -0,0 +1,261 @@
+"""
+Selectable JSON decoders of the NapCat responses and events
+"""
+
+import json
+import logging
+from typing import Any, Callable, Literal, Optional, TypedDict, Union
+
+from aiocqhttp.api_impl import _handle_api_result
+from aiocqhttp.exceptions import ActionFailed
+
+JsonBackend = Literal["json", "orjson", "msgspec"]
+
+logger = logging.getLogger(__name__)
+
+_EVENT_KEY = '"post_type"'
+"""
+The key only found in the events, a frame without it is a response
+"""
+
+_EVENT_KEY_BYTES = _EVENT_KEY.encode()
+
+
+def _installed(package: str) -> bool:
+    try:
+        __import__(package)
+    except ImportError:
+        return False
+
+    return True
+
+
+def select_backend(config: dict[str, Any]) -> JsonBackend:
+    """
+    Select the JSON decoder by `json_backend`:
+
+    1. "auto" (the default): "msgspec" if it is installed, otherwise
+       "orjson" if it is installed, otherwise "json".
+    2. "msgspec": the "msgspec" package (the optional dependency "msgspec")
+       decodes the responses of the actions with a registered schema
+       straight into the schema, the unused fields are skipped while
+       decoding instead of being built and dropped.
+    3. "orjson": the "orjson" package (the optional dependency "orjson")
+       decodes everything into plain objects, faster than "json".
+    4. "json": the standard library.
+
+    A backend not installed falls back to the next one with a warning.
+    """
+
+    backend = config.get("json_backend", "auto")
+    if backend not in ("auto", "msgspec", "orjson", "json"):
+        raise ValueError(f"Unknown JSON backend: {backend!r}")
+
+    if backend == "json":
+        return "json"
+
+    if backend in ("auto", "msgspec"):
+        if _installed("msgspec"):
+            return "msgspec"
+        if backend == "msgspec":
+            logger.warning("msgspec is not installed, trying orjson")
+
+    if _installed("orjson"):
+        return "orjson"
+    if backend != "auto":
+        logger.warning("orjson is not installed, using the json module")
+
+    return "json"
+
+
+class JsonDecoderStats(TypedDict):
+    typed: int
+    """
+    The number of responses decoded into their schemas
+    """
+
+    generic: int
+    """
+    The number of responses and events decoded into plain objects
+    """
+
+    fallbacks: int
+    """
+    The number of responses not matching their schemas, decoded again into
+    plain objects
+    """
+
+
+class NapCatJsonDecoder:
+    """
+    The NapCatJsonDecoder decodes the bodies of the responses and the
+    WebSocket frames of NapCat with the backend selected by `select_backend`.
+
+    The managers register the schema (a TypedDict, or a list of them) of the
+    "data" of the hot actions by `register`, e.g. "get_friend_list". With
+    msgspec, their responses are decoded into the schema directly: only the
+    fields of the schema are kept, the dozens of other fields of a contact
+    are skipped by the decoder. A response not matching its schema (e.g. a
+    field of another type) is decoded again into plain objects, so a change
+    of NapCat never breaks an action.
+
+    The results are the same with every backend: plain dicts and lists, so
+    the callers do not change.
+    """
+
+    backend: JsonBackend
+    """
+    The backend in use
+    """
+
+    _loads: Callable[[Union[bytes, str]], Any]
+    """
+    Decode into plain objects
+    """
+
+    _schemas: dict[str, Any]
+    """
+    The schemas of the "data" of the registered actions
+    """
+
+    _decoders: dict[str, Any]
+    """
+    The msgspec decoders of the registered actions, built lazily
+    """
+
+    _msgspec: Any
+    """
+    The msgspec module, None with the other backends
+    """
+
+    _echo_decoder: Any
+    """
+    The msgspec decoder only reading the echo of a frame
+    """
+
+    _stats: JsonDecoderStats
+    """
+    The statistics of the decoder
+    """
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.backend = select_backend(config)
+        self._schemas = {}
+        self._decoders = {}
+        self._msgspec = None
+        self._echo_decoder = None
+        self._stats = JsonDecoderStats(typed=0, generic=0, fallbacks=0)
+
+        if self.backend == "msgspec":
+            import msgspec
+
+            self._msgspec = msgspec
+            self._loads = msgspec.json.decode
+
+            class _Echo(msgspec.Struct):
+                echo: Any = None
+
+            self._echo_decoder = msgspec.json.Decoder(_Echo)
+        elif self.backend == "orjson":
+            import orjson
+
+            self._loads = orjson.loads
+        else:
+            self._loads = json.loads
+
+    @property
+    def stats(self) -> JsonDecoderStats:
+        return self._stats.copy()
+
+    def register(self, action: str, schema: Any) -> None:
+        """
+        Register the schema of the "data" of the responses of the action.
+        """
+
+        self._schemas[action] = schema
+        self._decoders.pop(action, None)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        """
+        Decode into plain objects, e.g. an event.
+        """
+
+        self._stats["generic"] += 1
+        return self._loads(data)
+
+    def _typed_decoder(self, action: str) -> Any:
+        decoder = self._decoders.get(action)
+        if decoder is None:
+            msgspec = self._msgspec
+            response = msgspec.defstruct(
+                f"{action}_response",
+                [
+                    ("status", str),
+                    ("retcode", int, 0),
+                    ("data", Optional[self._schemas[action]], None),
+                    ("message", Optional[str], None),
+                    ("wording", Optional[str], None),
+                ],
+            )
+            decoder = self._decoders[action] = msgspec.json.Decoder(response)
+
+        return decoder
+
+    def decode_result(self, action: str, payload: Union[bytes, str, Any]) -> Any:
+        """
+        Get the "data" of the response of the action, like
+        `aiocqhttp.api_impl._handle_api_result`. The payload is the body of the
+        response, or the response already decoded by `decode_frame`.
+
+        :raise ActionFailed: the status of the response is "failed"
+        """
+
+        if not isinstance(payload, (bytes, str)):
+            return _handle_api_result(payload)
+
+        if self._msgspec is not None and action in self._schemas:
+            try:
+                result = self._typed_decoder(action).decode(payload)
+            except self._msgspec.ValidationError as e:
+                self._stats["fallbacks"] += 1
+                logger.debug(
+                    "The response of %s does not match its schema: %s", action, e
+                )
+            else:
+                self._stats["typed"] += 1
+                if result.status == "failed":
+                    raise ActionFailed(result=self._msgspec.structs.asdict(result))
+                return result.data
+
+        return _handle_api_result(self.loads(payload))
+
+    def decode_frame(self, raw: Union[bytes, str]) -> tuple[Optional[str], Any]:
+        """
+        Decode a WebSocket frame into (echo, response) for a response, and
+        (None, event) for an event. With msgspec, a response is only read
+        for its echo, it is decoded by `decode_result` with its action then.
+
+        :raise ValueError: the frame is not valid JSON
+        """
+
+        if self._echo_decoder is not None:
+            # A frame without "post_type" cannot be an event, its other fields
+            # are skipped until the action decodes it
+            if (_EVENT_KEY_BYTES if isinstance(raw, bytes) else _EVENT_KEY) not in raw:
+                try:
+                    echo = self._echo_decoder.decode(raw).echo
+                except self._msgspec.ValidationError:
+                    # Not an object, it is ignored below like the others do
+                    echo = None
+                if echo is not None:
+                    return str(echo), raw
+
+        frame = self.loads(raw)
+        if not isinstance(frame, dict):
+            return None, None
+
+        echo = frame.get("echo")
+        if echo is not None and "post_type" not in frame:
+            return str(echo), frame
+
+        return None, frame
@@ -0,0 +1,223 @@
+"""
+Bridge between the EFB threads and the event loop of napcat
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Any, Coroutine, Optional, TypedDict, TypeVar
+
+from efb_qq_plugin_napcat.napcat.exceptions import (
+    NapCatDisconnectedException,
+    NapCatTimeoutException,
+)
+
+T = TypeVar("T")
+
+
+class LoopBridgeStats(TypedDict):
+    calls: int
+    """
+    The number of coroutines submitted to the event loop
+    """
+
+    timeouts: int
+    """
+    The number of calls cancelled because of the timeout
+    """
+
+    schedule_wait_total: float
+    """
+    The total seconds coroutines waited for the event loop to start them
+    """
+
+    schedule_wait_max: float
+    """
+    The longest seconds a coroutine waited for the event loop to start it
+    """
+
+    call_wait_total: float
+    """
+    The total seconds the calling threads waited for the results
+    """
+
+    call_wait_max: float
+    """
+    The longest seconds a calling thread waited for the result
+    """
+
+
+class NapCatLoopBridge:
+    """
+    EFB calls the methods of the client (e.g. `send_message`) from its own
+    threads, but the NapCat client runs in its own event loop thread. The
+    NapCatLoopBridge marshals the coroutines onto that event loop:
+
+    1. `call`: wait for the result in the calling thread with a timeout.
+       The coroutine is cancelled when the timeout expires, and only the
+       calling thread waits, the other threads are not blocked.
+    2. `submit`: get a `concurrent.futures.Future` at once, cancelling it
+       cancels the coroutine.
+    3. `fire_and_forget`: run the coroutine without waiting, the failure
+       is logged.
+
+    The coroutines are only submitted while the event loop runs, i.e.
+    between `poll` and `stop_polling` of the client, otherwise they fail at
+    once instead of waiting for the timeout.
+
+    It also records how long the coroutines waited for the event loop and
+    how long the calling threads waited for the results.
+    """
+
+    _loop: asyncio.AbstractEventLoop
+    """
+    The event loop of the NapCat client
+    """
+
+    _default_timeout: Optional[float]
+    """
+    The timeout of `call` when it is not given
+    """
+
+    _pending: set["concurrent.futures.Future[Any]"]
+    """
+    The fire-and-forget calls not finished yet
+    """
+
+    _stats: LoopBridgeStats
+    """
+    The statistics of the calls
+    """
+
+    _lock: threading.Lock
+    """
+    The lock of `_stats` and `_pending`, they are updated from many threads
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, config: dict[str, Any]) -> None:
+        self._loop = loop
+        self._default_timeout = config.get("bridge_timeout", 60.0)
+        self._pending = set()
+        self._stats = LoopBridgeStats(
+            calls=0,
+            timeouts=0,
+            schedule_wait_total=0.0,
+            schedule_wait_max=0.0,
+            call_wait_total=0.0,
+            call_wait_max=0.0,
+        )
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def stats(self) -> LoopBridgeStats:
+        with self._lock:
+            return self._stats.copy()
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of fire-and-forget calls not finished yet.
+        """
+
+        return len(self._pending)
+
+    def wait_running(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the event loop, just started in another thread, runs the
+        callbacks. Return False if it does not in `timeout` seconds.
+        """
+
+        running = threading.Event()
+        self._loop.call_soon_threadsafe(running.set)
+        return running.wait(timeout)
+
+    async def _timed(self, coro: Coroutine[Any, Any, T], submitted_at: float) -> T:
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self._stats["schedule_wait_total"] += wait
+            self._stats["schedule_wait_max"] = max(self._stats["schedule_wait_max"], wait)
+
+        return await coro
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> "concurrent.futures.Future[T]":
+        """
+        Submit the coroutine to the event loop. It should never be called
+        in the event loop thread, await the coroutine directly there.
+        """
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self._loop:
+            coro.close()
+            raise RuntimeError("Cannot wait for the event loop in its own thread")
+
+        if not self._loop.is_running():
+            coro.close()
+            raise NapCatDisconnectedException("The NapCat client is not polling")
+
+        with self._lock:
+            self._stats["calls"] += 1
+
+        return asyncio.run_coroutine_threadsafe(
+            self._timed(coro, time.perf_counter()), self._loop
+        )
+
+    def call(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        """
+        Run the coroutine in the event loop and wait for the result. If the
+        result is not ready in `timeout` seconds (`bridge_timeout` by
+        default), the coroutine is cancelled and NapCatTimeoutException is
+        raised. The exceptions raised by the coroutine are raised here.
+        """
+
+        if timeout is None:
+            timeout = self._default_timeout
+
+        start = time.perf_counter()
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise NapCatTimeoutException(
+                f"The NapCat client did not respond in {timeout} seconds"
+            )
+        finally:
+            wait = time.perf_counter() - start
+            with self._lock:
+                self._stats["call_wait_total"] += wait
+                self._stats["call_wait_max"] = max(self._stats["call_wait_max"], wait)
+
+    def fire_and_forget(self, coro: Coroutine[Any, Any, Any]) -> None:
+        """
+        Run the coroutine in the event loop without waiting for it.
+        """
+
+        future = self.submit(coro)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._fire_and_forget_done)
+
+    def _fire_and_forget_done(self, future: "concurrent.futures.Future[Any]") -> None:
+        with self._lock:
+            self._pending.discard(future)
+
+        if future.cancelled():
+            return
+
+        exception = future.exception()
+        if exception is not None:
+            self._logger.warning(f"The fire-and-forget call failed: {exception!r}")
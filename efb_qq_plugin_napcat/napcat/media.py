@@ -0,0 +1,320 @@
+"""
+Streaming media I/O for napcat
+"""
+
+import asyncio
+import base64
+import logging
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatMediaException
+from efb_qq_plugin_napcat.napcat.media_cache import NapCatMediaCache, media_key
+from efb_qq_plugin_napcat.napcat.metrics import MetricsSink, instrumented
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+_LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+_BASE64_CHUNK = 3 * 256 * 1024
+"""
+The bytes encoded at a time, a multiple of 3, so the chunks can be
+encoded separately and concatenated
+"""
+
+
+class NapCatMediaIO:
+    """
+    The NapCatMediaIO transfers the media (images, voices, videos and
+    files) without holding them in memory:
+
+    1. Inbound media are streamed in chunks from the url of the OneBot
+       segment to a temporary file, through the shared HTTP client. The
+       file is written in the default executor, not in the event loop.
+       A temporary file handed out by `fetch` is deleted by `release`
+       once the message is delivered, and the ones left behind (e.g. by a
+       crash) are deleted after `media_temp_ttl` seconds.
+    2. Outbound media are passed to NapCat as "file://" paths when NapCat
+       runs on the same host, NapCat reads the files itself. Otherwise the
+       file is encoded into a "base64://" uri chunk by chunk.
+
+    Whether NapCat runs on the same host is guessed from `api_root` or
+    `ws_url`, and can be set with `media_local_path`.
+
+    With a NapCatMediaCache, the inbound media are served from the cache
+    when they have been downloaded before, and the outbound images are
+    added to it, so a sticker forwarded back and forth is downloaded once.
+    """
+
+    _napcat_bot: NapCatBot
+    """
+    The NapCatBot instance, its HTTP client downloads the media
+    """
+
+    _media_dir: Path
+    """
+    The directory of the downloaded media
+    """
+
+    _chunk_size: int
+    """
+    The bytes read from the network at a time
+    """
+
+    _max_size: int
+    """
+    The largest media to download in bytes
+    """
+
+    _local_path: bool
+    """
+    Whether NapCat can read the files of this host
+    """
+
+    _cache: Optional[NapCatMediaCache]
+    """
+    The media cache, None if the media are not cached
+    """
+
+    _fetching: dict[str, "asyncio.Task[Path]"]
+    """
+    The mapping from the cache key to the in-flight download
+    """
+
+    _temporary: set[Path]
+    """
+    The temporary files handed out by `fetch`, not released yet
+    """
+
+    _temp_ttl: float
+    """
+    The seconds after which a temporary file left behind is deleted
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(
+        self,
+        napcat_bot: NapCatBot,
+        config: dict[str, Any],
+        media_dir: Optional[Path] = None,
+        cache: Optional[NapCatMediaCache] = None,
+    ) -> None:
+        self._napcat_bot = napcat_bot
+        self._cache = cache
+        self._fetching = {}
+        self._media_dir = media_dir or Path(tempfile.gettempdir()) / "efb-napcat-media"
+        self._chunk_size = config.get("media_chunk_size", 64 * 1024)
+        self._max_size = config.get("media_max_size", 200 * 1024 * 1024)
+        self._temporary = set()
+        self._temp_ttl = config.get("media_temp_ttl", 24 * 3600.0)
+        self._logger = logging.getLogger(__name__)
+
+        local_path = config.get("media_local_path")
+        if local_path is None:
+            url = config.get("api_root") or config.get("ws_url") or ""
+            local_path = urlsplit(url).hostname in _LOCAL_HOSTS
+        self._local_path = local_path
+
+    @property
+    def local_path(self) -> bool:
+        return self._local_path
+
+    @property
+    def cache(self) -> Optional[NapCatMediaCache]:
+        return self._cache
+
+    @property
+    def metrics(self) -> Optional[MetricsSink]:
+        return self._napcat_bot.metrics
+
+    @instrumented("media.download")
+    async def download(self, url: str, suffix: str = "") -> Path:
+        """
+        Download the media to a temporary file and return its path. The
+        caller owns the file and should delete it when it is not needed.
+        """
+
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, self._create_temp, suffix)
+        path = Path(f.name)
+
+        try:
+            async with self._napcat_bot.http_client.stream("GET", url) as resp:
+                resp.raise_for_status()
+
+                size = 0
+                async for chunk in resp.aiter_bytes(self._chunk_size):
+                    size += len(chunk)
+                    if size > self._max_size:
+                        raise NapCatMediaException(
+                            f"The media is larger than {self._max_size} bytes"
+                        )
+                    await loop.run_in_executor(None, f.write, chunk)
+            await loop.run_in_executor(None, f.close)
+        except httpx.HTTPError as e:
+            await loop.run_in_executor(None, self._discard, f)
+            raise NapCatMediaException(f"Failed to download the media: {e}")
+        except BaseException:
+            await loop.run_in_executor(None, self._discard, f)
+            raise
+
+        self._logger.debug("Downloaded %d bytes to %s", size, path)
+        return path
+
+    def _create_temp(self, suffix: str) -> BinaryIO:
+        self._media_dir.mkdir(parents=True, exist_ok=True)
+
+        return tempfile.NamedTemporaryFile(  # type: ignore[return-value]
+            "wb", suffix=suffix, dir=self._media_dir, delete=False
+        )
+
+    @staticmethod
+    def _discard(f: BinaryIO) -> None:
+        f.close()
+        Path(f.name).unlink(missing_ok=True)
+
+    def purge_stale(self) -> None:
+        """
+        Delete the temporary files older than `media_temp_ttl` seconds, which
+        were never released, e.g. because of a crash.
+        """
+
+        if not self._media_dir.is_dir():
+            return
+
+        expire_before = time.time() - self._temp_ttl
+        for path in self._media_dir.iterdir():
+            try:
+                if path.stat().st_mtime < expire_before:
+                    path.unlink()
+            except OSError:
+                pass
+
+    async def release(self, path: Path, file: Optional[BinaryIO] = None) -> None:
+        """
+        Release the media handed out by `fetch` once it is not needed, e.g.
+        the message is delivered: the file opened is closed, a temporary
+        file is deleted, and a cached media is unpinned.
+        """
+
+        temporary = path in self._temporary
+        self._temporary.discard(path)
+        if file is None and not temporary and self._cache is None:
+            return
+
+        def close() -> None:
+            if file is not None:
+                file.close()
+            if temporary:
+                path.unlink(missing_ok=True)
+            elif self._cache is not None:
+                self._cache.unpin(path)
+
+        await asyncio.get_running_loop().run_in_executor(None, close)
+
+    async def fetch(self, data: dict[str, Any]) -> Path:
+        """
+        Get the media of the data of a OneBot segment, downloading it from
+        its url if it is not cached. Concurrent fetches of the same media
+        share the same download. Only the media without a cache key are
+        temporary files, the cached ones belong to the cache and are pinned
+        against the eviction. Either way, the caller should `release` the
+        path when it is not needed.
+        """
+
+        url = data.get("url")
+        if not url:
+            raise NapCatMediaException("The media segment has no url")
+        suffix = Path(data.get("file") or "").suffix
+
+        key = media_key(data) if self._cache is not None else None
+        if key is None:
+            path = await self.download(url, suffix)
+            self._temporary.add(path)
+            return path
+
+        path = self._cache.lookup(key, pin=True)  # type: ignore[union-attr]
+        metrics = self._napcat_bot.metrics
+        if metrics is not None:
+            metrics.cache_lookup("media", path is not None)
+        if path is not None:
+            return path
+
+        task = self._fetching.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_to_cache(key, url, suffix))
+            self._fetching[key] = task
+            task.add_done_callback(lambda _: self._fetching.pop(key, None))
+
+        await asyncio.shield(task)
+        path = self._cache.pin(key)  # type: ignore[union-attr]
+        if path is None:
+            # Evicted by the other media before it was pinned
+            path = await self.download(url, suffix)
+            self._temporary.add(path)
+
+        return path
+
+    async def _fetch_to_cache(self, key: str, url: str, suffix: str) -> Path:
+        path = await self.download(url, suffix)
+        return self._cache.put(key, path)  # type: ignore[union-attr]
+
+    def open(self, path: Path) -> BinaryIO:
+        """
+        Open the media for reading, the hot media are read from memory.
+        """
+
+        if self._cache is not None:
+            return self._cache.open(path)
+
+        return open(path, "rb")
+
+    def file_uri(self, path: Path) -> str:
+        """
+        Get the uri of a local file for the "file" field of the OneBot
+        segment. Base64 is only the fallback for a remote NapCat.
+        """
+
+        if self._local_path:
+            return path.resolve().as_uri()
+
+        content = self._cache.read_hot(path) if self._cache is not None else None
+        if content is not None:
+            return "base64://" + base64.b64encode(content).decode("ascii")
+
+        return "base64://" + self._encode_base64(path)
+
+    def _encode_base64(self, path: Path) -> str:
+        chunks = []
+        with open(path, "rb") as f:
+            while chunk := f.read(_BASE64_CHUNK):
+                chunks.append(base64.b64encode(chunk).decode("ascii"))
+
+        return "".join(chunks)
+
+    def media_segment(self, segment_type: str, path: Path) -> dict[str, Any]:
+        """
+        Build the OneBot segment (e.g. "image", "record", "video", "file")
+        of a local file. The images (e.g. stickers) are added to the cache,
+        they are likely to be sent again or to come back.
+        """
+
+        if self._cache is not None and segment_type == "image":
+            try:
+                path = self._cache.add_file(path)
+            except OSError as e:
+                self._logger.warning(f"Failed to cache the media {path}: {e}")
+
+        data = {"file": self.file_uri(path)}
+        if segment_type == "file":
+            data["name"] = path.name
+
+        return {"type": segment_type, "data": data}
@@ -0,0 +1,502 @@
+"""
+Content-addressed on-disk cache of the media of napcat
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, BinaryIO, Optional, TypedDict
+
+_INDEX_NAME = "index.json"
+
+_MD5_NAME = re.compile(r"^([0-9a-fA-F]{32})(\.\w+)?$")
+"""
+QQ names the images after the MD5 of their content, e.g. "0A1B...9F.jpg"
+"""
+
+_KEY_NAME = re.compile(r"^[0-9a-f]{32}(?:[0-9a-f]{8})?$")
+"""
+The name of a cached file without the suffix: an MD5 or a SHA-1
+"""
+
+_KEY_FIELDS = ("file_unique", "md5", "file_id", "file")
+"""
+The fields of a OneBot segment identifying the media, in the order of
+preference
+"""
+
+
+def media_key(data: dict[str, Any]) -> Optional[str]:
+    """
+    Get the cache key of the media in the data of a OneBot segment. The
+    MD5 of the content is used as it is when the segment carries it, so
+    the same media sent back to QQ has the same key. The other ids are
+    hashed. A plain file name (e.g. "report.pdf") identifies nothing, so
+    there is no key then.
+    """
+
+    for field in _KEY_FIELDS:
+        value = data.get(field)
+        if not value or not isinstance(value, str):
+            continue
+
+        match = _MD5_NAME.match(value)
+        if match is not None:
+            return match.group(1).lower()
+
+        if field != "file":
+            return hashlib.sha1(f"{field}:{value}".encode()).hexdigest()
+
+    return None
+
+
+def file_md5(path: Path, chunk_size: int = 64 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+class MediaCacheStats(TypedDict):
+    hits: int
+    """
+    The number of lookups served by the cache, including the hot set
+    """
+
+    hot_hits: int
+    """
+    The number of lookups served by the in-memory hot set
+    """
+
+    misses: int
+    """
+    The number of lookups not in the cache
+    """
+
+    evictions: int
+    """
+    The number of media evicted from the disk
+    """
+
+    entries: int
+    """
+    The number of media on the disk now
+    """
+
+    bytes: int
+    """
+    The bytes of the media on the disk now
+    """
+
+
+class _CacheEntry:
+    __slots__ = ("suffix", "size", "hits")
+
+    suffix: str
+    size: int
+    hits: int
+
+    def __init__(self, suffix: str, size: int, hits: int = 0) -> None:
+        self.suffix = suffix
+        self.size = size
+        self.hits = hits
+
+
+class NapCatMediaCache:
+    """
+    The NapCatMediaCache keeps the media (stickers, forwarded memes, ...)
+    on the disk, so a media sent over and over is downloaded only once.
+
+    1. The media are addressed by their content: the MD5 in the OneBot
+       segment, or the other QQ file ids (see `media_key`). A file is
+       stored as `<key><suffix>` in the cache directory.
+    2. The total size is bounded by `media_cache_bytes`, the least recently
+       used media are deleted when it is exceeded.
+    3. The index is saved to the cache directory by `save` and restored by
+       `load`, so the cache survives restarts.
+    4. The media hit at least `media_hot_min_hits` times and not larger
+       than `media_hot_item_bytes` are also kept in memory, up to
+       `media_hot_bytes` in total, so the most popular stickers are not
+       read from the disk again.
+    5. The media handed out with `pin=True` (e.g. attached to a message not
+       delivered yet) are not evicted until they are `unpin`ned.
+
+    It is used from the event loop and the EFB threads, so it is guarded
+    by a lock.
+    """
+
+    _cache_dir: Path
+    """
+    The directory of the cached media and the index
+    """
+
+    _entries: "OrderedDict[str, _CacheEntry]"
+    """
+    The LRU index from the key to the entry, the most recently used media
+    is at the end
+    """
+
+    _hot: "OrderedDict[str, bytes]"
+    """
+    The LRU hot set from the key to the content
+    """
+
+    _pins: dict[str, int]
+    """
+    The mapping from the key of a pinned media to the number of its holders
+    """
+
+    _budget: int
+    """
+    The most bytes of the media on the disk
+    """
+
+    _hot_budget: int
+    """
+    The most bytes of the hot set
+    """
+
+    _hot_item_bytes: int
+    """
+    The largest media kept in the hot set
+    """
+
+    _hot_min_hits: int
+    """
+    The hits of a media before it is kept in the hot set
+    """
+
+    _bytes: int
+    """
+    The bytes of the media on the disk
+    """
+
+    _hot_bytes: int
+    """
+    The bytes of the hot set
+    """
+
+    _stats: MediaCacheStats
+    """
+    The statistics of the cache
+    """
+
+    _lock: threading.Lock
+    """
+    The lock of the index, the hot set and the statistics
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, cache_dir: Path, config: dict[str, Any]) -> None:
+        self._cache_dir = cache_dir
+        self._budget = config.get("media_cache_bytes", 512 * 1024 * 1024)
+        self._hot_budget = config.get("media_hot_bytes", 16 * 1024 * 1024)
+        self._hot_item_bytes = config.get("media_hot_item_bytes", 512 * 1024)
+        self._hot_min_hits = config.get("media_hot_min_hits", 2)
+        self._entries = OrderedDict()
+        self._hot = OrderedDict()
+        self._pins = {}
+        self._bytes = 0
+        self._hot_bytes = 0
+        self._stats = MediaCacheStats(
+            hits=0, hot_hits=0, misses=0, evictions=0, entries=0, bytes=0
+        )
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def stats(self) -> MediaCacheStats:
+        with self._lock:
+            stats = self._stats.copy()
+        stats["entries"] = len(self._entries)
+        stats["bytes"] = self._bytes
+
+        return stats
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        The ratio of the lookups served by the cache, 0 before any lookup.
+        """
+
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return self._stats["hits"] / lookups if lookups else 0.0
+
+    @property
+    def cache_dir(self) -> Path:
+        return self._cache_dir
+
+    def _path(self, key: str, entry: _CacheEntry) -> Path:
+        return self._cache_dir / (key + entry.suffix)
+
+    def _key_of(self, path: Path) -> Optional[str]:
+        if path.parent != self._cache_dir or path.stem not in self._entries:
+            return None
+
+        return path.stem
+
+    def load(self) -> None:
+        """
+        Restore the index saved by the last run. The media missing on the
+        disk are dropped from the index, the files not in the index (e.g.
+        left by a crash) are deleted.
+        """
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+        try:
+            records = json.loads((self._cache_dir / _INDEX_NAME).read_text())
+        except (OSError, ValueError):
+            records = []
+
+        entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        try:
+            for key, suffix, hits in records:
+                try:
+                    size = (self._cache_dir / (key + suffix)).stat().st_size
+                except OSError:
+                    continue
+                entries[key] = _CacheEntry(suffix, size, hits)
+        except (TypeError, ValueError):
+            self._logger.warning("The media cache index is corrupted, ignored")
+            entries.clear()
+
+        # The media cached after the index was saved (e.g. before a crash)
+        # are adopted as the most recently used ones, the other files
+        # (e.g. half-written copies) are deleted.
+        names = {key + entry.suffix for key, entry in entries.items()}
+        orphans = []
+        for path in self._cache_dir.iterdir():
+            if path.name == _INDEX_NAME or path.name in names:
+                continue
+            if _KEY_NAME.match(path.stem) and path.suffix != ".tmp":
+                stat = path.stat()
+                orphans.append((stat.st_mtime, path.stem, path.suffix, stat.st_size))
+            else:
+                path.unlink(missing_ok=True)
+
+        for _, key, suffix, size in sorted(orphans):
+            if key in entries:
+                (self._cache_dir / (key + suffix)).unlink(missing_ok=True)
+                continue
+            entries[key] = _CacheEntry(suffix, size)
+
+        with self._lock:
+            self._entries = entries
+            self._bytes = sum(entry.size for entry in entries.values())
+            self._evict()
+
+        self._logger.debug("Restored %d media from the cache", len(entries))
+
+    def save(self) -> None:
+        """
+        Save the index, from the least recently used media to the most
+        recently used one.
+        """
+
+        with self._lock:
+            records = [
+                (key, entry.suffix, entry.hits) for key, entry in self._entries.items()
+            ]
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._cache_dir / _INDEX_NAME
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(records))
+        os.replace(tmp_path, path)
+
+    def lookup(self, key: str, pin: bool = False) -> Optional[Path]:
+        """
+        Get the path of the cached media, None if it is not cached. With
+        `pin`, the media is also pinned.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+
+            path = self._path(key, entry)
+            if not path.exists():
+                self._remove(key)
+                self._stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            self._stats["hits"] += 1
+            if pin:
+                self._pins[key] = self._pins.get(key, 0) + 1
+
+            if key in self._hot:
+                self._hot.move_to_end(key)
+                self._stats["hot_hits"] += 1
+            elif entry.hits >= self._hot_min_hits and entry.size <= self._hot_item_bytes:
+                self._promote(key, path)
+
+        return path
+
+    def pin(self, key: str) -> Optional[Path]:
+        """
+        Pin the cached media, so it is not evicted until it is unpinned, and
+        get its path. None if it is not cached (anymore).
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            self._pins[key] = self._pins.get(key, 0) + 1
+            return self._path(key, entry)
+
+    def unpin(self, path: Path) -> None:
+        """
+        Release a pin of the cached media. The media evictable again are
+        evicted if the cache is over its budget.
+        """
+
+        if path.parent != self._cache_dir:
+            return
+
+        with self._lock:
+            holders = self._pins.get(path.stem)
+            if holders is None:
+                return
+
+            if holders > 1:
+                self._pins[path.stem] = holders - 1
+            else:
+                del self._pins[path.stem]
+                self._evict()
+
+    def open(self, path: Path) -> BinaryIO:
+        """
+        Open the media for reading, from the hot set if it is there.
+        """
+
+        content = self.read_hot(path)
+        if content is not None:
+            return io.BytesIO(content)
+
+        return open(path, "rb")
+
+    def read_hot(self, path: Path) -> Optional[bytes]:
+        """
+        Get the content of the media from the hot set, None if it is not
+        a hot media.
+        """
+
+        with self._lock:
+            key = self._key_of(path)
+            return None if key is None else self._hot.get(key)
+
+    def put(self, key: str, path: Path, suffix: Optional[str] = None) -> Path:
+        """
+        Move a downloaded media into the cache and return its new path. The
+        suffix of the cached file is the one of `path` by default.
+        """
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = _CacheEntry(
+            path.suffix if suffix is None else suffix, path.stat().st_size
+        )
+
+        with self._lock:
+            old_entry = self._entries.get(key)
+            if old_entry is not None and old_entry.suffix != entry.suffix:
+                self._path(key, old_entry).unlink(missing_ok=True)
+            self._remove(key)
+            cached_path = self._path(key, entry)
+            os.replace(path, cached_path)
+            self._add(key, entry)
+
+        return cached_path
+
+    def add_file(self, path: Path) -> Path:
+        """
+        Copy a local media (e.g. a sticker sent to QQ) into the cache under
+        the MD5 of its content, and return the cached path. If the media is
+        already cached, only its recency is updated.
+        """
+
+        if path.parent == self._cache_dir:
+            with self._lock:
+                if path.stem in self._entries:
+                    self._entries.move_to_end(path.stem)
+                    return path
+
+        key = file_md5(path)
+        cached_path = self.lookup(key)
+        if cached_path is not None:
+            return cached_path
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp_name)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+        return self.put(key, Path(tmp_name), path.suffix)
+
+    def _add(self, key: str, entry: _CacheEntry) -> None:
+        self._entries[key] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def _evict(self) -> None:
+        # Evict the least recently used media, but always keep the pinned
+        # media and the media just added, even if they exceed the budget.
+        if self._bytes <= self._budget:
+            return
+
+        for key in list(self._entries)[:-1]:
+            if self._bytes <= self._budget:
+                break
+            if key in self._pins:
+                continue
+
+            path = self._path(key, self._entries[key])
+            self._remove(key)
+            path.unlink(missing_ok=True)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+        content = self._hot.pop(key, None)
+        if content is not None:
+            self._hot_bytes -= len(content)
+
+    def _promote(self, key: str, path: Path) -> None:
+        try:
+            content = path.read_bytes()
+        except OSError:
+            return
+
+        self._hot[key] = content
+        self._hot_bytes += len(content)
+        while self._hot_bytes > self._hot_budget and self._hot:
+            _, evicted = self._hot.popitem(last=False)
+            self._hot_bytes -= len(evicted)
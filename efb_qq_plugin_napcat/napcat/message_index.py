@@ -0,0 +1,369 @@
+"""
+Index between the QQ message ids and the EFB message uids
+"""
+
+import collections
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, TypedDict
+
+
+class MessageRecord:
+    """
+    A message known to the index.
+    """
+
+    __slots__ = ("efb_uid", "qq_id", "chat_uid", "author_uid", "created_at")
+
+    efb_uid: str
+    """
+    The uid of the message in EFB
+    """
+
+    qq_id: str
+    """
+    The id of the message in QQ, or the outbox uid (e.g. "outbox_42") while
+    it is buffered in the outbox
+    """
+
+    chat_uid: str
+    """
+    The uid of the EFB chat of the message
+    """
+
+    author_uid: str
+    """
+    The uid of the EFB chat member who sent the message
+    """
+
+    created_at: float
+    """
+    The time the message is recorded
+    """
+
+    def __init__(
+        self, efb_uid: str, qq_id: str, chat_uid: str, author_uid: str, created_at: float
+    ) -> None:
+        self.efb_uid = efb_uid
+        self.qq_id = qq_id
+        self.chat_uid = chat_uid
+        self.author_uid = author_uid
+        self.created_at = created_at
+
+
+class MessageIndexStats(TypedDict):
+    hits: int
+    """
+    The number of lookups answered by the memory
+    """
+
+    disk_hits: int
+    """
+    The number of lookups answered by the database
+    """
+
+    misses: int
+    """
+    The number of lookups of unknown messages
+    """
+
+    recorded: int
+    """
+    The number of messages recorded
+    """
+
+    pruned: int
+    """
+    The number of messages removed by the retention
+    """
+
+
+class NapCatMessageIndex:
+    """
+    The NapCatMessageIndex maps the QQ message ids to the EFB message uids
+    and back, with the chat and the author of the message, so the replies,
+    the recalls and the edits do not call "get_msg" of NapCat:
+
+    1. The recent `message_index_memory` messages are kept in memory (LRU),
+       a lookup of them takes microseconds.
+    2. All the messages are kept in a SQLite database in the WAL mode, so
+       they survive a restart of EFB. The writes are committed in batches.
+    3. The messages older than `message_index_retention` seconds, or beyond
+       the newest `message_index_max_records`, are removed, so a busy group
+       does not fill the disk.
+
+    Without a path, the database is only kept in memory. It is used from
+    the EFB threads and the event loop thread, so it is guarded by a lock.
+    """
+
+    _COMMIT_EVERY = 64
+    """
+    The number of writes committed together
+    """
+
+    _PRUNE_EVERY = 4096
+    """
+    The number of messages recorded between two prunes
+    """
+
+    _db: sqlite3.Connection
+    """
+    The database of the index
+    """
+
+    _by_efb_uid: "collections.OrderedDict[str, MessageRecord]"
+    """
+    The recent messages by the EFB uid, the least recently used first
+    """
+
+    _by_qq_id: "collections.OrderedDict[str, MessageRecord]"
+    """
+    The recent messages by the QQ id, the least recently used first
+    """
+
+    _memory: int
+    """
+    The most messages kept in memory
+    """
+
+    _retention: float
+    """
+    The seconds a message is kept
+    """
+
+    _max_records: int
+    """
+    The most messages kept in the database
+    """
+
+    _uncommitted: int
+    """
+    The number of writes not committed yet
+    """
+
+    _since_prune: int
+    """
+    The number of messages recorded since the last prune
+    """
+
+    _stats: MessageIndexStats
+    """
+    The statistics of the index
+    """
+
+    _lock: threading.Lock
+    """
+    The lock of the database and the memory
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, path: Optional[Path], config: dict[str, Any]) -> None:
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(
+            ":memory:" if path is None else str(path), check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "efb_uid TEXT PRIMARY KEY, "
+            "qq_id TEXT NOT NULL, "
+            "chat_uid TEXT NOT NULL, "
+            "author_uid TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_qq_id ON messages (qq_id)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at)"
+        )
+        self._db.commit()
+
+        self._by_efb_uid = collections.OrderedDict()
+        self._by_qq_id = collections.OrderedDict()
+        self._memory = config.get("message_index_memory", 10000)
+        self._retention = config.get("message_index_retention", 7 * 24 * 3600)
+        self._max_records = config.get("message_index_max_records", 200000)
+        self._uncommitted = 0
+        self._since_prune = 0
+        self._stats = MessageIndexStats(
+            hits=0, disk_hits=0, misses=0, recorded=0, pruned=0
+        )
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+        with self._lock:
+            self._prune()
+
+    @property
+    def stats(self) -> MessageIndexStats:
+        with self._lock:
+            return self._stats.copy()
+
+    def record(
+        self,
+        efb_uid: str,
+        qq_id: str,
+        chat_uid: str,
+        author_uid: str,
+        created_at: Optional[float] = None,
+    ) -> MessageRecord:
+        """
+        Record a message, it replaces the message with the same EFB uid (e.g.
+        an edited message sent to QQ again).
+        """
+
+        record = MessageRecord(
+            efb_uid,
+            qq_id,
+            chat_uid,
+            author_uid,
+            time.time() if created_at is None else created_at,
+        )
+
+        with self._lock:
+            old = self._by_efb_uid.pop(efb_uid, None)
+            if old is not None and self._by_qq_id.get(old.qq_id) is old:
+                del self._by_qq_id[old.qq_id]
+            self._remember(record)
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO messages "
+                "(efb_uid, qq_id, chat_uid, author_uid, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (efb_uid, qq_id, chat_uid, author_uid, record.created_at),
+            )
+            self._stats["recorded"] += 1
+            self._written()
+
+            self._since_prune += 1
+            if self._since_prune >= self._PRUNE_EVERY:
+                self._prune()
+
+        return record
+
+    def _remember(self, record: MessageRecord) -> None:
+        self._by_efb_uid[record.efb_uid] = record
+        self._by_efb_uid.move_to_end(record.efb_uid)
+        if record.qq_id:
+            self._by_qq_id[record.qq_id] = record
+            self._by_qq_id.move_to_end(record.qq_id)
+
+        while len(self._by_efb_uid) > self._memory:
+            self._by_efb_uid.popitem(last=False)
+        while len(self._by_qq_id) > self._memory:
+            self._by_qq_id.popitem(last=False)
+
+    def _written(self) -> None:
+        self._uncommitted += 1
+        if self._uncommitted >= self._COMMIT_EVERY:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def by_efb_uid(self, efb_uid: str) -> Optional[MessageRecord]:
+        return self._lookup(self._by_efb_uid, "efb_uid", efb_uid)
+
+    def by_qq_id(self, qq_id: str) -> Optional[MessageRecord]:
+        return self._lookup(self._by_qq_id, "qq_id", qq_id)
+
+    def _lookup(
+        self,
+        memory: "collections.OrderedDict[str, MessageRecord]",
+        column: str,
+        key: str,
+    ) -> Optional[MessageRecord]:
+        with self._lock:
+            record = memory.get(key)
+            if record is not None:
+                memory.move_to_end(key)
+                self._stats["hits"] += 1
+                return record
+
+            row = self._db.execute(
+                "SELECT efb_uid, qq_id, chat_uid, author_uid, created_at FROM messages "
+                f"WHERE {column} = ? ORDER BY created_at DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+            if row is None or row[4] < time.time() - self._retention:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["disk_hits"] += 1
+            record = MessageRecord(*row)
+            self._remember(record)
+
+            return record
+
+    def resolve_qq_id(self, efb_uid: str) -> Optional[str]:
+        """
+        Get the QQ id of the message sent to EFB or from EFB, by its EFB uid.
+        Not indexed EFB uids made of digits are taken as the QQ ids.
+        """
+
+        record = self.by_efb_uid(efb_uid)
+        if record is not None:
+            return record.qq_id
+
+        return efb_uid if efb_uid.isdigit() else None
+
+    def reassign_qq_id(self, old_qq_id: str, qq_id: str) -> Optional[MessageRecord]:
+        """
+        Change the QQ id of a recorded message, e.g. a message buffered in the
+        outbox as "outbox_42" is sent at last.
+        """
+
+        record = self.by_qq_id(old_qq_id)
+        if record is None:
+            return None
+
+        return self.record(
+            record.efb_uid, qq_id, record.chat_uid, record.author_uid, record.created_at
+        )
+
+    def _prune(self) -> None:
+        self._since_prune = 0
+        removed = self._db.execute(
+            "DELETE FROM messages WHERE created_at < ?",
+            (time.time() - self._retention,),
+        ).rowcount
+        removed += self._db.execute(
+            "DELETE FROM messages WHERE efb_uid IN ("
+            "SELECT efb_uid FROM messages ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self._max_records,),
+        ).rowcount
+        self._db.commit()
+        self._uncommitted = 0
+
+        if removed:
+            self._stats["pruned"] += removed
+            self._logger.debug("Pruned %d messages from the message index", removed)
+
+    def prune(self) -> None:
+        """
+        Remove the messages beyond the retention now.
+        """
+
+        with self._lock:
+            self._prune()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
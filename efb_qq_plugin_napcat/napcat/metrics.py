@@ -0,0 +1,527 @@
+"""
+Metrics and tracing of napcat
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, TypedDict, TypeVar
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatAPIFailureException
+
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""
+The upper bounds of the latency histograms in seconds, the ones of the
+Prometheus clients
+"""
+
+ErrorLabels = tuple[str, str, str]
+"""
+The labels of an error: the exception class, the HTTP status code and the
+OneBot return code, the codes are empty when they are unknown
+"""
+
+
+def error_labels(exception: BaseException) -> ErrorLabels:
+    if isinstance(exception, NapCatAPIFailureException):
+        status_code = exception.status_code
+        ret_code = exception.ret_code
+        return (
+            type(exception).__name__,
+            "" if status_code is None else str(status_code),
+            "" if ret_code is None else str(ret_code),
+        )
+
+    return type(exception).__name__, "", ""
+
+
+class MetricsSink:
+    """
+    The MetricsSink receives the measurements of NapCatBot and the
+    managers. The methods of this base class do nothing, a sink overrides
+    the ones it is interested in. The sink of NapCatBot can be replaced by
+    `NapCatBot.metrics`, e.g. to export the metrics to another system.
+
+    The methods are called in the event loop and should return at once.
+    """
+
+    def action_started(self, action: str) -> Any:
+        """
+        Called before an action is sent to NapCat. The return value is
+        passed to `action_finished`, e.g. a tracing span.
+        """
+
+        return None
+
+    def action_finished(
+        self,
+        action: str,
+        token: Any,
+        seconds: float,
+        exception: Optional[BaseException],
+    ) -> None:
+        """
+        Called after an action returns or raises.
+        """
+
+    def operation_finished(
+        self, operation: str, seconds: float, exception: Optional[BaseException]
+    ) -> None:
+        """
+        Called after an operation of the managers, e.g. updating the friend
+        list, returns or raises.
+        """
+
+    def cache_lookup(self, cache: str, hit: bool) -> None:
+        """
+        Called after a lookup in a cache, e.g. the friend remarks.
+        """
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    buckets: tuple[float, ...]
+    counts: list[int]
+    count: int
+    sum: float
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list[int]:
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+
+        return result
+
+
+class HistogramSnapshot(TypedDict):
+    count: int
+    sum: float
+    buckets: dict[float, int]
+    """
+    The mapping from the upper bound to the cumulative count
+    """
+
+
+class MetricsSnapshot(TypedDict):
+    actions: dict[str, HistogramSnapshot]
+    """
+    The latency of every action
+    """
+
+    operations: dict[str, HistogramSnapshot]
+    """
+    The latency of every operation of the managers
+    """
+
+    errors: dict[str, dict[ErrorLabels, int]]
+    """
+    The mapping from the action or the operation to the error counts
+    """
+
+    in_flight: dict[str, int]
+    """
+    The actions sent to NapCat and not finished yet
+    """
+
+    cache_hits: dict[str, int]
+    """
+    The hits of every cache
+    """
+
+    cache_misses: dict[str, int]
+    """
+    The misses of every cache
+    """
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    The InMemoryMetrics aggregates the measurements in the process: the
+    latency histograms of the actions and the operations, the error counts
+    by the exception class (and the codes of NapCatAPIFailureException),
+    the in-flight actions and the cache hits and misses.
+
+    `snapshot` returns a copy of the metrics, `prometheus_text` renders
+    them in the Prometheus text exposition format.
+    """
+
+    _buckets: tuple[float, ...]
+    """
+    The upper bounds of the histograms
+    """
+
+    _actions: dict[str, Histogram]
+    """
+    The latency histogram of every action
+    """
+
+    _operations: dict[str, Histogram]
+    """
+    The latency histogram of every operation
+    """
+
+    _errors: dict[str, dict[ErrorLabels, int]]
+    """
+    The error counts of every action or operation
+    """
+
+    _in_flight: dict[str, int]
+    """
+    The in-flight calls of every action
+    """
+
+    _cache_hits: dict[str, int]
+    """
+    The hits of every cache
+    """
+
+    _cache_misses: dict[str, int]
+    """
+    The misses of every cache
+    """
+
+    _lock: threading.Lock
+    """
+    The lock of the metrics, they are read from other threads
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self._buckets = tuple(sorted(buckets))
+        self._actions = {}
+        self._operations = {}
+        self._errors = {}
+        self._in_flight = {}
+        self._cache_hits = {}
+        self._cache_misses = {}
+        self._lock = threading.Lock()
+
+    def action_started(self, action: str) -> Any:
+        with self._lock:
+            self._in_flight[action] = self._in_flight.get(action, 0) + 1
+
+        return None
+
+    def action_finished(
+        self,
+        action: str,
+        token: Any,
+        seconds: float,
+        exception: Optional[BaseException],
+    ) -> None:
+        with self._lock:
+            self._in_flight[action] -= 1
+            self._observe(self._actions, action, seconds, exception)
+
+    def operation_finished(
+        self, operation: str, seconds: float, exception: Optional[BaseException]
+    ) -> None:
+        with self._lock:
+            self._observe(self._operations, operation, seconds, exception)
+
+    def cache_lookup(self, cache: str, hit: bool) -> None:
+        counts = self._cache_hits if hit else self._cache_misses
+        with self._lock:
+            counts[cache] = counts.get(cache, 0) + 1
+
+    def _observe(
+        self,
+        histograms: dict[str, Histogram],
+        name: str,
+        seconds: float,
+        exception: Optional[BaseException],
+    ) -> None:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(self._buckets)
+        histogram.observe(seconds)
+
+        if exception is not None:
+            errors = self._errors.setdefault(name, {})
+            labels = error_labels(exception)
+            errors[labels] = errors.get(labels, 0) + 1
+
+    def cache_hit_rate(self, cache: str) -> float:
+        """
+        The ratio of the lookups of a cache served by the cache, 0 before
+        any lookup.
+        """
+
+        with self._lock:
+            hits = self._cache_hits.get(cache, 0)
+            lookups = hits + self._cache_misses.get(cache, 0)
+
+        return hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def _histogram_snapshot(histogram: Histogram) -> HistogramSnapshot:
+        return HistogramSnapshot(
+            count=histogram.count,
+            sum=histogram.sum,
+            buckets=dict(zip(histogram.buckets, histogram.cumulative_counts())),
+        )
+
+    def snapshot(self) -> MetricsSnapshot:
+        with self._lock:
+            return MetricsSnapshot(
+                actions={
+                    name: self._histogram_snapshot(histogram)
+                    for name, histogram in self._actions.items()
+                },
+                operations={
+                    name: self._histogram_snapshot(histogram)
+                    for name, histogram in self._operations.items()
+                },
+                errors={name: dict(errors) for name, errors in self._errors.items()},
+                in_flight=dict(self._in_flight),
+                cache_hits=dict(self._cache_hits),
+                cache_misses=dict(self._cache_misses),
+            )
+
+    def prometheus_text(self) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+
+        snapshot = self.snapshot()
+        lines: list[str] = []
+
+        for family, label, histograms in (
+            ("napcat_action_seconds", "action", snapshot["actions"]),
+            ("napcat_operation_seconds", "operation", snapshot["operations"]),
+        ):
+            lines.append(f"# TYPE {family} histogram")
+            for name, histogram in sorted(histograms.items()):
+                labels = f'{label}="{_escape(name)}"'
+                for bound, count in histogram["buckets"].items():
+                    lines.append(f'{family}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(
+                    f'{family}_bucket{{{labels},le="+Inf"}} {histogram["count"]}'
+                )
+                lines.append(f"{family}_sum{{{labels}}} {histogram['sum']}")
+                lines.append(f"{family}_count{{{labels}}} {histogram['count']}")
+
+        lines.append("# TYPE napcat_errors_total counter")
+        for name, errors in sorted(snapshot["errors"].items()):
+            for (error, status_code, ret_code), count in sorted(errors.items()):
+                lines.append(
+                    f'napcat_errors_total{{name="{_escape(name)}",error="{error}",'
+                    f'status_code="{status_code}",retcode="{ret_code}"}} {count}'
+                )
+
+        lines.append("# TYPE napcat_action_in_flight gauge")
+        for name, count in sorted(snapshot["in_flight"].items()):
+            lines.append(f'napcat_action_in_flight{{action="{_escape(name)}"}} {count}')
+
+        lines.append("# TYPE napcat_cache_requests_total counter")
+        for result, counts in (
+            ("hit", snapshot["cache_hits"]),
+            ("miss", snapshot["cache_misses"]),
+        ):
+            for name, count in sorted(counts.items()):
+                lines.append(
+                    f'napcat_cache_requests_total{{cache="{_escape(name)}",'
+                    f'result="{result}"}} {count}'
+                )
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class OpenTelemetrySink(MetricsSink):
+    """
+    The OpenTelemetrySink traces every action as an OpenTelemetry span.
+    The "opentelemetry-api" package is an optional dependency, the spans
+    are exported by the SDK configured by the application.
+    """
+
+    _tracer: Any
+    """
+    The OpenTelemetry tracer
+    """
+
+    def __init__(self) -> None:
+        from opentelemetry import trace
+
+        self._tracer = trace.get_tracer(__name__)
+
+    def action_started(self, action: str) -> Any:
+        span = self._tracer.start_span(f"napcat {action}")
+        span.set_attribute("napcat.action", action)
+
+        return span
+
+    def action_finished(
+        self,
+        action: str,
+        token: Any,
+        seconds: float,
+        exception: Optional[BaseException],
+    ) -> None:
+        if exception is not None:
+            from opentelemetry.trace import Status, StatusCode
+
+            token.record_exception(exception)
+            token.set_status(Status(StatusCode.ERROR, repr(exception)))
+        token.end()
+
+
+class CompositeSink(MetricsSink):
+    """
+    The CompositeSink passes the measurements to several sinks.
+    """
+
+    _sinks: list[MetricsSink]
+    """
+    The sinks receiving the measurements
+    """
+
+    def __init__(self, sinks: list[MetricsSink]) -> None:
+        self._sinks = sinks
+
+    @property
+    def sinks(self) -> list[MetricsSink]:
+        return self._sinks
+
+    def action_started(self, action: str) -> Any:
+        return [sink.action_started(action) for sink in self._sinks]
+
+    def action_finished(
+        self,
+        action: str,
+        token: Any,
+        seconds: float,
+        exception: Optional[BaseException],
+    ) -> None:
+        for sink, sink_token in zip(self._sinks, token):
+            sink.action_finished(action, sink_token, seconds, exception)
+
+    def operation_finished(
+        self, operation: str, seconds: float, exception: Optional[BaseException]
+    ) -> None:
+        for sink in self._sinks:
+            sink.operation_finished(operation, seconds, exception)
+
+    def cache_lookup(self, cache: str, hit: bool) -> None:
+        for sink in self._sinks:
+            sink.cache_lookup(cache, hit)
+
+
+def create_metrics_sink(config: dict[str, Any]) -> Optional[MetricsSink]:
+    """
+    Create the sink configured by `metrics` (the in-process metrics) and
+    `metrics_opentelemetry` (the OpenTelemetry spans). None means the
+    instrumentation is disabled.
+    """
+
+    sinks: list[MetricsSink] = []
+    if config.get("metrics", False):
+        sinks.append(InMemoryMetrics())
+
+    if config.get("metrics_opentelemetry", False):
+        try:
+            sinks.append(OpenTelemetrySink())
+        except ImportError:
+            logging.getLogger(__name__).warning(
+                "The opentelemetry-api package is not installed, spans are disabled"
+            )
+
+    if not sinks:
+        return None
+
+    return sinks[0] if len(sinks) == 1 else CompositeSink(sinks)
+
+
+def instrumented(
+    operation: str,
+) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Measure an async method as an operation. The instance should have a
+    `metrics` property, the method is called directly when it is None.
+    """
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(self: Any, *args: Any, **kwargs: Any) -> T:
+            metrics: Optional[MetricsSink] = self.metrics
+            if metrics is None:
+                return await func(self, *args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                result = await func(self, *args, **kwargs)
+            except BaseException as e:
+                metrics.operation_finished(operation, time.perf_counter() - start, e)
+                raise
+            metrics.operation_finished(operation, time.perf_counter() - start, None)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def find_in_memory_metrics(sink: Optional[MetricsSink]) -> Optional[InMemoryMetrics]:
+    if isinstance(sink, InMemoryMetrics):
+        return sink
+
+    if isinstance(sink, CompositeSink):
+        for child in sink.sinks:
+            if isinstance(child, InMemoryMetrics):
+                return child
+
+    return None
+
+
+async def serve_prometheus(
+    metrics: InMemoryMetrics, host: str, port: int
+) -> asyncio.AbstractServer:
+    """
+    Serve the metrics in the Prometheus text exposition format over HTTP,
+    every path returns the metrics. It runs in the event loop of the
+    NapCat client, so no extra thread or dependency is needed.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # The request itself does not matter, every path is the metrics
+            await reader.readuntil(b"\r\n\r\n")
+            body = metrics.prometheus_text().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
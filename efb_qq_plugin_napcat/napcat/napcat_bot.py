@@ -1,9 +1,16 @@
 import asyncio
 import logging
-from typing import Any, TypedDict
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, TypedDict
 
 import aiocqhttp
+import httpx
 
+from efb_qq_plugin_napcat.napcat.dispatcher import (
+    ActionDispatchStats,
+    NapCatActionDispatcher,
+    is_read_only_action,
+)
 from efb_qq_plugin_napcat.napcat.exceptions import (
     NapCatAPIFailureException,
     NapCatDisconnectedException,
@@ -11,6 +18,21 @@ from efb_qq_plugin_napcat.napcat.exceptions import (
     NapCatOfflineException,
     NapCatUnknownException,
 )
+from efb_qq_plugin_napcat.napcat.health import NapCatHealthMonitor
+from efb_qq_plugin_napcat.napcat.http_api import NapCatHttpApi
+from efb_qq_plugin_napcat.napcat.json_decoder import NapCatJsonDecoder
+from efb_qq_plugin_napcat.napcat.metrics import MetricsSink, create_metrics_sink
+from efb_qq_plugin_napcat.napcat.outbox import NapCatOutbox, OutboxEntry
+from efb_qq_plugin_napcat.napcat.retry import (
+    CircuitBreaker,
+    RetryPolicies,
+    RetryStats,
+    is_unreachable,
+)
+
+if TYPE_CHECKING:
+    from efb_qq_plugin_napcat.napcat.runtime import NapCatRuntime
+    from efb_qq_plugin_napcat.napcat.ws_api import NapCatWebSocketApi
 
 
 class _GetStatusRequest(TypedDict):
@@ -28,17 +50,36 @@ class NapCatBot:
     It provides the following functionalities:
 
     1. Check the status of the NapCat client.
-    2. Check the status of the NapCat client periodically.
-    3. Call actions of the NapCat client (generic).
+    2. Check the status of the NapCat client adaptively: successful actions
+       count as liveness, and a client down is probed again with backoff.
+    3. Call actions of the NapCat client (generic). Identical read-only calls
+       in flight are merged and the concurrency of each action is limited.
+    4. Receive events of the NapCat client when the transport is a forward
+       ("ws") or reverse ("ws_reverse") WebSocket.
+    5. With an outbox, buffer the actions changing the state (e.g. "send_msg")
+       while the NapCat client is offline, and replay them in order when it
+       is up again. The read-only actions still fail fast.
+    6. Retry the failed actions by their retry policies, and fail fast with a
+       circuit breaker while the NapCat client cannot be reached.
 
     The caller should create a new class which contains the NapCatBot instance
     and provide more high-level functionalities.
     """
 
-    _qq_bot: aiocqhttp.CQHttp
+    _qq_api: "NapCatHttpApi | NapCatWebSocketApi"
+    """
+    The api instance to call the actions of the NapCat client
+    """
 
+    _http_api: NapCatHttpApi
     """
-    The coolq bot instance
+    The HTTP api instance, it is `_qq_api` with the HTTP transport. Its
+    keep-alive client is also used to transfer the media.
+    """
+
+    _decoder: NapCatJsonDecoder
+    """
+    The JSON decoder shared by the transports
     """
 
     _logged_in: bool
@@ -61,22 +102,92 @@ class NapCatBot:
     The logger instance
     """
 
-    _check_status_interval: int
+    _health: NapCatHealthMonitor
     """
-    The interval to check the status of the NapCat client
+    The monitor deciding when to check the status of the NapCat client
     """
 
-    def __init__(self, config: dict[str, Any]) -> None:
-        self._qq_bot = aiocqhttp.CQHttp(
-            api_root=config["api_root"],
-            access_token=config["access_token"],
-            api_timeout_sec=config["api_timeout"],
-        )
+    _dispatcher: NapCatActionDispatcher
+    """
+    The dispatcher to merge and limit the calls of actions
+    """
+
+    _outbox: Optional[NapCatOutbox]
+    """
+    The outbox buffering the actions while the NapCat client is offline
+    """
+
+    _replay_task: Optional["asyncio.Task[None]"]
+    """
+    The running replay of the outbox
+    """
+
+    _metrics: Optional[MetricsSink]
+    """
+    The sink of the metrics, None if the instrumentation is disabled
+    """
+
+    _retry_policies: RetryPolicies
+    """
+    The retry policies of the actions
+    """
+
+    _retry_stats: RetryStats
+    """
+    The statistics of the retries and the circuit breaker
+    """
+
+    _breaker: CircuitBreaker
+    """
+    The circuit breaker failing the actions fast while NapCat is unreachable
+    """
+
+    _event_handlers: list[Callable[[dict[str, Any]], Awaitable[None]]]
+    """
+    The handlers called for every event of the NapCat client
+    """
+
+    _replay_handlers: list[Callable[[OutboxEntry, Any], None]]
+    """
+    The handlers called for every action replayed from the outbox
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        outbox: Optional[NapCatOutbox] = None,
+        runtime: Optional["NapCatRuntime"] = None,
+        account: str = "",
+    ) -> None:
+        # With a runtime shared by several accounts, the HTTP connections are
+        # pooled with the other accounts, the rest of the bot is per account.
+        self._decoder = NapCatJsonDecoder(config)
+        self._http_api = NapCatHttpApi(config, runtime, account, self._decoder)
+
+        transport = config.get("transport", "http")
+        if transport == "http":
+            self._qq_api = self._http_api
+        else:
+            # Only import the WebSocket transport when it is used, the
+            # "websockets" package is an optional dependency.
+            from efb_qq_plugin_napcat.napcat.ws_api import NapCatWebSocketApi
+
+            self._qq_api = NapCatWebSocketApi(config, self._handle_event, self._decoder)
+
+        self._event_handlers = []
+        self._replay_handlers = []
         self._logged_in = False
         self._connected = False
         self._repeat_num = 0
         self._logger = logging.getLogger(__name__)
-        self._check_status_interval = 300
+        self._health = NapCatHealthMonitor(config)
+        self._outbox = outbox
+        self._replay_task = None
+        self._metrics = create_metrics_sink(config)
+        self._dispatcher = NapCatActionDispatcher(config)
+        self._retry_policies = RetryPolicies(config)
+        self._retry_stats = RetryStats(retries=0, circuit_opened=0, circuit_rejected=0)
+        self._breaker = CircuitBreaker(config, self._retry_stats)
 
     def is_logged_in(self) -> bool:
         return self._logged_in
@@ -84,10 +195,124 @@ class NapCatBot:
     def is_connected(self) -> bool:
         return self._connected
 
+    @property
+    def health(self) -> NapCatHealthMonitor:
+        """
+        The health monitor, which holds the state transitions.
+        """
+
+        return self._health
+
+    @property
+    def metrics(self) -> Optional[MetricsSink]:
+        """
+        The sink of the metrics of the bot and the managers using it.
+        """
+
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, sink: Optional[MetricsSink]) -> None:
+        self._metrics = sink
+
+    @property
+    def outbox(self) -> Optional[NapCatOutbox]:
+        return self._outbox
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """
+        The shared HTTP client of the running event loop.
+        """
+
+        return self._http_api.client
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        return self._breaker
+
+    @property
+    def retry_stats(self) -> RetryStats:
+        return self._retry_stats.copy()
+
+    def dispatch_stats(self) -> dict[str, ActionDispatchStats]:
+        """
+        Get the statistics of the dispatched actions, which include how
+        many calls were merged and how long calls waited in the queue.
+        """
+
+        return self._dispatcher.stats
+
+    @property
+    def json_decoder(self) -> NapCatJsonDecoder:
+        return self._decoder
+
+    def register_response_type(self, action: str, schema: Any) -> None:
+        """
+        Register the schema of the "data" of the responses of a hot action.
+        With msgspec, the responses are decoded into it, the fields not in
+        the schema are skipped.
+        """
+
+        self._decoder.register(action, schema)
+
+    def limit_action_concurrency(self, action: str, limit: int) -> None:
+        """
+        Limit the calls of an action in flight, by default. The limit in
+        `action_concurrency` takes precedence.
+        """
+
+        self._dispatcher.set_default_concurrency(action, limit)
+
+    def on_event(self, handler: Callable[[dict[str, Any]], Awaitable[None]]) -> None:
+        """
+        Register a handler called for every event of the NapCat client.
+        """
+
+        self._event_handlers.append(handler)
+
+    def on_replayed(self, handler: Callable[[OutboxEntry, Any], None]) -> None:
+        """
+        Register a handler called with the entry and the response of every
+        action replayed from the outbox successfully.
+        """
+
+        self._replay_handlers.append(handler)
+
+    async def _handle_event(self, event: dict[str, Any]) -> None:
+        self._logger.debug(
+            "Received the %s event of the NapCat client", event.get("post_type")
+        )
+
+        for handler in self._event_handlers:
+            await handler(event)
+
+    async def start(self) -> None:
+        """
+        Start the connections to the NapCat client. It should be called in
+        the event loop of the NapCat client.
+        """
+
+        await self._qq_api.start()
+
+    async def close(self) -> None:
+        """
+        Close the connections to the NapCat client. It should be called in
+        the event loop of the NapCat client.
+        """
+
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            await asyncio.gather(self._replay_task, return_exceptions=True)
+
+        await self._qq_api.close()
+        if self._http_api is not self._qq_api:
+            await self._http_api.close()
+
     async def _call_action_wrapper(self, action_name: str, **kwargs: Any) -> Any:
         """
         Wrapper for calling actions. This method will handle the exceptions raised
-        by the aiocqhttp client. It will raise the following exceptions:
+        by the aiocqhttp api. It will raise the following exceptions:
 
         1. NapCatDisconnectedException: The NapCat client is disconnected.
         2. NapCatAPIFailureException: The NapCat HTTP API fails.
@@ -97,11 +322,80 @@ class NapCatBot:
 
         Caller should never call this method directly, instead, they should call
         `call_action` method.
+
+        The action is retried by its retry policy, and NapCatCircuitOpenException
+        (a NapCatDisconnectedException) is raised at once while the circuit
+        breaker is open. With a metrics sink, the latency (including the
+        retries), the in-flight calls and the errors of the action are recorded.
         """
 
+        return await self._call_instrumented(action_name, kwargs, False)
+
+    async def _call_instrumented(
+        self, action_name: str, kwargs: dict[str, Any], probe: bool
+    ) -> Any:
+        metrics = self._metrics
+        if metrics is None:
+            return await self._call_with_retry(action_name, kwargs, probe)
+
+        token = metrics.action_started(action_name)
+        start = time.perf_counter()
         try:
-            res = await self._qq_bot.call_action(action_name, **kwargs)  # type: ignore
+            res = await self._call_with_retry(action_name, kwargs, probe)
+        except BaseException as e:
+            metrics.action_finished(action_name, token, time.perf_counter() - start, e)
+            raise
+        metrics.action_finished(action_name, token, time.perf_counter() - start, None)
+
+        return res
+
+    async def _call_with_retry(
+        self, action_name: str, kwargs: dict[str, Any], probe: bool
+    ) -> Any:
+        """
+        Call the action through the circuit breaker and retry it by its retry
+        policy. A probe of the status bypasses the breaker and is not retried,
+        the health monitor has its own backoff, but its result still closes
+        or opens the breaker.
+        """
+
+        breaker = self._breaker
+        policy = self._retry_policies.get(action_name)
+        attempt = 1
+
+        while True:
+            if not probe:
+                breaker.before_call()
+
+            try:
+                res = await self._call_qq_api(action_name, kwargs)
+            except NapCatException as e:
+                if is_unreachable(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+
+                if probe or not policy.should_retry(action_name, e, attempt):
+                    raise
+                self._logger.debug(
+                    "Retrying %s (attempt %d failed: %r)", action_name, attempt, e
+                )
+            except BaseException:
+                breaker.record_abort()
+                raise
+            else:
+                breaker.record_success()
+                return res
+
+            self._retry_stats["retries"] += 1
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+
+    async def _call_qq_api(self, action_name: str, kwargs: dict[str, Any]) -> Any:
+        try:
+            res = await self._qq_api.call_action(action_name, **kwargs)
         except aiocqhttp.NetworkError as e:
+            self._health.record_unreachable()
             raise NapCatDisconnectedException(
                 f"Unable to connect to napcat client!. Error message: {e}"
             )
@@ -111,27 +405,95 @@ class NapCatBot:
 
             raise NapCatAPIFailureException(status_code, ret_code)
         else:
+            self._health.record_alive()
             return res
 
     async def call_action(self, action_name: str, **kwargs: Any) -> Any:
-        if self._logged_in and self._connected:
-            return await self._call_action_wrapper(action_name, **kwargs)
+        """
+        Call an action of the NapCat client. When the client is offline,
+        the read-only actions return None at once, the other actions are
+        buffered in the outbox if there is one, and a QueuedResponse is
+        returned. The actions are also buffered while the outbox is being
+        replayed, so they are called in order, and when the call finds the
+        client disconnected or the circuit breaker open.
+        """
+
+        buffered = self._outbox is not None and not is_read_only_action(action_name)
+        online = self._logged_in and self._connected
+
+        if online and not (buffered and len(self._outbox)):  # type: ignore[arg-type]
+            try:
+                return await self._dispatcher.dispatch(
+                    action_name, kwargs, self._call_action_wrapper
+                )
+            except NapCatDisconnectedException as e:
+                if not buffered:
+                    raise
+                # The health monitor replays the outbox once NapCat is back
+                self._status_bad_callback(e)
+                return self._outbox.push(action_name, kwargs)  # type: ignore[union-attr]
+
+        if buffered:
+            response = self._outbox.push(action_name, kwargs)  # type: ignore[union-attr]
+            if online:
+                self._start_replay()
+            return response
 
         if self._repeat_num < 3:
             # TODO: Send the failure information to the user
             self._repeat_num += 1
 
+    def _start_replay(self) -> None:
+        if self._outbox is None or not len(self._outbox):
+            return
+
+        if self._replay_task is None or self._replay_task.done():
+            self._replay_task = asyncio.ensure_future(self._replay_outbox())
+
+    async def _replay_outbox(self) -> None:
+        """
+        Replay the buffered actions in order, at most `outbox_replay_rate`
+        actions per second. An action rejected by NapCat is dropped, the
+        replay stops when the client is offline again.
+        """
+
+        outbox: NapCatOutbox = self._outbox  # type: ignore[assignment]
+        self._logger.info("Replaying %d actions from the outbox", len(outbox))
+
+        while self._connected and (entry := outbox.peek()) is not None:
+            start = time.perf_counter()
+            try:
+                res = await self._dispatcher.dispatch(
+                    entry["action"], entry["params"], self._call_action_wrapper
+                )
+            except NapCatDisconnectedException as e:
+                self._status_bad_callback(e)
+                return
+            except NapCatException as e:
+                self._logger.warning(
+                    f"Dropped {entry['action']} #{entry['outbox_id']} "
+                    f"from the outbox: {e!r}"
+                )
+                outbox.remove(entry["outbox_id"], replayed=False)
+            else:
+                outbox.remove(entry["outbox_id"], replayed=True)
+                for handler in self._replay_handlers:
+                    handler(entry, res)
+
+            await asyncio.sleep(outbox.replay_interval)
+            outbox.record_replay_time(time.perf_counter() - start)
+
     async def _get_status(self) -> _GetStatusResponse:
         """
-        Get the status of the NapCat client. In this function, we use
-        the `_call_action_wrapper` method to call the `get_status` action
-        of the NapCat client. We do not use the `call_action` method here,
+        Get the status of the NapCat client. In this function, we call the
+        `get_status` action of the NapCat client as a probe, which bypasses
+        the circuit breaker. We do not use the `call_action` method here,
         because `self._logged_in` and `self._connected` should not be checked
         in this function.
         """
 
         request = _GetStatusRequest()
-        res = await self._call_action_wrapper("get_status", **request)
+        res = await self._call_instrumented("get_status", dict(request), True)
 
         return res
 
@@ -155,19 +517,26 @@ class NapCatBot:
             # TODO: Send the failure information to the user
             self._repeat_num += 1
 
+        if self._connected:
+            self._logger.warning(f"The NapCat client is down: {exception!r}")
+
         self._connected = False
         self._logged_in = False
-        self._check_status_interval = 3600
+        self._health.mark_down(repr(exception))
 
     def _status_good_callback(self) -> None:
         """
         Callback function when the status of the NapCat client is good.
         """
 
+        if not self._connected:
+            self._logger.info("The NapCat client is up")
+
         self._connected = True
         self._logged_in = True
-        self._check_status_interval = 300
         self._repeat_num = 0
+        self._health.mark_up()
+        self._start_replay()
 
     async def check_status_periodically(self, run_once: bool = False) -> None:
         """
@@ -182,29 +551,37 @@ class NapCatBot:
         "NapCatUnknownException" to indicate that an unknown error occurred
         and call the `_status_bad_callback` method. Otherwise, the status is good,
         and the `_status_good_callback` method will be called.
+
+        The health monitor decides when to check: the check is skipped while
+        the actions succeed, and retried with backoff while the status is
+        bad. With `run_once`, the status is always checked once.
         """
 
         while True:
-            self._logger.debug("Checking the status of the NapCat client...")
-            flag = True
-
-            try:
-                flag = await self._check_running_status()
-            except (
-                NapCatDisconnectedException,
-                NapCatOfflineException,
-                NapCatAPIFailureException,
-            ) as e:
-                self._status_bad_callback(e)
-            else:
-                if not flag:
-                    self._status_bad_callback(
-                        NapCatUnknownException("Unknown error occurred!")
-                    )
-                else:
-                    self._status_good_callback()
+            if run_once or self._health.should_probe():
+                await self._check_status_once()
 
             if run_once:
                 return
 
-            await asyncio.sleep(self._check_status_interval)
+            await self._health.wait()
+
+    async def _check_status_once(self) -> None:
+        self._logger.debug("Checking the status of the NapCat client...")
+        flag = True
+
+        try:
+            flag = await self._check_running_status()
+        except (
+            NapCatDisconnectedException,
+            NapCatOfflineException,
+            NapCatAPIFailureException,
+        ) as e:
+            self._status_bad_callback(e)
+        else:
+            if not flag:
+                self._status_bad_callback(
+                    NapCatUnknownException("Unknown error occurred!")
+                )
+            else:
+                self._status_good_callback()
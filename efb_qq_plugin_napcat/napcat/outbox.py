@@ -0,0 +1,240 @@
+"""
+Durable outbox of the actions called while napcat is offline
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Optional, TypedDict, Union
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatOfflineException
+
+OUTBOX_ID_PREFIX = "outbox_"
+"""
+The prefix of the message id of a message buffered in the outbox, e.g.
+"outbox_42", it is not sent to QQ yet
+"""
+
+
+class QueuedResponse(TypedDict):
+    outbox_id: int
+    """
+    The id of the buffered action in the outbox
+    """
+
+
+class OutboxStats(TypedDict):
+    queued: int
+    """
+    The number of actions buffered
+    """
+
+    rejected: int
+    """
+    The number of actions rejected because the outbox is full
+    """
+
+    replayed: int
+    """
+    The number of actions replayed successfully
+    """
+
+    failed: int
+    """
+    The number of actions dropped because NapCat rejected them on replay
+    """
+
+    size: int
+    """
+    The number of actions in the outbox now
+    """
+
+    replay_seconds: float
+    """
+    The total seconds spent on replaying
+    """
+
+
+class OutboxEntry(TypedDict):
+    outbox_id: int
+    action: str
+    params: dict[str, Any]
+    created_at: float
+
+
+class NapCatOutbox:
+    """
+    The NapCatOutbox buffers the actions changing the state of QQ (e.g.
+    "send_msg", "delete_msg") while the NapCat client is offline, so they
+    are not lost but replayed in order when the client is up again.
+
+    The actions are kept in a SQLite database in the WAL mode, so they
+    survive a restart of EFB. The outbox holds at most `outbox_max_size`
+    actions, NapCatOfflineException is raised when it is full. Without a
+    path, the actions are only kept in memory.
+    """
+
+    _db: sqlite3.Connection
+    """
+    The database of the outbox
+    """
+
+    _max_size: int
+    """
+    The most actions in the outbox
+    """
+
+    _size: int
+    """
+    The number of actions in the outbox
+    """
+
+    _replay_rate: float
+    """
+    The most actions replayed per second, 0 means no limit
+    """
+
+    _stats: OutboxStats
+    """
+    The statistics of the outbox
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, path: Optional[Path], config: dict[str, Any]) -> None:
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+        # It is created in the EFB thread and used in the event loop thread,
+        # but never at the same time.
+        self._db = sqlite3.connect(
+            ":memory:" if path is None else str(path), check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "action TEXT NOT NULL, "
+            "params TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+        self._max_size = config.get("outbox_max_size", 1000)
+        self._replay_rate = config.get("outbox_replay_rate", 2.0)
+        self._size = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self._stats = OutboxStats(
+            queued=0, rejected=0, replayed=0, failed=0, size=0, replay_seconds=0.0
+        )
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def stats(self) -> OutboxStats:
+        stats = self._stats.copy()
+        stats["size"] = self._size
+
+        return stats
+
+    @property
+    def replay_throughput(self) -> float:
+        """
+        The actions replayed per second, 0 before any replay.
+        """
+
+        seconds = self._stats["replay_seconds"]
+        return self._stats["replayed"] / seconds if seconds else 0.0
+
+    @property
+    def replay_interval(self) -> float:
+        """
+        The seconds between two replayed actions.
+        """
+
+        return 1 / self._replay_rate if self._replay_rate > 0 else 0.0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, action_name: str, params: dict[str, Any]) -> QueuedResponse:
+        """
+        Append an action to the outbox.
+        """
+
+        if self._size >= self._max_size:
+            self._stats["rejected"] += 1
+            raise NapCatOfflineException(
+                f"NapCat client is offline and the outbox is full ({self._max_size})"
+            )
+
+        cursor = self._db.execute(
+            "INSERT INTO outbox (action, params, created_at) VALUES (?, ?, ?)",
+            (action_name, json.dumps(params, ensure_ascii=False), time.time()),
+        )
+        self._db.commit()
+
+        self._size += 1
+        self._stats["queued"] += 1
+        outbox_id = cursor.lastrowid
+        assert outbox_id is not None
+        self._logger.debug("Buffered %s as #%d in the outbox", action_name, outbox_id)
+
+        return QueuedResponse(outbox_id=outbox_id)
+
+    def peek(self) -> Optional[OutboxEntry]:
+        """
+        Get the oldest action in the outbox without removing it.
+        """
+
+        row = self._db.execute(
+            "SELECT id, action, params, created_at FROM outbox ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+
+        return OutboxEntry(
+            outbox_id=row[0], action=row[1], params=json.loads(row[2]), created_at=row[3]
+        )
+
+    def remove(self, outbox_id: int, replayed: bool) -> None:
+        """
+        Remove an action after it is replayed or dropped.
+        """
+
+        cursor = self._db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+        self._db.commit()
+
+        if cursor.rowcount:
+            self._size -= 1
+            self._stats["replayed" if replayed else "failed"] += 1
+
+    def cancel(self, outbox_id: int) -> bool:
+        """
+        Remove an action before it is replayed, e.g. a buffered message is
+        recalled. Return whether the action was still in the outbox.
+        """
+
+        cursor = self._db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+        self._db.commit()
+        self._size -= cursor.rowcount
+
+        return cursor.rowcount > 0
+
+    def record_replay_time(self, seconds: float) -> None:
+        self._stats["replay_seconds"] += seconds
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def is_queued(response: Union[QueuedResponse, dict[str, Any], None]) -> bool:
+    """
+    Whether the response of an action means it is buffered in the outbox.
+    """
+
+    return isinstance(response, dict) and "outbox_id" in response
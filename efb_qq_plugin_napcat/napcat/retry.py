@@ -0,0 +1,277 @@
+"""
+Retry policies and the circuit breaker of the NapCat actions
+"""
+
+import random
+import time
+from typing import Any, Literal, TypedDict
+
+from efb_qq_plugin_napcat.napcat.dispatcher import is_read_only_action
+from efb_qq_plugin_napcat.napcat.exceptions import (
+    NapCatAPIFailureException,
+    NapCatCircuitOpenException,
+    NapCatDisconnectedException,
+    NapCatException,
+)
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+def is_unreachable(exception: NapCatException) -> bool:
+    """
+    Whether the exception means NapCat cannot be reached: the connection
+    failed or the server answered with a 5xx status. A failed OneBot return
+    code means NapCat is alive and only rejects the action.
+    """
+
+    if isinstance(exception, NapCatDisconnectedException):
+        return True
+
+    if isinstance(exception, NapCatAPIFailureException):
+        return exception.status_code is not None and exception.status_code >= 500
+
+    return False
+
+
+class RetryPolicy:
+    """
+    The RetryPolicy decides whether a failed action is called again:
+
+    1. At most `max_attempts` attempts, waiting `backoff` seconds doubled
+       after every attempt (at most `backoff_max`, with a random jitter of
+       10%) in between.
+    2. The failures with a OneBot return code in `retry_retcodes` are
+       retried.
+    3. The failures with an HTTP status in `retry_status_codes` and the
+       network errors (unless `retry_network_errors` is false) are retried
+       for the read-only actions only. The action may have been done
+       before the gateway or the connection failed, e.g. a "send_msg" whose
+       response is lost may have been sent already, so the actions changing
+       the state are only retried on them with `retry_state_changing`.
+    """
+
+    __slots__ = (
+        "max_attempts",
+        "backoff",
+        "backoff_max",
+        "retry_status_codes",
+        "retry_retcodes",
+        "retry_network_errors",
+        "retry_state_changing",
+    )
+
+    max_attempts: int
+    backoff: float
+    backoff_max: float
+    retry_status_codes: frozenset[int]
+    retry_retcodes: frozenset[int]
+    retry_network_errors: bool
+    retry_state_changing: bool
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.max_attempts = config.get("max_attempts", 3)
+        self.backoff = config.get("backoff", 0.2)
+        self.backoff_max = config.get("backoff_max", 2.0)
+        self.retry_status_codes = frozenset(
+            config.get("retry_status_codes", (502, 503, 504))
+        )
+        self.retry_retcodes = frozenset(config.get("retry_retcodes", ()))
+        self.retry_network_errors = config.get("retry_network_errors", True)
+        self.retry_state_changing = config.get("retry_state_changing", False)
+
+    def should_retry(
+        self, action_name: str, exception: NapCatException, attempt: int
+    ) -> bool:
+        if attempt >= self.max_attempts:
+            return False
+
+        if isinstance(exception, NapCatCircuitOpenException):
+            return False
+
+        if isinstance(exception, NapCatDisconnectedException):
+            ambiguous = self.retry_network_errors
+        elif isinstance(exception, NapCatAPIFailureException):
+            if exception.ret_code in self.retry_retcodes:
+                return True
+            ambiguous = exception.status_code in self.retry_status_codes
+        else:
+            return False
+
+        return ambiguous and (
+            self.retry_state_changing or is_read_only_action(action_name)
+        )
+
+    def delay(self, attempt: int) -> float:
+        """
+        The seconds to wait after the `attempt`-th attempt failed.
+        """
+
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(0.9, 1.1)
+
+
+class RetryStats(TypedDict):
+    retries: int
+    """
+    The number of attempts retried
+    """
+
+    circuit_opened: int
+    """
+    The number of times the circuit breaker opened
+    """
+
+    circuit_rejected: int
+    """
+    The number of calls failed fast because the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    The CircuitBreaker stops hammering a dead NapCat:
+
+    1. closed: the calls go through. After `circuit_failure_threshold`
+       consecutive unreachable failures (see `is_unreachable`), it opens.
+    2. open: the calls fail at once with NapCatCircuitOpenException
+       instead of each waiting for `api_timeout`. After
+       `circuit_reset_timeout` seconds, it becomes half open.
+    3. half_open: a single call is let through as a probe, the others
+       still fail at once. The breaker closes if the probe succeeds and
+       opens again otherwise.
+    """
+
+    _failure_threshold: int
+    """
+    The consecutive failures to open the breaker, 0 disables the breaker
+    """
+
+    _reset_timeout: float
+    """
+    The seconds the breaker stays open before a probe
+    """
+
+    _state: CircuitState
+    """
+    The state of the breaker
+    """
+
+    _failures: int
+    """
+    The consecutive unreachable failures
+    """
+
+    _opened_at: float
+    """
+    The monotonic time the breaker opened
+    """
+
+    _probing: bool
+    """
+    Whether the probe of the half open breaker is in flight
+    """
+
+    _stats: RetryStats
+    """
+    The statistics shared with the retries
+    """
+
+    def __init__(self, config: dict[str, Any], stats: RetryStats) -> None:
+        self._failure_threshold = config.get("circuit_failure_threshold", 5)
+        self._reset_timeout = config.get("circuit_reset_timeout", 10.0)
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = stats
+
+    @property
+    def state(self) -> CircuitState:
+        return self._state
+
+    def before_call(self) -> None:
+        """
+        Check whether a call may go through, raise NapCatCircuitOpenException
+        otherwise.
+        """
+
+        if self._state == "closed":
+            return
+
+        if self._state == "open":
+            if time.monotonic() - self._opened_at < self._reset_timeout:
+                self._reject()
+            self._state = "half_open"
+
+        if self._probing:
+            self._reject()
+        self._probing = True
+
+    def _reject(self) -> None:
+        self._stats["circuit_rejected"] += 1
+        raise NapCatCircuitOpenException(
+            "NapCat client is unreachable, the circuit breaker is open"
+        )
+
+    def record_success(self) -> None:
+        """
+        Record a call reaching NapCat, including the failed return codes.
+        """
+
+        self._failures = 0
+        self._probing = False
+        self._state = "closed"
+
+    def record_failure(self) -> None:
+        """
+        Record a call failing to reach NapCat.
+        """
+
+        self._failures += 1
+        self._probing = False
+
+        if self._state == "half_open" or (
+            self._state == "closed"
+            and self._failure_threshold > 0
+            and self._failures >= self._failure_threshold
+        ):
+            self._state = "open"
+            self._opened_at = time.monotonic()
+            self._stats["circuit_opened"] += 1
+
+    def record_abort(self) -> None:
+        """
+        Record a call aborted without a result (e.g. cancelled), so another
+        call can probe.
+        """
+
+        self._probing = False
+
+
+class RetryPolicies:
+    """
+    The retry policies of the actions: `retry_policy` is the default one,
+    `retry_policies` overrides it for specific actions, e.g.
+    `{"send_msg": {"retry_state_changing": true}}`.
+    """
+
+    _default: RetryPolicy
+    """
+    The policy of the actions not in `_policies`
+    """
+
+    _policies: dict[str, RetryPolicy]
+    """
+    The mapping from the action name to its policy
+    """
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        default_config = config.get("retry_policy", {})
+        self._default = RetryPolicy(default_config)
+        self._policies = {
+            action_name: RetryPolicy(default_config | policy_config)
+            for action_name, policy_config in config.get("retry_policies", {}).items()
+        }
+
+    def get(self, action_name: str) -> RetryPolicy:
+        return self._policies.get(action_name, self._default)
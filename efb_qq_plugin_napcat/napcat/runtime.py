@@ -0,0 +1,323 @@
+"""
+Runtime shared by several NapCat accounts in one process
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, TypedDict
+
+import httpx
+
+from efb_qq_plugin_napcat.napcat.event_loop import new_event_loop
+from efb_qq_plugin_napcat.napcat.media_cache import NapCatMediaCache
+
+
+class FairSchedulerStats(TypedDict):
+    acquired: int
+    """
+    The number of slots acquired by the account
+    """
+
+    waited: int
+    """
+    The number of times the account waited for a slot
+    """
+
+    wait_seconds: float
+    """
+    The total seconds the account waited for the slots
+    """
+
+
+class NapCatFairScheduler:
+    """
+    The NapCatFairScheduler shares the connections of the pool among the
+    accounts. There are `slots` slots (one per connection), an account holds
+    one while its request is in flight. When all the slots are taken, a freed
+    slot goes to the waiting accounts in turn (round robin), not to the
+    earliest request, so an account flooding the pool only queues behind its
+    own requests and cannot starve the others.
+
+    It should only be used in the event loop of the runtime.
+    """
+
+    _free: int
+    """
+    The number of free slots
+    """
+
+    _waiters: "collections.OrderedDict[str, collections.deque[asyncio.Future[None]]]"
+    """
+    The waiting requests of every account, the first account is served next
+    """
+
+    _stats: dict[str, FairSchedulerStats]
+    """
+    The statistics of every account
+    """
+
+    def __init__(self, slots: int) -> None:
+        self._free = slots
+        self._waiters = collections.OrderedDict()
+        self._stats = {}
+
+    @property
+    def stats(self) -> dict[str, FairSchedulerStats]:
+        return {account: stats.copy() for account, stats in self._stats.items()}
+
+    def _get_stats(self, account: str) -> FairSchedulerStats:
+        stats = self._stats.get(account)
+        if stats is None:
+            stats = self._stats[account] = FairSchedulerStats(
+                acquired=0, waited=0, wait_seconds=0.0
+            )
+
+        return stats
+
+    async def acquire(self, account: str) -> None:
+        stats = self._get_stats(account)
+        stats["acquired"] += 1
+
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+
+        stats["waited"] += 1
+        start = time.perf_counter()
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(account, collections.deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted, but the request is cancelled
+                self.release()
+            else:
+                self._discard(account, waiter)
+            raise
+        finally:
+            stats["wait_seconds"] += time.perf_counter() - start
+
+    def _discard(self, account: str, waiter: "asyncio.Future[None]") -> None:
+        waiters = self._waiters.get(account)
+        if waiters is None:
+            return
+
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._waiters[account]
+
+    def release(self) -> None:
+        while self._waiters:
+            account, waiters = self._waiters.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                # The account waits at the end of the turn for its next slot
+                self._waiters[account] = waiters
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self._free += 1
+
+
+class NapCatRuntime:
+    """
+    The NapCatRuntime is shared by the NapCat accounts with the same
+    `shared_runtime` name in one process. Instead of one event loop thread,
+    one HTTP client and one media cache per account, the accounts share:
+
+    1. One event loop and the thread running it, started by the first
+       account and stopped when the last account is released.
+    2. One HTTP client, so the connections of the accounts are pooled, and
+       the requests are scheduled fairly among the accounts by the
+       NapCatFairScheduler.
+    3. One media cache, the media are content-addressed, so a media
+       received by several accounts is stored once.
+
+    The contact managers, the health and the outbox stay per account.
+
+    Use `acquire_runtime` to get the runtime by the name.
+    """
+
+    name: str
+    """
+    The name of the runtime
+    """
+
+    loop: asyncio.AbstractEventLoop
+    """
+    The event loop shared by the accounts
+    """
+
+    scheduler: NapCatFairScheduler
+    """
+    The scheduler of the requests of the shared HTTP client
+    """
+
+    media_cache: Optional[NapCatMediaCache]
+    """
+    The media cache shared by the accounts, None if it is disabled
+    """
+
+    _accounts: set[str]
+    """
+    The accounts using the runtime
+    """
+
+    _thread: Optional[threading.Thread]
+    """
+    The thread running the event loop, None before it is started
+    """
+
+    _limits: httpx.Limits
+    """
+    The limits of the connection pool of the shared client
+    """
+
+    _client: Optional[httpx.AsyncClient]
+    """
+    The shared HTTP client, created lazily in the event loop
+    """
+
+    _lock: threading.Lock
+    """
+    The lock of the accounts and the thread, accounts start and stop in
+    different EFB threads
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, name: str, config: dict[str, Any], media_dir: Path) -> None:
+        self.name = name
+        self.loop = new_event_loop(config)
+
+        max_connections = config.get("http_max_connections", 16)
+        self.scheduler = NapCatFairScheduler(max_connections)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=config.get("http_max_keepalive_connections", 8),
+            keepalive_expiry=config.get("http_keepalive_expiry", 60.0),
+        )
+
+        self.media_cache = None
+        if config.get("media_cache", True):
+            self.media_cache = NapCatMediaCache(media_dir, config)
+
+        self._accounts = set()
+        self._thread = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def accounts(self) -> frozenset[str]:
+        return frozenset(self._accounts)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Get the shared client, it should be called in the event loop of the
+        runtime. The headers and the timeout are given by every request.
+        """
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self._limits)
+
+        return self._client
+
+    def start(self) -> None:
+        """
+        Start the event loop thread if it is not running yet. The media cache
+        is loaded before.
+        """
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            if self.media_cache is not None:
+                self.media_cache.load()
+
+            def _run():
+                asyncio.set_event_loop(self.loop)
+                self.loop.run_forever()
+
+            self._thread = threading.Thread(target=_run, name=f"napcat-{self.name}")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def release(self, account: str) -> None:
+        """
+        Release the runtime used by the account. When the last account is
+        released, the shared client is closed, the event loop is stopped and
+        the media cache is saved.
+        """
+
+        with _runtimes_lock, self._lock:
+            self._accounts.discard(account)
+            if self._accounts:
+                return
+
+            if _runtimes.get(self.name) is self:
+                del _runtimes[self.name]
+
+            thread = self._thread
+            self._thread = None
+
+        if thread is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_client(), self.loop).result(
+                    10
+                )
+            except Exception as e:
+                self._logger.warning(f"Failed to close the shared HTTP client: {e!r}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join()
+        self.loop.close()
+
+        if self.media_cache is not None:
+            try:
+                self.media_cache.save()
+            except OSError as e:
+                self._logger.warning(f"Failed to save the media cache index: {e}")
+
+    async def _close_client(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_runtimes: dict[str, NapCatRuntime] = {}
+_runtimes_lock = threading.Lock()
+
+
+def acquire_runtime(
+    name: str, account: str, config: dict[str, Any], media_dir: Path
+) -> NapCatRuntime:
+    """
+    Get the runtime of the name for the account, it is created by the first
+    account. The config and the media directory of the first account are
+    used by the runtime.
+    """
+
+    with _runtimes_lock:
+        runtime = _runtimes.get(name)
+        if runtime is None:
+            runtime = _runtimes[name] = NapCatRuntime(name, config, media_dir)
+        with runtime._lock:
+            if account in runtime._accounts:
+                raise ValueError(f"The account {account} already uses the runtime")
+            runtime._accounts.add(account)
+
+    return runtime
@@ -0,0 +1,448 @@
+"""
+Outbound send queue for napcat
+"""
+
+import asyncio
+import collections
+import logging
+import time
+from typing import Any, Literal, TypedDict
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatOfflineException
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.outbox import OUTBOX_ID_PREFIX, is_queued
+
+ChatTarget = tuple[Literal["private", "group"], int]
+"""
+The chat to send to: the message type and the user id or group id
+"""
+
+Segment = dict[str, Any]
+
+_BUCKET_PRUNE_INTERVAL = 60.0
+
+
+class TokenBucket:
+    """
+    A token bucket allowing `rate` calls per second on average and bursts
+    of `burst` calls. `reserve` takes a token at once and returns how long
+    the caller should wait for it, so the callers are served in order
+    without a lock. A rate of 0 means no limit.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        """
+        Whether the bucket has refilled to its burst by `now`, so dropping it
+        for a new full one changes nothing.
+        """
+
+        if self.rate <= 0:
+            return True
+
+        return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+class SendQueueStats(TypedDict):
+    submitted: int
+    """
+    The number of messages submitted to the queue
+    """
+
+    calls: int
+    """
+    The number of "send_msg" calls
+    """
+
+    merged: int
+    """
+    The number of messages merged into the previous message
+    """
+
+    failed: int
+    """
+    The number of messages failed to be sent
+    """
+
+    queue_wait_total: float
+    """
+    The total seconds messages waited before being sent, including the
+    rate limit
+    """
+
+    queue_wait_max: float
+    """
+    The longest seconds a message waited before being sent
+    """
+
+    rate_limit_wait_total: float
+    """
+    The total seconds the sending waited for the rate limits
+    """
+
+
+class _OutboundMessage:
+    __slots__ = ("segments", "mergeable", "future", "submitted_at")
+
+    segments: list[Segment]
+    mergeable: bool
+    future: "asyncio.Future[int | str]"
+    submitted_at: float
+
+    def __init__(
+        self,
+        segments: list[Segment],
+        mergeable: bool,
+        future: "asyncio.Future[int | str]",
+    ) -> None:
+        self.segments = segments
+        self.mergeable = mergeable
+        self.future = future
+        self.submitted_at = time.perf_counter()
+
+
+class NapCatSendQueue:
+    """
+    The NapCatSendQueue sends the messages to QQ on top of NapCatBot. QQ
+    risk control may ban an account sending bursts of messages, so:
+
+    1. The messages of one chat are sent one by one in the order they are
+       submitted, the chats are sent in parallel.
+    2. The sending is limited by a token bucket per chat
+       (`send_rate_per_chat`, `send_burst_per_chat`) and a global one
+       (`send_rate`, `send_burst`).
+    3. With `send_merge_texts`, consecutive text messages to the same
+       chat submitted within `send_merge_window` seconds are merged into
+       one "send_msg" call, at most `send_merge_max` messages or
+       `send_merge_max_length` characters. The merged messages are one
+       QQ message with one message id, so recalling or editing one of
+       them recalls all of them: it is off by default, and should only be
+       enabled when the messages are not recalled or edited afterwards.
+
+    Every submitted message gets a future resolved with the message id, or
+    the outbox id (e.g. "outbox_42") if NapCat is offline and the message
+    is buffered.
+    """
+
+    _napcat_bot: NapCatBot
+    """
+    The NapCatBot instance
+    """
+
+    _chats: dict[ChatTarget, "collections.deque[_OutboundMessage]"]
+    """
+    The mapping from the chat to its waiting messages, a chat is here only
+    when it has a worker
+    """
+
+    _chat_buckets: dict[ChatTarget, TokenBucket]
+    """
+    The token bucket of every chat, the idle ones (refilled and without a
+    worker) are pruned every `_BUCKET_PRUNE_INTERVAL` seconds
+    """
+
+    _pruned_at: float
+    """
+    The monotonic time the idle token buckets were last pruned
+    """
+
+    _bucket: TokenBucket
+    """
+    The global token bucket
+    """
+
+    _chat_rate: float
+    """
+    The rate of the token bucket of every chat
+    """
+
+    _chat_burst: float
+    """
+    The burst of the token bucket of every chat
+    """
+
+    _merge: bool
+    """
+    Whether the consecutive text messages are merged
+    """
+
+    _merge_window: float
+    """
+    The seconds to wait for the next text message to merge
+    """
+
+    _merge_max: int
+    """
+    The most messages merged into one call
+    """
+
+    _merge_max_length: int
+    """
+    The most characters of a merged text
+    """
+
+    _tasks: set["asyncio.Task[None]"]
+    """
+    The running workers
+    """
+
+    _stats: SendQueueStats
+    """
+    The statistics of the queue
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(self, napcat_bot: NapCatBot, config: dict[str, Any]) -> None:
+        self._napcat_bot = napcat_bot
+        self._chat_rate = config.get("send_rate_per_chat", 1.0)
+        self._chat_burst = config.get("send_burst_per_chat", 5)
+        self._bucket = TokenBucket(
+            config.get("send_rate", 5.0), config.get("send_burst", 10)
+        )
+        self._merge = config.get("send_merge_texts", False)
+        self._merge_window = config.get("send_merge_window", 0.1)
+        self._merge_max = config.get("send_merge_max", 10)
+        self._merge_max_length = config.get("send_merge_max_length", 4000)
+        self._chats = {}
+        self._chat_buckets = {}
+        self._pruned_at = time.monotonic()
+        self._tasks = set()
+        self._stats = SendQueueStats(
+            submitted=0,
+            calls=0,
+            merged=0,
+            failed=0,
+            queue_wait_total=0.0,
+            queue_wait_max=0.0,
+            rate_limit_wait_total=0.0,
+        )
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def stats(self) -> SendQueueStats:
+        return self._stats
+
+    def submit(
+        self, target: ChatTarget, segments: list[Segment]
+    ) -> "asyncio.Future[int | str]":
+        """
+        Submit a message to the queue. The message is merged with the
+        adjacent ones when it only contains text and `send_merge_texts` is
+        enabled. It should be called in the event loop of the NapCat client.
+        """
+
+        future: "asyncio.Future[int | str]" = asyncio.get_running_loop().create_future()
+        mergeable = self._merge and all(segment["type"] == "text" for segment in segments)
+        message = _OutboundMessage(segments, mergeable, future)
+        self._stats["submitted"] += 1
+
+        messages = self._chats.get(target)
+        if messages is not None:
+            messages.append(message)
+            return future
+
+        self._chats[target] = collections.deque([message])
+        self._prune_buckets()
+        task = asyncio.ensure_future(self._run_chat(target))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return future
+
+    def _prune_buckets(self) -> None:
+        now = time.monotonic()
+        if now - self._pruned_at < _BUCKET_PRUNE_INTERVAL:
+            return
+
+        self._pruned_at = now
+        self._chat_buckets = {
+            target: bucket
+            for target, bucket in self._chat_buckets.items()
+            if target in self._chats or not bucket.is_full(now)
+        }
+
+    async def send(self, target: ChatTarget, segments: list[Segment]) -> int | str:
+        """
+        Send a message and wait for the message id. A message buffered in
+        the outbox of NapCatBot gets an id like "outbox_42" instead.
+
+        If the caller is cancelled (e.g. the bridge call timed out) before
+        the message is sent, the message is taken out of the queue, so it
+        is not sent later behind the back of the caller.
+        """
+
+        return await self.submit(target, segments)
+
+    def send_text(self, target: ChatTarget, text: str) -> "asyncio.Future[int | str]":
+        return self.submit(target, [{"type": "text", "data": {"text": text}}])
+
+    async def _run_chat(self, target: ChatTarget) -> None:
+        """
+        Send the messages of one chat until there is none left.
+        """
+
+        messages = self._chats[target]
+        bucket = self._chat_buckets.get(target)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chat_buckets[target] = bucket
+
+        try:
+            while messages:
+                batch = [messages.popleft()]
+                if batch[0].future.done():
+                    # Cancelled by the caller while waiting
+                    continue
+
+                try:
+                    if batch[0].mergeable:
+                        await self._collect_batch(messages, batch)
+
+                    wait = bucket.reserve()
+                    if wait:
+                        await asyncio.sleep(wait)
+                    global_wait = self._bucket.reserve()
+                    if global_wait:
+                        await asyncio.sleep(global_wait)
+                    self._stats["rate_limit_wait_total"] += wait + global_wait
+
+                    # The callers may have been cancelled during the waits
+                    batch = [message for message in batch if not message.future.done()]
+                    if batch:
+                        await self._send_batch(target, batch)
+                except asyncio.CancelledError:
+                    for message in batch:
+                        message.future.cancel()
+                    raise
+                except Exception as e:
+                    # Fail this batch only, the worker goes on with the next
+                    self._logger.exception(f"Failed to send the messages to {target}")
+                    self._fail_batch(batch, e)
+        finally:
+            # A new worker is started for the chat by the next submit
+            if self._chats.get(target) is messages:
+                del self._chats[target]
+            for message in messages:
+                message.future.cancel()
+
+    async def _collect_batch(
+        self,
+        messages: "collections.deque[_OutboundMessage]",
+        batch: list[_OutboundMessage],
+    ) -> None:
+        """
+        Wait until `send_merge_window` seconds after the first message in
+        the batch was submitted, then take the consecutive text messages
+        following it.
+        """
+
+        remaining = batch[0].submitted_at + self._merge_window - time.perf_counter()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+        length = sum(len(s["data"]["text"]) for s in batch[0].segments)
+        while messages and len(batch) < self._merge_max:
+            message = messages[0]
+            if message.future.done():
+                messages.popleft()
+                continue
+
+            if not message.mergeable:
+                return
+
+            message_length = sum(len(s["data"]["text"]) for s in message.segments)
+            if length + message_length + 1 > self._merge_max_length:
+                return
+
+            batch.append(messages.popleft())
+            length += message_length + 1
+
+    async def _send_batch(
+        self, target: ChatTarget, batch: list[_OutboundMessage]
+    ) -> None:
+        if len(batch) == 1:
+            segments = batch[0].segments
+        else:
+            text = "\n".join(
+                "".join(s["data"]["text"] for s in message.segments) for message in batch
+            )
+            segments = [{"type": "text", "data": {"text": text}}]
+            self._stats["merged"] += len(batch) - 1
+
+        now = time.perf_counter()
+        for message in batch:
+            wait = now - message.submitted_at
+            self._stats["queue_wait_total"] += wait
+            self._stats["queue_wait_max"] = max(self._stats["queue_wait_max"], wait)
+
+        message_type, target_id = target
+        id_key = "group_id" if message_type == "group" else "user_id"
+
+        self._stats["calls"] += 1
+        try:
+            res = await self._napcat_bot.call_action(
+                "send_msg",
+                message_type=message_type,
+                message=segments,
+                **{id_key: target_id},
+            )
+            if res is None:
+                raise NapCatOfflineException("NapCat client is offline!")
+        except Exception as e:
+            self._fail_batch(batch, e)
+            return
+
+        message_id: int | str
+        if is_queued(res):
+            message_id = f"{OUTBOX_ID_PREFIX}{res['outbox_id']}"
+        else:
+            message_id = res["message_id"]
+
+        for message in batch:
+            if not message.future.done():
+                message.future.set_result(message_id)
+
+    def _fail_batch(self, batch: list[_OutboundMessage], e: Exception) -> None:
+        self._stats["failed"] += len(batch)
+        for message in batch:
+            if not message.future.done():
+                message.future.set_exception(e)
+
+    async def close(self) -> None:
+        """
+        Cancel the messages not sent yet.
+        """
+
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+        for messages in self._chats.values():
+            for message in messages:
+                message.future.cancel()
+        self._chats.clear()
@@ -0,0 +1,126 @@
+"""
+Compact on-disk snapshot of the contacts for a fast warm startup
+"""
+
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import Iterable
+
+ContactRecord = tuple[int, str, str]
+"""
+A contact in the snapshot: the id, the name and the alias. The alias is
+the remark of a friend, an empty alias means it equals the name.
+"""
+
+_MAGIC = b"NCSS"
+_VERSION = 1
+
+_HEADER = struct.Struct("<4sHH")
+"""
+magic, version, number of sections
+"""
+
+_SECTION = struct.Struct("<HI")
+"""
+length of the section name, number of records
+"""
+
+_RECORD = struct.Struct("<qHH")
+"""
+id, length of the name, length of the alias
+"""
+
+_logger = logging.getLogger(__name__)
+
+
+def dump_snapshot(path: Path, sections: dict[str, Iterable[ContactRecord]]) -> None:
+    """
+    Write the sections of contacts to `path`. The snapshot is written to
+    a temporary file first and then renamed, so a crash never leaves a
+    half-written snapshot behind.
+    """
+
+    chunks = [_HEADER.pack(_MAGIC, _VERSION, len(sections))]
+
+    for section_name, records in sections.items():
+        body = []
+        count = 0
+        for contact_id, name, alias in records:
+            name_bytes = name.encode()
+            alias_bytes = b"" if alias == name else alias.encode()
+            body.append(_RECORD.pack(contact_id, len(name_bytes), len(alias_bytes)))
+            body.append(name_bytes)
+            body.append(alias_bytes)
+            count += 1
+
+        section_name_bytes = section_name.encode()
+        chunks.append(_SECTION.pack(len(section_name_bytes), count))
+        chunks.append(section_name_bytes)
+        chunks.extend(body)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(chunks))
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: Path) -> dict[str, list[ContactRecord]]:
+    """
+    Read the sections of contacts from `path`. If the snapshot does not
+    exist, is of another version or is corrupted, an empty dict will be
+    returned, the contacts are fetched from NapCat as usual then.
+    """
+
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return {}
+    except OSError as e:
+        _logger.warning(f"Failed to read the contact snapshot: {e}")
+        return {}
+
+    try:
+        return _parse_snapshot(memoryview(data))
+    except (struct.error, UnicodeDecodeError, ValueError) as e:
+        _logger.warning(f"Ignore the invalid contact snapshot {path}: {e}")
+        return {}
+
+
+def _parse_snapshot(data: memoryview) -> dict[str, list[ContactRecord]]:
+    magic, version, section_count = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+        raise ValueError("bad magic")
+    if version != _VERSION:
+        raise ValueError(f"unsupported version {version}")
+
+    offset = _HEADER.size
+    sections: dict[str, list[ContactRecord]] = {}
+
+    for _ in range(section_count):
+        name_len, count = _SECTION.unpack_from(data, offset)
+        offset += _SECTION.size
+        end = offset + name_len
+        section_name = str(data[offset:end], "utf-8")
+        offset = end
+
+        records: list[ContactRecord] = []
+        for _ in range(count):
+            contact_id, name_len, alias_len = _RECORD.unpack_from(data, offset)
+            offset += _RECORD.size
+            end = offset + name_len
+            name = str(data[offset:end], "utf-8")
+            offset = end
+            end = offset + alias_len
+            alias = str(data[offset:end], "utf-8") if alias_len else name
+            offset = end
+            records.append((contact_id, name, alias))
+
+        sections[section_name] = records
+
+    if offset != len(data):
+        raise ValueError("trailing data")
+
+    return sections
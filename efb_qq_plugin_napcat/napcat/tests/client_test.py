@@ -0,0 +1,240 @@
+import asyncio
+import json
+import logging
+import time
+from types import SimpleNamespace
+
+import pytest
+from ehforwarderbot import MsgType, coordinator
+from ehforwarderbot.status import ChatUpdates
+from werkzeug import Response
+
+from efb_qq_plugin_napcat.NapCat import NapCat
+from efb_qq_plugin_napcat.napcat.codec import ImageSegment
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatDisconnectedException
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+@pytest.fixture
+def efb_data_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("EFB_DATA_PATH", str(tmp_path))
+    return tmp_path
+
+
+def _client(**config) -> NapCat:
+    napcat_config = {
+        "api_root": "http://localhost:6700",
+        "access_token": "",
+        "api_timeout": 5,
+        "contact_snapshot": False,
+        "media_cache": False,
+    } | config
+    channel = SimpleNamespace(channel_id="napcat.test")
+
+    return NapCat("NapCat", {"NapCat": napcat_config}, channel)  # type: ignore
+
+
+def _ok(data):
+    return {"status": "ok", "retcode": 0, "data": data}
+
+
+class TestBeforePoll:
+    def test_fail_fast(self, efb_data_path):
+        client = _client(bridge_timeout=60)
+
+        start = time.monotonic()
+        with pytest.raises(NapCatDisconnectedException):
+            client.get_login_info()
+        assert time.monotonic() - start < 1
+
+        client.stop_polling()
+
+
+class TestReconcile:
+    def test_failure_logged(self, efb_data_path, httpserver, caplog):
+        httpserver.expect_request("/get_status").respond_with_json(
+            _ok({"online": True, "good": True})
+        )
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {"status": "failed", "retcode": 1400, "data": None}
+        )
+        httpserver.expect_request("/get_group_list").respond_with_json(_ok([]))
+
+        client = _client()
+        with caplog.at_level(logging.WARNING):
+            client.poll()
+            while not client._reconcile_task.done():
+                time.sleep(0.01)
+            client.stop_polling()
+
+        assert client._reconcile_task.done()
+        assert any(
+            "Failed to reconcile the contacts" in record.message
+            for record in caplog.records
+        )
+
+    def test_chat_updates(self, efb_data_path, httpserver, monkeypatch):
+        httpserver.expect_request("/get_status").respond_with_json(
+            _ok({"online": True, "good": True})
+        )
+        friends = [
+            {"user_id": 1, "nickname": "Alice", "remark": ""},
+            {"user_id": 2, "nickname": "Bob", "remark": ""},
+        ]
+        httpserver.expect_request("/get_friend_list").respond_with_json(_ok(friends))
+        httpserver.expect_request("/get_group_list").respond_with_json(_ok([]))
+
+        sent = []
+        monkeypatch.setattr(coordinator, "master", None, raising=False)
+        monkeypatch.setattr(coordinator, "send_status", sent.append)
+        monkeypatch.setattr(ChatUpdates, "verify", lambda self: None)
+
+        client = _client()
+        client.poll()
+        try:
+            _wait_for(lambda: client._reconcile_task.done())
+            assert len(sent) == 1
+            assert list(sent[0].new_chats) == ["private_1", "private_2"]
+
+            # Alice is renamed, Bob is deleted, Carol is added
+            friends[:] = [
+                {"user_id": 1, "nickname": "Alice", "remark": "Ally"},
+                {"user_id": 3, "nickname": "Carol", "remark": ""},
+            ]
+            httpserver.clear_all_handlers()
+            httpserver.expect_request("/get_status").respond_with_json(
+                _ok({"online": True, "good": True})
+            )
+            httpserver.expect_request("/get_friend_list").respond_with_json(_ok(friends))
+            client.bridge.call(client.friend_manager.update_friend_list())
+        finally:
+            client.stop_polling()
+
+        assert len(sent) == 2
+        assert list(sent[1].new_chats) == ["private_3"]
+        assert list(sent[1].removed_chats) == ["private_2"]
+        assert list(sent[1].modified_chats) == ["private_1"]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestHealth:
+    def test_napcat_late(self, efb_data_path, httpserver):
+        def slow_status(request):
+            time.sleep(1)
+            return Response(
+                json.dumps(_ok({"online": True, "good": True})),
+                content_type="application/json",
+            )
+
+        httpserver.expect_request("/get_status").respond_with_handler(slow_status)
+        httpserver.expect_request("/get_friend_list").respond_with_json(_ok([]))
+        httpserver.expect_request("/get_group_list").respond_with_json(_ok([]))
+
+        client = _client()
+        start = time.monotonic()
+        client.poll()
+        try:
+            # The first probe runs in the background, poll does not wait for it
+            assert time.monotonic() - start < 0.5
+            assert client.napcat_bot.health.state == "unknown"
+
+            _wait_for(lambda: client.napcat_bot.health.state == "up")
+            _wait_for(lambda: client._reconcile_task.done())
+        finally:
+            client.stop_polling()
+
+    def test_napcat_back_after_poll(self, efb_data_path, httpserver):
+        httpserver.expect_request("/get_status").respond_with_data("", status=500)
+        httpserver.expect_request("/get_friend_list").respond_with_json(_ok([]))
+        httpserver.expect_request("/get_group_list").respond_with_json(_ok([]))
+
+        client = _client(health_retry_min=0.05, health_retry_jitter=0)
+        client.poll()
+        try:
+            _wait_for(lambda: client.napcat_bot.health.state == "down")
+
+            httpserver.clear_all_handlers()
+            httpserver.expect_request("/get_status").respond_with_json(
+                _ok({"online": True, "good": True})
+            )
+            _wait_for(lambda: client.napcat_bot.health.state == "up")
+        finally:
+            client.stop_polling()
+
+        assert client._health_task.cancelled()
+
+    def test_outbox_replayed_on_recovery(self, efb_data_path, httpserver):
+        httpserver.expect_request("/get_status").respond_with_json(
+            _ok({"online": True, "good": True})
+        )
+        httpserver.expect_request("/get_friend_list").respond_with_json(_ok([]))
+        httpserver.expect_request("/get_group_list").respond_with_json(_ok([]))
+
+        client = _client(
+            health_interval=0.05,
+            health_retry_min=0.05,
+            health_retry_jitter=0,
+            outbox_replay_rate=0,
+        )
+        client.poll()
+        try:
+            health = client.napcat_bot.health
+            _wait_for(lambda: health.state == "up")
+
+            # NapCat goes offline
+            httpserver.clear_all_handlers()
+            httpserver.expect_request("/get_status").respond_with_data("", status=500)
+            _wait_for(lambda: health.state == "down")
+
+            segments = [{"type": "text", "data": {"text": "hello"}}]
+            qq_id = client.bridge.call(client.send_queue.send(("private", 1), segments))
+            assert qq_id == "outbox_1"
+            assert len(client.outbox) == 1
+
+            # NapCat is back, the message is replayed
+            httpserver.clear_all_handlers()
+            httpserver.expect_request("/get_status").respond_with_json(
+                _ok({"online": True, "good": True})
+            )
+            httpserver.expect_request("/send_msg").respond_with_json(
+                _ok({"message_id": 42})
+            )
+            _wait_for(lambda: len(client.outbox) == 0)
+        finally:
+            client.stop_polling()
+
+        sent = [
+            json.loads(request.data)
+            for request, _ in httpserver.log
+            if request.path == "/send_msg"
+        ]
+        assert sent == [{"message_type": "private", "user_id": 1, "message": segments}]
+
+
+class TestMedia:
+    def test_fetch_failed(self, efb_data_path, httpserver):
+        httpserver.expect_request("/image").respond_with_data("", status=404)
+        url = httpserver.url_for("/image")
+        client = _client()
+        client._setup()
+        msg = SimpleNamespace(uid="1", type=MsgType.Text, text="", path=None)
+
+        segments = [ImageSegment("a.jpg", url)]
+        asyncio.run(client._attach_media(msg, segments))  # type: ignore
+
+        # The message is still delivered, as a text with the url
+        assert msg.type == MsgType.Text
+        assert msg.text == f"[image] {url}"
+        assert msg.path is None
+
+        client.stop_polling()
@@ -0,0 +1,119 @@
+from efb_qq_plugin_napcat.napcat.codec import (
+    AtSegment,
+    FaceSegment,
+    ImageSegment,
+    OtherSegment,
+    ReplySegment,
+    TextSegment,
+    escape,
+    parse_array,
+    parse_cq,
+    parse_message,
+    to_array,
+    to_cq,
+    unescape,
+)
+
+
+class TestEscape:
+    def test_escape(self):
+        assert escape("a&b[c],d") == "a&amp;b&#91;c&#93;,d"
+        assert escape("a&b[c],d", param=True) == "a&amp;b&#91;c&#93;&#44;d"
+
+    def test_unescape(self):
+        assert unescape("plain") == "plain"
+        assert unescape("a&amp;b&#91;c&#93;&#44;d") == "a&b[c],d"
+        # Escaped once, so "&amp;#91;" is "&#91;", not "["
+        assert unescape("&amp;#91;") == "&#91;"
+        # An unknown entity or a lone "&" is kept
+        assert unescape("&x; & &amp") == "&x; & &amp"
+
+    def test_roundtrip(self):
+        text = "[CQ:face,id=1] & &#91; ,"
+        assert unescape(escape(text)) == text
+        assert unescape(escape(text, param=True)) == text
+
+
+class TestParse:
+    def test_parse_cq(self):
+        segments = parse_cq(
+            "[CQ:reply,id=-42][CQ:at,qq=10001] hi &#91;1&#93; [CQ:face,id=14]"
+            "[CQ:image,file=a.jpg,url=https://x/?a=1&amp;b=2&#44;3,file_unique=abc]"
+            "[CQ:record,file=v.amr]"
+        )
+
+        assert segments == [
+            ReplySegment("-42"),
+            AtSegment("10001"),
+            TextSegment(" hi [1] "),
+            FaceSegment(14),
+            ImageSegment("a.jpg", "https://x/?a=1&b=2,3", extra={"file_unique": "abc"}),
+            OtherSegment("record", {"file": "v.amr"}),
+        ]
+
+    def test_parse_text_only(self):
+        assert parse_cq("") == []
+        assert parse_cq("hello") == [TextSegment("hello")]
+
+    def test_parse_unterminated(self):
+        assert parse_cq("hi [CQ:face,id=1") == [TextSegment("hi [CQ:face,id=1")]
+
+    def test_parse_malformed(self):
+        # A known type without its fields is kept as it is
+        assert parse_cq("[CQ:face,id=smile][CQ:at]") == [
+            OtherSegment("face", {"id": "smile"}),
+            OtherSegment("at", {}),
+        ]
+
+    def test_parse_array(self):
+        segments = parse_array(
+            [
+                {"type": "reply", "data": {"id": 42}},
+                {"type": "text", "data": {"text": "hi"}},
+                {"type": "face", "data": {"id": "14"}},
+                {"type": "json", "data": {"data": "{}"}},
+            ]
+        )
+
+        assert segments == [
+            ReplySegment("42"),
+            TextSegment("hi"),
+            FaceSegment(14),
+            OtherSegment("json", {"data": "{}"}),
+        ]
+
+    def test_parse_message(self):
+        assert parse_message(None) == []
+        assert parse_message("hi") == [TextSegment("hi")]
+        assert parse_message([{"type": "text", "data": {"text": "hi"}}]) == [
+            TextSegment("hi")
+        ]
+
+
+class TestSerialize:
+    def test_to_cq(self):
+        message = (
+            "[CQ:reply,id=42][CQ:at,qq=all] a&amp;b &#91;x&#93;, "
+            "[CQ:image,file=a.jpg,url=https://x/?a&#44;b,summary=&#91;s&#93;]"
+            "[CQ:record,file=v.amr]"
+        )
+
+        assert to_cq(parse_cq(message)) == message
+
+    def test_to_array(self):
+        array = [
+            {"type": "reply", "data": {"id": "42"}},
+            {"type": "text", "data": {"text": "hi"}},
+            {"type": "image", "data": {"file": "a.jpg", "url": "u", "file_unique": "x"}},
+            {"type": "video", "data": {"file": "v.mp4"}},
+        ]
+
+        assert to_array(parse_array(array)) == array
+
+    def test_cq_to_array(self):
+        segments = parse_cq("[CQ:face,id=14]hi")
+        assert to_array(segments) == [
+            {"type": "face", "data": {"id": "14"}},
+            {"type": "text", "data": {"text": "hi"}},
+        ]
+        assert to_cq(parse_array(to_array(segments))) == "[CQ:face,id=14]hi"
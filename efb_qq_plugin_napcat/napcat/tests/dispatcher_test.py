@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.dispatcher import NapCatActionDispatcher
+
+
+class _FakeCall:
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        self.count = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, action_name: str, **kwargs):
+        self.count += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        return {"action": action_name, **kwargs}
+
+
+class TestCoalesce:
+    def test_merge_identical_calls(self):
+        dispatcher = NapCatActionDispatcher({})
+        call = _FakeCall()
+
+        async def run():
+            return await asyncio.gather(
+                *(
+                    dispatcher.dispatch("get_friend_list", {"no_cache": True}, call)
+                    for _ in range(10)
+                )
+            )
+
+        results = asyncio.run(run())
+
+        assert call.count == 1
+        assert all(r == {"action": "get_friend_list", "no_cache": True} for r in results)
+        assert dispatcher.stats["get_friend_list"]["calls"] == 10
+        assert dispatcher.stats["get_friend_list"]["merged"] == 9
+
+    def test_different_arguments(self):
+        dispatcher = NapCatActionDispatcher({})
+        call = _FakeCall()
+
+        async def run():
+            await asyncio.gather(
+                dispatcher.dispatch("get_group_member_info", {"user_id": 1}, call),
+                dispatcher.dispatch("get_group_member_info", {"user_id": 2}, call),
+            )
+
+        asyncio.run(run())
+
+        assert call.count == 2
+        assert dispatcher.stats["get_group_member_info"]["merged"] == 0
+
+    def test_never_merge_write_actions(self):
+        dispatcher = NapCatActionDispatcher({})
+        call = _FakeCall()
+
+        async def run():
+            await asyncio.gather(
+                *(
+                    dispatcher.dispatch("send_msg", {"message": "hello"}, call)
+                    for _ in range(3)
+                )
+            )
+
+        asyncio.run(run())
+
+        assert call.count == 3
+
+    def test_exception_shared(self):
+        dispatcher = NapCatActionDispatcher({})
+
+        async def failed_call(action_name: str, **kwargs):
+            await asyncio.sleep(0.01)
+            raise RuntimeError("failed")
+
+        async def run():
+            return await asyncio.gather(
+                dispatcher.dispatch("get_status", {}, failed_call),
+                dispatcher.dispatch("get_status", {}, failed_call),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(run())
+
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert dispatcher.stats["get_status"]["merged"] == 1
+
+
+class TestConcurrency:
+    @pytest.mark.parametrize("limit", [1, 3])
+    def test_limit(self, limit: int):
+        dispatcher = NapCatActionDispatcher({"action_concurrency": {"send_msg": limit}})
+        call = _FakeCall()
+
+        async def run():
+            await asyncio.gather(
+                *(
+                    dispatcher.dispatch("send_msg", {"message": str(i)}, call)
+                    for i in range(6)
+                )
+            )
+
+        asyncio.run(run())
+
+        assert call.count == 6
+        assert call.max_running == limit
+        assert dispatcher.stats["send_msg"]["queue_wait_max"] > 0
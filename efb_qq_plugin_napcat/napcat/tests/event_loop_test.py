@@ -0,0 +1,59 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.event_loop import new_event_loop, select_backend
+
+
+class TestEventLoop:
+    def test_default(self):
+        assert select_backend({}) == "asyncio"
+
+        loop = new_event_loop({})
+        try:
+            assert type(loop) is type(asyncio.new_event_loop())
+        finally:
+            loop.close()
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            select_backend({"event_loop": "trio"})
+
+    def test_fallback(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, "uvloop", None)
+
+        assert select_backend({"event_loop": "uvloop"}) == "asyncio"
+        assert select_backend({"event_loop": "auto"}) == "asyncio"
+
+    def test_uvloop(self):
+        uvloop = pytest.importorskip("uvloop")
+
+        assert select_backend({"event_loop": "auto"}) == "uvloop"
+
+        loop = new_event_loop({"event_loop": "uvloop"})
+        try:
+            assert isinstance(loop, uvloop.Loop)
+            assert loop.run_until_complete(asyncio.sleep(0, "done")) == "done"
+        finally:
+            loop.close()
+
+    def test_current_loop_unchanged(self):
+        errors = []
+
+        def create():
+            loop = new_event_loop({"event_loop": "auto"})
+            try:
+                # No current event loop is set in a new thread
+                asyncio.get_event_loop()
+            except RuntimeError as e:
+                errors.append(e)
+            finally:
+                loop.close()
+
+        thread = threading.Thread(target=create)
+        thread.start()
+        thread.join()
+
+        assert len(errors) == 1
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+
+from websockets.asyncio.server import serve
+
+from efb_qq_plugin_napcat.napcat.event_pipeline import NapCatEventPipeline
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+
+def _event(group_id: int, seq: int) -> dict:
+    return {"post_type": "message", "group_id": group_id, "seq": seq}
+
+
+class _Collector:
+    def __init__(self, delay: float = 0) -> None:
+        self.delay = delay
+        self.results = []
+        self.running = 0
+        self.max_running = 0
+
+    async def convert(self, event):
+        if event.get("post_type") != "message":
+            return None
+        return event
+
+    async def deliver(self, event):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.running -= 1
+        self.results.append((event["group_id"], event["seq"]))
+
+
+class TestPipeline:
+    def test_per_chat_order(self):
+        collector = _Collector(delay=0.001)
+        pipeline = NapCatEventPipeline({}, collector.convert, collector.deliver)
+
+        async def run():
+            for seq in range(20):
+                for group_id in range(5):
+                    await pipeline.submit(_event(group_id, seq))
+            await pipeline.submit({"post_type": "meta_event"})
+            await pipeline.join()
+
+        asyncio.run(run())
+
+        for group_id in range(5):
+            seqs = [seq for gid, seq in collector.results if gid == group_id]
+            assert seqs == list(range(20))
+        # The chats are processed in parallel
+        assert collector.max_running > 1
+        assert pipeline.stats["received"] == 101
+        assert pipeline.stats["delivered"] == 100
+        assert pipeline.stats["queue_depth"] == 0
+
+    def test_backpressure(self):
+        collector = _Collector(delay=0.001)
+        pipeline = NapCatEventPipeline(
+            {"event_queue_size": 8, "event_workers": 2},
+            collector.convert,
+            collector.deliver,
+        )
+
+        async def run():
+            for seq in range(50):
+                await pipeline.submit(_event(seq % 4, seq))
+            await pipeline.join()
+
+        asyncio.run(run())
+
+        assert len(collector.results) == 50
+        assert pipeline.stats["queue_depth_max"] == 8
+        assert collector.max_running <= 2
+
+    def test_failed_event(self):
+        async def convert(event):
+            if event["seq"] == 1:
+                raise RuntimeError("failed")
+            return event
+
+        collector = _Collector()
+        pipeline = NapCatEventPipeline({}, convert, collector.deliver)
+
+        async def run():
+            for seq in range(3):
+                await pipeline.submit(_event(1, seq))
+            await pipeline.join()
+
+        asyncio.run(run())
+
+        assert collector.results == [(1, 0), (1, 2)]
+        assert pipeline.stats["failed"] == 1
+
+
+class TestLoad:
+    def test_replay_10k_events(self):
+        """
+        A stand-in NapCat pushes 10k events in one second over the forward
+        WebSocket, every event must be delivered in order with a bounded
+        queue.
+        """
+
+        total = 10000
+        collector = _Collector()
+        config = {
+            "transport": "ws",
+            "access_token": "",
+            "api_timeout": 5,
+            "event_queue_size": 256,
+        }
+
+        async def napcat(ws):
+            start = time.perf_counter()
+            for seq in range(total):
+                await ws.send(json.dumps(_event(seq % 50, seq)))
+                if seq % 1000 == 999:
+                    # Pace the replay at 10k events per second
+                    delay = start + (seq + 1) / total - time.perf_counter()
+                    await asyncio.sleep(max(delay, 0))
+            await ws.wait_closed()
+
+        async def run():
+            async with serve(napcat, "localhost", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                bot = NapCatBot(config | {"ws_url": f"ws://localhost:{port}"})
+                pipeline = NapCatEventPipeline(
+                    config, collector.convert, collector.deliver
+                )
+                bot.on_event(pipeline.submit)
+
+                start = time.perf_counter()
+                await bot.start()
+                while len(collector.results) < total:
+                    assert time.perf_counter() - start < 10
+                    await asyncio.sleep(0.01)
+                elapsed = time.perf_counter() - start
+
+                await bot.close()
+                return elapsed, pipeline.stats
+
+        elapsed, stats = asyncio.run(run())
+
+        assert elapsed < 5
+        assert stats["delivered"] == total
+        assert stats["queue_depth_max"] <= 256
+        for group_id in range(50):
+            seqs = [seq for gid, seq in collector.results if gid == group_id]
+            assert seqs == sorted(seqs)
@@ -1,10 +1,13 @@
 import asyncio
+import json
 
 import pytest
+from werkzeug import Response
 
 from efb_qq_plugin_napcat.napcat.exceptions import NapCatAPIFailureException
 from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager
 from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.types.friend import Friend
 
 
 @pytest.fixture
@@ -89,10 +92,79 @@ class TestUpdateFriendList:
         asyncio.run(friend_manager.update_friend_list())
 
         assert len(friend_manager.friend_list) == 1
-        assert len(friend_manager.uid_to_friend) == 3
-        assert friend_manager.uid_to_friend[3]["user_id"] == 3
-        assert friend_manager.uid_to_friend[3]["nickname"] == "Charlie"
-        assert friend_manager.uid_to_friend[3]["remark"] == "Charlie"
+        assert len(friend_manager.uid_to_friend) == 1
+        assert friend_manager.uid_to_friend[3].user_id == 3
+        assert friend_manager.uid_to_friend[3].nickname == "Charlie"
+        assert friend_manager.uid_to_friend[3].remark == "Charlie"
+
+    def test_diff(self, friend_manager: NapCatFriendManager, httpserver):
+
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [
+                    {"user_id": 1, "nickname": "Alice", "remark": ""},
+                    {"user_id": 2, "nickname": "Bob", "remark": "Bob"},
+                    {"user_id": 3, "nickname": "Charlie", "remark": ""},
+                ],
+            }
+        )
+
+        diffs = []
+
+        async def handler(diff):
+            diffs.append(diff)
+
+        friend_manager.on_friend_list_changed(handler)
+
+        diff = asyncio.run(friend_manager.update_friend_list())
+        assert [f.user_id for f in diff["added"]] == [1, 2, 3]
+        alice = friend_manager.uid_to_friend[1]
+
+        httpserver.clear()
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [
+                    {"user_id": 1, "nickname": "Alice", "remark": ""},
+                    {"user_id": 2, "nickname": "Bob", "remark": "Bobby"},
+                    {"user_id": 3, "nickname": "Charlie", "remark": ""},
+                ],
+            }
+        )
+
+        diff = asyncio.run(friend_manager.update_friend_list())
+        assert diff == {
+            "added": [],
+            "removed": [],
+            "updated": [Friend(user_id=2, nickname="Bob", remark="Bobby")],
+        }
+        assert friend_manager.uid_to_friend[1] is alice
+
+        httpserver.clear()
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [
+                    {"user_id": 1, "nickname": "Alice", "remark": ""},
+                    {"user_id": 4, "nickname": "Dave", "remark": ""},
+                ],
+            }
+        )
+
+        diff = asyncio.run(friend_manager.update_friend_list())
+        assert [f.user_id for f in diff["added"]] == [4]
+        assert sorted(f.user_id for f in diff["removed"]) == [2, 3]
+        assert diff["updated"] == []
+        assert sorted(friend_manager.uid_to_friend) == [1, 4]
+        assert len(friend_manager.friend_list) == 2
+
+        # Nothing changed, so the handler is not called
+        asyncio.run(friend_manager.update_friend_list())
+        assert len(diffs) == 3
 
     def test_update_error(self, friend_manager: NapCatFriendManager, httpserver):
 
@@ -165,3 +237,222 @@ class TestGetFriendRemark:
 
         result = asyncio.run(friend_manager.get_friend_remark(1))
         assert result == "Alice"
+
+
+class TestFriendCache:
+    @staticmethod
+    def _expect_friend_list(httpserver, friends):
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": friends}
+        )
+
+    def test_stranger_burst(self, friend_manager: NapCatFriendManager, httpserver):
+        self._expect_friend_list(
+            httpserver, [{"user_id": 1, "nickname": "Alice", "remark": ""}]
+        )
+
+        async def run():
+            first = await asyncio.gather(
+                *(friend_manager.get_friend_remark(uid) for uid in range(100, 600))
+            )
+            second = [
+                await friend_manager.get_friend_remark(uid) for uid in range(600, 1100)
+            ]
+            return first + second
+
+        results = asyncio.run(run())
+
+        assert results == [None] * 1000
+        assert len(httpserver.log) == 1
+
+    def test_negative_cache(self, httpserver):
+        bot = NapCatBot(
+            {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10}
+        )
+        bot._logged_in = True
+        bot._connected = True
+        friend_manager = NapCatFriendManager(
+            bot, {"friend_min_refresh_interval": 0, "friend_negative_ttl": 600}
+        )
+        self._expect_friend_list(
+            httpserver, [{"user_id": 1, "nickname": "Alice", "remark": ""}]
+        )
+
+        async def run():
+            assert await friend_manager.get_friend_remark(3) is None
+            assert await friend_manager.get_friend_remark(3) is None
+            assert await friend_manager.get_friend_remark(4) is None
+
+        asyncio.run(run())
+
+        # uid 3 is refreshed only once, uid 4 is another stranger
+        assert len(httpserver.log) == 2
+
+    def test_stale_while_revalidate(self, httpserver):
+        bot = NapCatBot(
+            {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10}
+        )
+        bot._logged_in = True
+        bot._connected = True
+        friend_manager = NapCatFriendManager(bot, {"friend_list_ttl": 0})
+        self._expect_friend_list(
+            httpserver, [{"user_id": 1, "nickname": "Alice", "remark": ""}]
+        )
+
+        async def run():
+            assert await friend_manager.get_friend_remark(1) == "Alice"
+
+            httpserver.clear()
+            self._expect_friend_list(
+                httpserver, [{"user_id": 1, "nickname": "Alice", "remark": "Ally"}]
+            )
+
+            # The stale remark is served, the refresh runs in the background
+            assert await friend_manager.get_friend_remark(1) == "Alice"
+            await friend_manager._refresh_task
+            assert friend_manager.uid_to_friend[1].remark == "Ally"
+
+        asyncio.run(run())
+
+
+class TestBulkResolution:
+    @staticmethod
+    def _expect_friend_list(httpserver):
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [
+                    {"user_id": 1, "nickname": "Alice", "remark": "Ally"},
+                    {"user_id": 2, "nickname": "Bob", "remark": ""},
+                ],
+            }
+        )
+
+    def test_get_remarks(self, friend_manager: NapCatFriendManager, httpserver):
+        self._expect_friend_list(httpserver)
+        uids = [1, 2, 1, *range(100, 200)]
+
+        async def run():
+            first = await friend_manager.get_remarks(uids)
+            second = await friend_manager.get_remarks(uids)
+            return first, second
+
+        first, second = asyncio.run(run())
+
+        assert first == second
+        assert first[1] == "Ally"
+        assert first[2] == "Bob"
+        assert all(first[uid] is None for uid in range(100, 200))
+        assert len(first) == 102
+        # All the misses share one refresh, the strangers are cached
+        assert len(httpserver.log) == 1
+
+    def test_resolve_contacts(self, friend_manager: NapCatFriendManager, httpserver):
+        self._expect_friend_list(httpserver)
+        for uid in (5, 6):
+            httpserver.expect_request(
+                "/get_stranger_info", json={"user_id": uid}
+            ).respond_with_json(
+                {
+                    "status": "ok",
+                    "retcode": 0,
+                    "data": {"user_id": uid, "nickname": f"stranger-{uid}"},
+                }
+            )
+        httpserver.expect_request("/get_stranger_info").respond_with_json(
+            {"status": "failed", "retcode": 100, "data": None}
+        )
+
+        async def run():
+            first = await friend_manager.resolve_contacts([1, 5, 6, 7])
+            second = await friend_manager.resolve_contacts([1, 5, 6])
+            return first, second
+
+        first, second = asyncio.run(run())
+
+        assert first[1] == {
+            "user_id": 1,
+            "nickname": "Alice",
+            "remark": "Ally",
+            "is_friend": True,
+        }
+        assert first[5] == {
+            "user_id": 5,
+            "nickname": "stranger-5",
+            "remark": None,
+            "is_friend": False,
+        }
+        assert first[7]["nickname"] == "7"
+        assert second == {uid: first[uid] for uid in (1, 5, 6)}
+        # One refresh and one lookup per stranger, nothing for the second call
+        assert len(httpserver.log) == 4
+
+    @staticmethod
+    def _expect_strangers(httpserver):
+        def respond(request):
+            uid = request.get_json()["user_id"]
+            return Response(
+                json.dumps(
+                    {
+                        "status": "ok",
+                        "retcode": 0,
+                        "data": {"user_id": uid, "nickname": f"stranger-{uid}"},
+                    }
+                ),
+                content_type="application/json",
+            )
+
+        httpserver.expect_request("/get_stranger_info").respond_with_handler(respond)
+
+    def test_shared_stranger_lookups(
+        self, friend_manager: NapCatFriendManager, httpserver
+    ):
+        self._expect_friend_list(httpserver)
+        self._expect_strangers(httpserver)
+
+        async def run():
+            return await asyncio.gather(
+                *(friend_manager.resolve_contacts([1, 5, 6]) for _ in range(10))
+            )
+
+        results = asyncio.run(run())
+
+        assert all(result == results[0] for result in results)
+        assert results[0][6]["nickname"] == "stranger-6"
+        # One refresh and one lookup per stranger for all the callers
+        assert len(httpserver.log) == 3
+
+    def test_stranger_cache_size(self, httpserver):
+        bot = NapCatBot(
+            {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10}
+        )
+        bot._logged_in = True
+        bot._connected = True
+        friend_manager = NapCatFriendManager(bot, {"stranger_info_cache_size": 2})
+        self._expect_friend_list(httpserver)
+        self._expect_strangers(httpserver)
+
+        async def run():
+            await friend_manager.resolve_contacts([5, 6])
+            # uid 5 is used again, uid 6 is the least recently used
+            await friend_manager.resolve_contacts([5])
+            await friend_manager.resolve_contacts([7])
+
+        asyncio.run(run())
+
+        assert list(friend_manager._stranger_nicknames) == [5, 7]
+
+    def test_stranger_concurrency(self):
+        config = {
+            "api_root": "http://localhost:6700",
+            "access_token": "",
+            "api_timeout": 10,
+        }
+        bot = NapCatBot({**config, "action_concurrency": {"get_stranger_info": 2}})
+        NapCatFriendManager(bot, {"stranger_info_concurrency": 4})
+        assert bot._dispatcher._action_concurrency["get_stranger_info"] == 2
+
+        bot = NapCatBot(config)
+        NapCatFriendManager(bot, {"stranger_info_concurrency": 4})
+        assert bot._dispatcher._action_concurrency["get_stranger_info"] == 4
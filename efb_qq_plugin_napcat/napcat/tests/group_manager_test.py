@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.group_manager import NapCatGroupManager
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+
+def _group_manager(config=None) -> NapCatGroupManager:
+    bot = NapCatBot(
+        {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10}
+    )
+    bot._logged_in = True
+    bot._connected = True
+
+    return NapCatGroupManager(bot, config)
+
+
+@pytest.fixture
+def group_manager() -> NapCatGroupManager:
+    return _group_manager()
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+def _expect_members(httpserver, group_id, count):
+    httpserver.expect_request(
+        "/get_group_member_list", json={"group_id": group_id, "no_cache": False}
+    ).respond_with_json(
+        {
+            "status": "ok",
+            "retcode": 0,
+            "data": [
+                {
+                    "user_id": uid,
+                    "nickname": f"member-{uid}",
+                    "card": "Card" if uid == 1 else "",
+                }
+                for uid in range(1, count + 1)
+            ],
+        }
+    )
+
+
+class TestGroupList:
+    def test_update_group_list(self, group_manager: NapCatGroupManager, httpserver):
+        httpserver.expect_request("/get_group_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [
+                    {"group_id": 100, "group_name": "A", "member_count": 2000},
+                    {"group_id": 200, "group_name": "B", "member_count": 3},
+                ],
+            }
+        )
+
+        asyncio.run(group_manager.update_group_list())
+
+        assert sorted(group_manager.gid_to_group) == [100, 200]
+        assert asyncio.run(group_manager.get_group_name(200)) == "B"
+        # The member lists are not loaded with the group list
+        assert group_manager.cached_member_groups() == []
+        assert len(httpserver.log) == 1
+
+    def test_unknown_group(self, httpserver):
+        group_manager = _group_manager(
+            {"group_min_refresh_interval": 0, "group_negative_ttl": 600}
+        )
+        httpserver.expect_request("/get_group_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [{"group_id": 100, "group_name": "A", "member_count": 2}],
+            }
+        )
+
+        async def run():
+            # Concurrent misses share one refresh
+            names = await asyncio.gather(
+                group_manager.get_group_name(300),
+                group_manager.get_group_name(400),
+            )
+            # The unknown groups are answered from the negative cache
+            names.append(await group_manager.get_group_name(300))
+            return names
+
+        assert asyncio.run(run()) == [None, None, None]
+        assert len(httpserver.log) == 1
+
+    def test_min_refresh_interval(self, httpserver):
+        group_manager = _group_manager({"group_negative_ttl": 0})
+        httpserver.expect_request("/get_group_list").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": []}
+        )
+
+        assert asyncio.run(group_manager.get_group_name(300)) is None
+        assert asyncio.run(group_manager.get_group_name(400)) is None
+        assert len(httpserver.log) == 1
+
+
+class TestMembers:
+    def test_lazy_load(self, group_manager: NapCatGroupManager, httpserver):
+        _expect_members(httpserver, 100, 2000)
+
+        async def run():
+            return await asyncio.gather(
+                group_manager.get_member_name(100, 1),
+                group_manager.get_member_name(100, 2),
+                group_manager.get_member_name(100, 3),
+            )
+
+        names = asyncio.run(run())
+
+        assert names == ["Card", "member-2", "member-3"]
+        assert group_manager.cached_member_groups() == [100]
+        assert len(httpserver.log) == 1
+
+        asyncio.run(group_manager.get_member_name(100, 4))
+        assert len(httpserver.log) == 1
+
+    def test_new_member(self, group_manager: NapCatGroupManager, httpserver):
+        _expect_members(httpserver, 100, 2)
+        httpserver.expect_request("/get_group_member_info").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": {"user_id": 9, "nickname": "Newbie", "card": ""},
+            }
+        )
+
+        assert asyncio.run(group_manager.get_member_name(100, 9)) == "Newbie"
+        assert asyncio.run(group_manager.get_member_name(100, 9)) == "Newbie"
+        assert len(httpserver.log) == 2
+
+    def test_lru_eviction(self, httpserver):
+        group_manager = _group_manager({"group_member_cache_bytes": 350 * 1024})
+        for group_id in (100, 200, 300):
+            _expect_members(httpserver, group_id, 500)
+
+        async def run():
+            await group_manager.get_member_name(100, 1)
+            await group_manager.get_member_name(200, 1)
+            # Touch group 100, so group 200 is the least recently used
+            await group_manager.get_member_name(100, 2)
+            await group_manager.get_member_name(300, 1)
+
+        asyncio.run(run())
+
+        assert group_manager.cached_member_groups() == [100, 300]
+        assert group_manager.cache_bytes <= 350 * 1024
+        assert len(httpserver.log) == 3
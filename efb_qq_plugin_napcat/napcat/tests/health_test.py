@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatDisconnectedException
+from efb_qq_plugin_napcat.napcat.health import NapCatHealthMonitor
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+
+class TestHealthMonitor:
+    def test_backoff(self):
+        monitor = NapCatHealthMonitor(
+            {"health_retry_min": 2, "health_retry_max": 30, "health_retry_jitter": 0}
+        )
+
+        delays = []
+        for _ in range(6):
+            monitor.mark_down("refused")
+            delays.append(monitor.next_delay())
+
+        assert delays == [2, 4, 8, 16, 30, 30]
+
+        monitor.mark_up()
+        monitor.mark_down("refused")
+
+        assert monitor.next_delay() == 2
+
+    def test_jitter(self):
+        monitor = NapCatHealthMonitor(
+            {"health_retry_min": 10, "health_retry_jitter": 0.5}
+        )
+        monitor.mark_down("refused")
+
+        delays = {monitor.next_delay() for _ in range(20)}
+
+        assert all(5 <= delay <= 15 for delay in delays)
+        assert len(delays) > 1
+
+    def test_liveness(self):
+        monitor = NapCatHealthMonitor({"health_interval": 60})
+
+        assert monitor.should_probe()
+
+        monitor.mark_up()
+        monitor._last_alive -= 59
+        assert not monitor.should_probe()
+
+        monitor.record_alive()
+        assert not monitor.should_probe()
+        assert monitor.next_delay() > 59
+
+        monitor._last_alive -= 60
+        assert monitor.should_probe()
+
+    def test_transitions(self):
+        monitor = NapCatHealthMonitor({})
+        before = time.time()
+
+        monitor.mark_up()
+        monitor.mark_up()
+        monitor.mark_down("refused")
+        monitor.mark_down("refused")
+
+        transitions = monitor.transitions
+        assert [t["state"] for t in transitions] == ["up", "down"]
+        assert transitions[1]["reason"] == "refused"
+        assert before <= transitions[0]["at"] <= transitions[1]["at"] <= time.time()
+        assert monitor.consecutive_failures == 2
+
+    def test_wake_up(self):
+        monitor = NapCatHealthMonitor({"health_interval": 60})
+        monitor.mark_up()
+
+        async def wait():
+            waiter = asyncio.ensure_future(monitor.wait())
+            await asyncio.sleep(0.01)
+            monitor.record_unreachable()
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(wait())
+
+        assert monitor.should_probe()
+
+    def test_wait_up(self):
+        monitor = NapCatHealthMonitor({})
+
+        async def run():
+            waiter = asyncio.ensure_future(monitor.wait_up())
+            monitor.mark_down("refused")
+            await asyncio.sleep(0)
+            assert not waiter.done()
+
+            monitor.mark_up()
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(run())
+
+    def test_no_wake_up_when_down(self):
+        monitor = NapCatHealthMonitor({"health_retry_min": 10})
+
+        async def wait():
+            monitor.mark_up()
+            monitor.record_unreachable()
+            monitor.mark_down("refused")
+            monitor.record_unreachable()
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(monitor.wait(), 0.05)
+
+        asyncio.run(wait())
+
+
+class TestRecovery:
+    def test_restart(self):
+        """
+        NapCat is unreachable for a moment, and is noticed to be up again
+        within the backoff instead of an hour later.
+        """
+
+        bot = NapCatBot(
+            {
+                "api_root": "http://localhost:6700",
+                "access_token": "",
+                "api_timeout": 1,
+                "health_retry_min": 0.05,
+                "health_retry_jitter": 0,
+            }
+        )
+        probes = []
+
+        async def get_status():
+            probes.append(time.monotonic())
+            if len(probes) < 3:
+                raise NapCatDisconnectedException("refused")
+            return {"online": True, "good": True}
+
+        bot._get_status = get_status  # type: ignore[method-assign]
+
+        async def run():
+            task = asyncio.ensure_future(bot.check_status_periodically())
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if bot.is_connected():
+                    break
+            task.cancel()
+
+        asyncio.run(run())
+
+        assert bot.is_connected()
+        assert len(probes) == 3
+        assert [t["state"] for t in bot.health.transitions] == ["down", "up"]
+        assert probes[2] - probes[0] < 0.5
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from aiocqhttp.exceptions import ActionFailed, NetworkError
+
+from efb_qq_plugin_napcat.napcat.http_api import NapCatHttpApi
+
+
+@pytest.fixture
+def api() -> NapCatHttpApi:
+
+    config = {
+        "api_root": "http://localhost:6700",
+        "access_token": "token",
+        "api_timeout": 10,
+    }
+
+    return NapCatHttpApi(config)
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+class TestClient:
+    def test_reuse_client(self, api: NapCatHttpApi, httpserver):
+        httpserver.expect_request(
+            "/get_status", headers={"Authorization": "Bearer token"}
+        ).respond_with_json({"status": "ok", "retcode": 0, "data": {"good": True}})
+
+        async def run():
+            clients = []
+            for _ in range(3):
+                res = await api.call_action("get_status")
+                assert res == {"good": True}
+                clients.append(api.client)
+
+            await api.close()
+            return clients
+
+        clients = asyncio.run(run())
+
+        assert clients[0] is clients[1] is clients[2]
+        assert clients[0].is_closed
+
+    def test_new_loop_new_client(self, api: NapCatHttpApi, httpserver):
+        httpserver.expect_request("/get_status").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": {}}
+        )
+
+        async def run():
+            await api.call_action("get_status")
+            return api.client
+
+        first = asyncio.run(run())
+        second = asyncio.run(run())
+
+        assert first is not second
+
+    def test_close_without_client(self, api: NapCatHttpApi):
+        asyncio.run(api.close())
+
+
+class TestErrors:
+    def test_action_failed(self, api: NapCatHttpApi, httpserver):
+        httpserver.expect_request("/send_msg").respond_with_json(
+            {"status": "failed", "retcode": 100}
+        )
+
+        with pytest.raises(ActionFailed) as ex_info:
+            asyncio.run(api.call_action("send_msg"))
+
+        assert ex_info.value.retcode == 100
+
+    def test_network_error(self):
+        api = NapCatHttpApi(
+            {"api_root": "http://localhost:1", "access_token": "", "api_timeout": 1}
+        )
+
+        with pytest.raises(NetworkError):
+            asyncio.run(api.call_action("get_status"))
@@ -0,0 +1,109 @@
+import json
+from typing import TypedDict
+
+import pytest
+from aiocqhttp.exceptions import ActionFailed
+
+from efb_qq_plugin_napcat.napcat import json_decoder
+from efb_qq_plugin_napcat.napcat.json_decoder import NapCatJsonDecoder, select_backend
+
+BACKENDS = [
+    backend
+    for backend in ("json", "orjson", "msgspec")
+    if backend == "json" or json_decoder._installed(backend)
+]
+
+
+class _Friend(TypedDict):
+    user_id: int
+    nickname: str
+
+
+def _friend_list_body(user_id=10001) -> bytes:
+    return json.dumps(
+        {
+            "status": "ok",
+            "retcode": 0,
+            "data": [
+                {"user_id": user_id, "nickname": "a", "sex": "unknown", "level": 1},
+            ],
+            "message": "",
+            "wording": "",
+        }
+    ).encode()
+
+
+class TestSelectBackend:
+    def test_select(self, monkeypatch):
+        assert select_backend({"json_backend": "json"}) == "json"
+        with pytest.raises(ValueError):
+            select_backend({"json_backend": "simdjson"})
+
+        monkeypatch.setattr(json_decoder, "_installed", lambda package: False)
+        assert select_backend({}) == "json"
+        assert select_backend({"json_backend": "msgspec"}) == "json"
+
+        monkeypatch.setattr(
+            json_decoder, "_installed", lambda package: package == "orjson"
+        )
+        assert select_backend({}) == "orjson"
+        assert select_backend({"json_backend": "msgspec"}) == "orjson"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+class TestDecoder:
+    def test_decode_result(self, backend):
+        decoder = NapCatJsonDecoder({"json_backend": backend})
+        decoder.register("get_friend_list", list[_Friend])
+
+        friends = decoder.decode_result("get_friend_list", _friend_list_body())
+
+        assert friends[0]["user_id"] == 10001
+        assert friends[0]["nickname"] == "a"
+        if backend == "msgspec":
+            # The fields not in the schema are skipped
+            assert friends == [{"user_id": 10001, "nickname": "a"}]
+            assert decoder.stats["typed"] == 1
+
+        # An action without a schema is decoded as it is
+        assert decoder.decode_result("get_login_info", _friend_list_body()) == [
+            {"user_id": 10001, "nickname": "a", "sex": "unknown", "level": 1}
+        ]
+
+    def test_schema_mismatch(self, backend):
+        decoder = NapCatJsonDecoder({"json_backend": backend})
+        decoder.register("get_friend_list", list[_Friend])
+
+        friends = decoder.decode_result("get_friend_list", _friend_list_body("10001"))
+
+        assert friends[0]["user_id"] == "10001"
+        if backend == "msgspec":
+            assert decoder.stats["fallbacks"] == 1
+
+    def test_failed(self, backend):
+        decoder = NapCatJsonDecoder({"json_backend": backend})
+        decoder.register("get_friend_list", list[_Friend])
+        body = b'{"status": "failed", "retcode": 1400, "data": null, "message": null}'
+
+        with pytest.raises(ActionFailed) as e:
+            decoder.decode_result("get_friend_list", body)
+        assert e.value.retcode == 1400
+
+    def test_decode_frame(self, backend):
+        decoder = NapCatJsonDecoder({"json_backend": backend})
+        decoder.register("get_friend_list", list[_Friend])
+
+        event = b'{"post_type": "message", "message_id": 1, "echo": "x"}'
+        assert decoder.decode_frame(event) == (
+            None,
+            {"post_type": "message", "message_id": 1, "echo": "x"},
+        )
+
+        raw = _friend_list_body()[:-1] + b', "echo": 7}'
+        echo, frame = decoder.decode_frame(raw)
+        assert echo == "7"
+        assert decoder.decode_result("get_friend_list", frame)[0]["nickname"] == "a"
+
+        assert decoder.decode_frame(b"[]") == (None, None)
+        with pytest.raises(ValueError):
+            decoder.decode_frame(b"{")
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.exceptions import (
+    NapCatDisconnectedException,
+    NapCatTimeoutException,
+)
+from efb_qq_plugin_napcat.napcat.loop_bridge import NapCatLoopBridge
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield loop
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+class TestBridge:
+    def test_call(self, loop):
+        bridge = NapCatLoopBridge(loop, {})
+
+        async def add(a, b):
+            await asyncio.sleep(0.01)
+            assert asyncio.get_running_loop() is loop
+            return a + b
+
+        assert bridge.call(add(1, 2)) == 3
+        assert bridge.stats["calls"] == 1
+        assert bridge.stats["call_wait_max"] > 0
+
+    def test_exception(self, loop):
+        bridge = NapCatLoopBridge(loop, {})
+
+        async def failed():
+            raise ValueError("failed")
+
+        with pytest.raises(ValueError):
+            bridge.call(failed())
+
+    def test_timeout_cancels(self, loop):
+        bridge = NapCatLoopBridge(loop, {})
+        cancelled = threading.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(NapCatTimeoutException):
+            bridge.call(slow(), timeout=0.05)
+
+        assert cancelled.wait(1)
+        assert bridge.stats["timeouts"] == 1
+
+    def test_slow_call_blocks_only_its_caller(self, loop):
+        bridge = NapCatLoopBridge(loop, {})
+
+        async def sleep(seconds):
+            await asyncio.sleep(seconds)
+            return seconds
+
+        slow = threading.Thread(target=bridge.call, args=(sleep(0.5),))
+        slow.start()
+
+        start = time.perf_counter()
+        assert bridge.call(sleep(0.01)) == 0.01
+        assert time.perf_counter() - start < 0.3
+
+        slow.join()
+
+    def test_fire_and_forget(self, loop):
+        bridge = NapCatLoopBridge(loop, {})
+        done = threading.Event()
+
+        async def work():
+            await asyncio.sleep(0.05)
+            done.set()
+
+        start = time.perf_counter()
+        bridge.fire_and_forget(work())
+        assert time.perf_counter() - start < 0.05
+
+        assert done.wait(1)
+
+    def test_call_in_loop_thread(self, loop):
+        bridge = NapCatLoopBridge(loop, {})
+
+        async def nested():
+            async def inner():
+                return 1
+
+            return bridge.call(inner())
+
+        with pytest.raises(RuntimeError):
+            bridge.call(nested())
+
+    def test_loop_not_running(self):
+        loop = asyncio.new_event_loop()
+        bridge = NapCatLoopBridge(loop, {"bridge_timeout": 60})
+
+        async def never():
+            raise AssertionError
+
+        start = time.perf_counter()
+        with pytest.raises(NapCatDisconnectedException):
+            bridge.call(never())
+        assert time.perf_counter() - start < 1
+        assert bridge.stats["calls"] == 0
+
+        loop.close()
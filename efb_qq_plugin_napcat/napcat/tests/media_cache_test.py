@@ -0,0 +1,127 @@
+import hashlib
+import os
+from pathlib import Path
+
+from efb_qq_plugin_napcat.napcat.media_cache import NapCatMediaCache, media_key
+
+
+def _download(tmp_path: Path, data: bytes, suffix: str = ".jpg") -> Path:
+    path = tmp_path / f"download-{os.urandom(4).hex()}{suffix}"
+    path.write_bytes(data)
+
+    return path
+
+
+class TestMediaKey:
+    def test_md5_file_name(self):
+        key = media_key({"file": "0A1B2C3D4E5F60718293A4B5C6D7E8F9.jpg"})
+
+        assert key == "0a1b2c3d4e5f60718293a4b5c6d7e8f9"
+
+    def test_file_id(self):
+        key = media_key({"file": "report.pdf", "file_id": "/abc-123"})
+
+        assert key == hashlib.sha1(b"file_id:/abc-123").hexdigest()
+
+    def test_plain_file_name(self):
+        assert media_key({"file": "report.pdf"}) is None
+
+
+class TestMediaCache:
+    def test_lookup(self, tmp_path: Path):
+        cache = NapCatMediaCache(tmp_path / "cache", {})
+
+        assert cache.lookup("a" * 32) is None
+
+        path = cache.put("a" * 32, _download(tmp_path, b"sticker"))
+
+        assert path == tmp_path / "cache" / ("a" * 32 + ".jpg")
+        assert cache.lookup("a" * 32) == path
+        assert path.read_bytes() == b"sticker"
+        assert cache.hit_rate == 0.5
+        assert cache.stats["entries"] == 1
+        assert cache.stats["bytes"] == 7
+
+    def test_lru_eviction(self, tmp_path: Path):
+        cache = NapCatMediaCache(tmp_path / "cache", {"media_cache_bytes": 250})
+
+        first = cache.put("1" * 32, _download(tmp_path, b"x" * 100))
+        cache.put("2" * 32, _download(tmp_path, b"x" * 100))
+        cache.lookup("1" * 32)
+        cache.put("3" * 32, _download(tmp_path, b"x" * 100))
+
+        assert cache.lookup("2" * 32) is None
+        assert cache.lookup("1" * 32) == first
+        assert cache.stats["evictions"] == 1
+        assert cache.stats["bytes"] == 200
+        assert sorted(p.stem for p in (tmp_path / "cache").iterdir()) == [
+            "1" * 32,
+            "3" * 32,
+        ]
+
+    def test_pinned(self, tmp_path: Path):
+        cache = NapCatMediaCache(tmp_path / "cache", {"media_cache_bytes": 150})
+
+        first = cache.put("1" * 32, _download(tmp_path, b"x" * 100))
+        assert cache.pin("1" * 32) == first
+        cache.put("2" * 32, _download(tmp_path, b"x" * 100))
+
+        # The pinned media outlives the budget until it is unpinned
+        assert first.exists()
+        assert cache.stats["bytes"] == 200
+
+        cache.unpin(first)
+        assert not first.exists()
+        assert cache.stats["evictions"] == 1
+        assert cache.lookup("2" * 32) is not None
+
+    def test_hot_set(self, tmp_path: Path):
+        cache = NapCatMediaCache(
+            tmp_path / "cache", {"media_hot_min_hits": 2, "media_hot_item_bytes": 10}
+        )
+        small = cache.put("1" * 32, _download(tmp_path, b"small"))
+        large = cache.put("2" * 32, _download(tmp_path, b"x" * 100))
+
+        for _ in range(3):
+            cache.lookup("1" * 32)
+            cache.lookup("2" * 32)
+
+        assert cache.read_hot(small) == b"small"
+        assert cache.read_hot(large) is None
+        assert cache.open(small).read() == b"small"
+        assert cache.stats["hot_hits"] == 1
+
+    def test_add_file(self, tmp_path: Path):
+        cache = NapCatMediaCache(tmp_path / "cache", {})
+        path = _download(tmp_path, b"meme", ".gif")
+
+        cached = cache.add_file(path)
+
+        assert cached.name == hashlib.md5(b"meme").hexdigest() + ".gif"
+        assert path.exists()
+        assert cache.add_file(path) == cached
+        assert cache.add_file(cached) == cached
+        assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    def test_restart(self, tmp_path: Path):
+        cache = NapCatMediaCache(tmp_path / "cache", {})
+        cache.load()
+        first = cache.put("1" * 32, _download(tmp_path, b"first"))
+        second = cache.put("2" * 32, _download(tmp_path, b"second"))
+        cache.lookup("1" * 32)
+        cache.save()
+
+        # Cached after the index was saved, and left behind by a crash
+        third = cache.put("3" * 32, _download(tmp_path, b"third"))
+        (tmp_path / "cache" / "half-written.tmp").write_bytes(b"x")
+
+        restarted = NapCatMediaCache(
+            tmp_path / "cache", {"media_cache_bytes": len(b"firstthird")}
+        )
+        restarted.load()
+
+        assert restarted.lookup("1" * 32) == first
+        assert restarted.lookup("3" * 32) == third
+        assert restarted.lookup("2" * 32) is None
+        assert not second.exists()
+        assert not (tmp_path / "cache" / "half-written.tmp").exists()
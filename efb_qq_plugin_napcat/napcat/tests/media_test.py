@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import os
+from pathlib import Path
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatMediaException
+from efb_qq_plugin_napcat.napcat.media import NapCatMediaIO
+from efb_qq_plugin_napcat.napcat.media_cache import NapCatMediaCache
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+
+def _media(tmp_path: Path, **config) -> NapCatMediaIO:
+    config = {
+        "api_root": "http://localhost:6700",
+        "access_token": "",
+        "api_timeout": 10,
+    } | config
+
+    return NapCatMediaIO(NapCatBot(config), config, tmp_path / "media")
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+class TestDownload:
+    def test_download(self, tmp_path: Path, httpserver):
+        data = os.urandom(300 * 1024)
+        httpserver.expect_request("/image").respond_with_data(data)
+        media = _media(tmp_path, media_chunk_size=4096)
+
+        path = asyncio.run(media.download(httpserver.url_for("/image"), ".jpg"))
+
+        assert path.suffix == ".jpg"
+        assert path.parent == tmp_path / "media"
+        assert path.read_bytes() == data
+
+    def test_no_access_token(self, tmp_path: Path, httpserver):
+        httpserver.expect_request("/image").respond_with_data(b"x")
+        media = _media(tmp_path, access_token="token")
+
+        asyncio.run(media.download(httpserver.url_for("/image")))
+
+        # The media are downloaded from the QQ CDN, not from NapCat
+        request, _ = httpserver.log[0]
+        assert "Authorization" not in request.headers
+
+    def test_too_large(self, tmp_path: Path, httpserver):
+        httpserver.expect_request("/video").respond_with_data(b"x" * 10000)
+        media = _media(tmp_path, media_max_size=1000)
+
+        with pytest.raises(NapCatMediaException):
+            asyncio.run(media.download(httpserver.url_for("/video")))
+
+        assert list((tmp_path / "media").iterdir()) == []
+
+    def test_not_found(self, tmp_path: Path, httpserver):
+        httpserver.expect_request("/missing").respond_with_data("", status=404)
+        media = _media(tmp_path)
+
+        with pytest.raises(NapCatMediaException):
+            asyncio.run(media.download(httpserver.url_for("/missing")))
+
+
+class TestTemporary:
+    def test_release(self, tmp_path: Path, httpserver):
+        httpserver.expect_request("/image").respond_with_data(b"x")
+        media = _media(tmp_path)
+        segment = {"file": "a.jpg", "url": httpserver.url_for("/image")}
+
+        async def run():
+            path = await media.fetch(segment)
+            file = media.open(path)
+            assert path.exists()
+
+            await media.release(path, file)
+            return path, file
+
+        path, file = asyncio.run(run())
+
+        assert file.closed
+        assert not path.exists()
+
+    def test_purge_stale(self, tmp_path: Path):
+        media_dir = tmp_path / "media"
+        media_dir.mkdir()
+        stale = media_dir / "stale.jpg"
+        stale.write_bytes(b"x")
+        os.utime(stale, (0, 0))
+        fresh = media_dir / "fresh.jpg"
+        fresh.write_bytes(b"x")
+
+        _media(tmp_path, media_temp_ttl=3600).purge_stale()
+
+        assert list(media_dir.iterdir()) == [fresh]
+
+
+class TestFileUri:
+    def test_local(self, tmp_path: Path):
+        path = tmp_path / "a.png"
+        path.write_bytes(b"png")
+        media = _media(tmp_path)
+
+        assert media.local_path
+        assert media.file_uri(path) == path.as_uri()
+
+    def test_remote(self, tmp_path: Path):
+        path = tmp_path / "a.bin"
+        data = os.urandom(2 * 1024 * 1024 + 1)
+        path.write_bytes(data)
+        media = _media(tmp_path, api_root="http://napcat.example.com:3000")
+
+        uri = media.file_uri(path)
+
+        assert not media.local_path
+        assert base64.b64decode(uri.removeprefix("base64://")) == data
+
+    def test_file_segment(self, tmp_path: Path):
+        path = tmp_path / "report.pdf"
+        path.write_bytes(b"pdf")
+        media = _media(tmp_path, media_local_path=True)
+
+        assert media.media_segment("file", path) == {
+            "type": "file",
+            "data": {"file": path.as_uri(), "name": "report.pdf"},
+        }
+
+
+class TestCachedFetch:
+    def test_fetch(self, tmp_path: Path, httpserver):
+        data = os.urandom(1024)
+        httpserver.expect_request("/sticker").respond_with_data(data)
+        config = {
+            "api_root": "http://localhost:6700",
+            "access_token": "",
+            "api_timeout": 10,
+        }
+        cache = NapCatMediaCache(tmp_path / "cache", config)
+        media = NapCatMediaIO(NapCatBot(config), config, tmp_path / "media", cache)
+        segment = {
+            "file": "0A1B2C3D4E5F60718293A4B5C6D7E8F9.gif",
+            "url": httpserver.url_for("/sticker"),
+        }
+
+        async def fetch_many():
+            return await asyncio.gather(*[media.fetch(segment) for _ in range(5)])
+
+        paths = asyncio.run(fetch_many())
+        path = asyncio.run(media.fetch(segment))
+
+        assert set(paths) == {path}
+        assert path.parent == tmp_path / "cache"
+        assert path.read_bytes() == data
+        assert len(httpserver.log) == 1
+        assert (cache.stats["hits"], cache.stats["misses"]) == (1, 5)
+
+    def test_pinned_until_released(self, tmp_path: Path, httpserver):
+        httpserver.expect_request("/sticker").respond_with_data(b"x" * 100)
+        config = {
+            "api_root": "http://localhost:6700",
+            "access_token": "",
+            "api_timeout": 10,
+            "media_cache_bytes": 150,
+        }
+        cache = NapCatMediaCache(tmp_path / "cache", config)
+        media = NapCatMediaIO(NapCatBot(config), config, tmp_path / "media", cache)
+        segment = {
+            "file": "0A1B2C3D4E5F60718293A4B5C6D7E8F9.gif",
+            "url": httpserver.url_for("/sticker"),
+        }
+
+        async def run():
+            path = await media.fetch(segment)
+            # Another media pushes the cache over its budget
+            other = tmp_path / "other.jpg"
+            other.write_bytes(b"y" * 100)
+            cache.add_file(other)
+            assert path.exists()
+
+            await media.release(path, media.open(path))
+            return path
+
+        path = asyncio.run(run())
+
+        assert not path.exists()
+        assert cache.stats["evictions"] == 1
@@ -0,0 +1,79 @@
+import time
+from pathlib import Path
+
+from efb_qq_plugin_napcat.napcat.message_index import NapCatMessageIndex
+
+
+class TestMessageIndex:
+    def test_lookup(self):
+        index = NapCatMessageIndex(None, {})
+        index.record("101", "101", "group_1", "2")
+
+        record = index.by_qq_id("101")
+        assert record is not None
+        assert (record.efb_uid, record.chat_uid, record.author_uid) == (
+            "101",
+            "group_1",
+            "2",
+        )
+        assert index.by_efb_uid("101") is record
+        assert index.by_qq_id("102") is None
+
+        assert index.resolve_qq_id("101") == "101"
+        # The messages before the index are taken as the QQ ids
+        assert index.resolve_qq_id("102") == "102"
+        assert index.resolve_qq_id("outbox_1") is None
+
+        assert index.stats["hits"] == 3
+        assert index.stats["misses"] == 3
+
+    def test_edit_and_outbox(self):
+        index = NapCatMessageIndex(None, {})
+
+        # Buffered in the outbox, then edited and buffered again
+        index.record("outbox_1", "outbox_1", "private_1", "__self__")
+        index.record("outbox_1", "outbox_2", "private_1", "__self__")
+        assert index.by_qq_id("outbox_1") is None
+
+        index.reassign_qq_id("outbox_2", "201")
+        assert index.resolve_qq_id("outbox_1") == "201"
+        assert index.by_qq_id("201").efb_uid == "outbox_1"
+        assert index.reassign_qq_id("outbox_3", "202") is None
+
+    def test_memory_bound(self):
+        index = NapCatMessageIndex(None, {"message_index_memory": 10})
+        for i in range(100):
+            index.record(str(i), str(i), "private_1", "1")
+
+        assert len(index._by_qq_id) == 10
+        assert len(index._by_efb_uid) == 10
+
+        # The older messages are read from the database
+        assert index.by_qq_id("0").efb_uid == "0"
+        assert index.stats["disk_hits"] == 1
+        assert index.by_qq_id("0") is not None
+        assert index.stats["hits"] == 1
+
+    def test_retention(self, tmp_path: Path):
+        path = tmp_path / "messages.sqlite3"
+        index = NapCatMessageIndex(path, {})
+        for i in range(100):
+            index.record(str(i), str(i), "private_1", "1", created_at=time.time() + i)
+        index.record("old", "1000", "private_1", "1", created_at=time.time() - 3600)
+        index.close()
+
+        # The records survive a restart, within the retention and the limit
+        index = NapCatMessageIndex(
+            path,
+            {
+                "message_index_memory": 0,
+                "message_index_retention": 600,
+                "message_index_max_records": 50,
+            },
+        )
+        assert len(index) == 50
+        assert index.by_qq_id("99").efb_uid == "99"
+        assert index.by_qq_id("10") is None
+        assert index.by_qq_id("1000") is None
+        assert index.stats["pruned"] == 51
+        index.close()
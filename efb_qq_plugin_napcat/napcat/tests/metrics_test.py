@@ -0,0 +1,192 @@
+import asyncio
+
+import httpx
+import pytest
+
+from efb_qq_plugin_napcat.napcat.exceptions import (
+    NapCatAPIFailureException,
+    NapCatDisconnectedException,
+)
+from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager
+from efb_qq_plugin_napcat.napcat.metrics import (
+    CompositeSink,
+    InMemoryMetrics,
+    MetricsSink,
+    create_metrics_sink,
+    error_labels,
+    find_in_memory_metrics,
+    serve_prometheus,
+)
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+
+
+def _bot(**config) -> NapCatBot:
+    bot = NapCatBot(
+        {
+            "api_root": "http://localhost:6700",
+            "access_token": "",
+            "api_timeout": 10,
+            "metrics": True,
+        }
+        | config
+    )
+    bot._logged_in = True
+    bot._connected = True
+
+    return bot
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+class TestInMemoryMetrics:
+    def test_histogram(self):
+        metrics = InMemoryMetrics(buckets=(0.1, 1.0))
+
+        for seconds in (0.05, 0.5, 0.7, 5.0):
+            token = metrics.action_started("get_status")
+            metrics.action_finished("get_status", token, seconds, None)
+
+        histogram = metrics.snapshot()["actions"]["get_status"]
+        assert histogram["count"] == 4
+        assert histogram["sum"] == pytest.approx(6.25)
+        assert histogram["buckets"] == {0.1: 1, 1.0: 3}
+        assert metrics.snapshot()["in_flight"] == {"get_status": 0}
+
+    def test_error_labels(self):
+        assert error_labels(NapCatAPIFailureException(None, 100)) == (
+            "NapCatAPIFailureException",
+            "",
+            "100",
+        )
+        assert error_labels(NapCatDisconnectedException("refused")) == (
+            "NapCatDisconnectedException",
+            "",
+            "",
+        )
+
+    def test_prometheus_text(self):
+        metrics = InMemoryMetrics(buckets=(0.1,))
+        metrics.action_finished(
+            "send_msg", metrics.action_started("send_msg"), 0.05, None
+        )
+        metrics.operation_finished(
+            "friend_manager.update_friend_list", 0.2, NapCatAPIFailureException(500)
+        )
+        metrics.cache_lookup("friend_remark", True)
+        metrics.cache_lookup("friend_remark", False)
+
+        text = metrics.prometheus_text()
+
+        assert 'napcat_action_seconds_bucket{action="send_msg",le="0.1"} 1' in text
+        assert 'napcat_action_seconds_count{action="send_msg"} 1' in text
+        assert (
+            'napcat_errors_total{name="friend_manager.update_friend_list",'
+            'error="NapCatAPIFailureException",status_code="500",retcode=""} 1'
+        ) in text
+        assert 'napcat_cache_requests_total{cache="friend_remark",result="hit"} 1' in text
+        assert metrics.cache_hit_rate("friend_remark") == 0.5
+
+    def test_serve_prometheus(self):
+        metrics = InMemoryMetrics()
+        metrics.cache_lookup("media", True)
+
+        async def scrape():
+            server = await serve_prometheus(metrics, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with httpx.AsyncClient() as client:
+                resp = await client.get(f"http://127.0.0.1:{port}/metrics")
+            server.close()
+            await server.wait_closed()
+            return resp
+
+        resp = asyncio.run(scrape())
+
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/plain")
+        assert 'napcat_cache_requests_total{cache="media",result="hit"} 1' in resp.text
+
+
+class TestSink:
+    def test_disabled(self):
+        assert create_metrics_sink({}) is None
+        assert (
+            NapCatBot(
+                {
+                    "api_root": "http://localhost:6700",
+                    "access_token": "",
+                    "api_timeout": 1,
+                }
+            ).metrics
+            is None
+        )
+
+    def test_composite(self):
+        class Spans(MetricsSink):
+            def __init__(self):
+                self.finished = []
+
+            def action_started(self, action):
+                return f"span {action}"
+
+            def action_finished(self, action, token, seconds, exception):
+                self.finished.append(token)
+
+        metrics = InMemoryMetrics()
+        spans = Spans()
+        sink = CompositeSink([metrics, spans])
+        sink.action_finished("get_status", sink.action_started("get_status"), 0.1, None)
+
+        assert spans.finished == ["span get_status"]
+        assert find_in_memory_metrics(sink) is metrics
+        assert metrics.snapshot()["actions"]["get_status"]["count"] == 1
+
+
+class TestInstrumentation:
+    def test_actions(self, httpserver):
+        httpserver.expect_request("/get_status").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": {"online": True, "good": True}}
+        )
+        httpserver.expect_request("/send_msg").respond_with_json(
+            {"status": "failed", "retcode": 1200}
+        )
+        bot = _bot()
+
+        async def run():
+            await bot.call_action("get_status")
+            with pytest.raises(NapCatAPIFailureException):
+                await bot.call_action("send_msg", user_id=1, message="hi")
+
+        asyncio.run(run())
+
+        snapshot = bot.metrics.snapshot()
+        assert snapshot["actions"]["get_status"]["count"] == 1
+        assert snapshot["actions"]["send_msg"]["count"] == 1
+        assert snapshot["errors"] == {
+            "send_msg": {("NapCatAPIFailureException", "", "1200"): 1}
+        }
+        assert snapshot["in_flight"] == {"get_status": 0, "send_msg": 0}
+
+    def test_managers(self, httpserver):
+        httpserver.expect_request("/get_friend_list").respond_with_json(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": [{"user_id": 1, "nickname": "a", "remark": "A"}],
+            }
+        )
+        bot = _bot()
+        friend_manager = NapCatFriendManager(bot)
+
+        async def run():
+            await friend_manager.get_friend_remark(1)
+            await friend_manager.get_friend_remark(1)
+
+        asyncio.run(run())
+
+        snapshot = bot.metrics.snapshot()
+        assert snapshot["operations"]["friend_manager.update_friend_list"]["count"] == 1
+        assert snapshot["cache_hits"] == {"friend_remark": 1}
+        assert snapshot["cache_misses"] == {"friend_remark": 1}
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import pytest
+from werkzeug import Response
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatOfflineException
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.outbox import NapCatOutbox, is_queued
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+class TestOutbox:
+    def test_order(self):
+        outbox = NapCatOutbox(None, {})
+
+        first = outbox.push("send_msg", {"user_id": 1, "message": "a"})
+        second = outbox.push("delete_msg", {"message_id": 2})
+
+        entry = outbox.peek()
+        assert entry is not None
+        assert entry["outbox_id"] == first["outbox_id"]
+        assert entry["params"] == {"user_id": 1, "message": "a"}
+
+        outbox.remove(first["outbox_id"], replayed=True)
+        entry = outbox.peek()
+        assert entry is not None
+        assert entry["outbox_id"] == second["outbox_id"]
+        assert outbox.stats["size"] == 1
+        assert outbox.stats["replayed"] == 1
+
+    def test_full(self):
+        outbox = NapCatOutbox(None, {"outbox_max_size": 2})
+        outbox.push("send_msg", {})
+        outbox.push("send_msg", {})
+
+        with pytest.raises(NapCatOfflineException):
+            outbox.push("send_msg", {})
+
+        assert outbox.stats["rejected"] == 1
+        assert len(outbox) == 2
+
+    def test_durable(self, tmp_path: Path):
+        outbox = NapCatOutbox(tmp_path / "outbox.sqlite3", {})
+        outbox.push("send_msg", {"group_id": 1, "message": "hello"})
+        cancelled = outbox.push("send_msg", {"group_id": 1, "message": "oops"})
+        assert outbox.cancel(cancelled["outbox_id"])
+        outbox.close()
+
+        reopened = NapCatOutbox(tmp_path / "outbox.sqlite3", {})
+        entry = reopened.peek()
+
+        assert len(reopened) == 1
+        assert entry is not None
+        assert entry["params"] == {"group_id": 1, "message": "hello"}
+        assert reopened.push("send_msg", {})["outbox_id"] > cancelled["outbox_id"]
+
+
+class TestBufferAndReplay:
+    def test_replay(self, httpserver):
+        outbox = NapCatOutbox(None, {"outbox_replay_rate": 0})
+        bot = NapCatBot(
+            {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 5},
+            outbox,
+        )
+        sent = []
+        replayed = []
+        bot.on_replayed(lambda entry, res: replayed.append((entry["outbox_id"], res)))
+
+        def send_msg(request):
+            sent.append(request.get_json()["message"])
+            return Response(
+                json.dumps(
+                    {"status": "ok", "retcode": 0, "data": {"message_id": len(sent)}}
+                ),
+                content_type="application/json",
+            )
+
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        httpserver.expect_request("/get_status").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": {"online": True, "good": True}}
+        )
+
+        async def run():
+            # Offline: the read-only actions fail fast, the others are buffered
+            assert await bot.call_action("get_friend_list") is None
+            responses = [
+                await bot.call_action("send_msg", user_id=1, message=str(i))
+                for i in range(3)
+            ]
+            assert all(is_queued(response) for response in responses)
+            assert sent == []
+
+            await bot.check_status_periodically(run_once=True)
+            # Sent during the replay, so it is buffered after the others
+            response = await bot.call_action("send_msg", user_id=1, message="3")
+            assert is_queued(response)
+
+            await bot._replay_task
+            assert await bot.call_action("send_msg", user_id=1, message="4") == {
+                "message_id": 5
+            }
+            await bot.close()
+
+        asyncio.run(run())
+
+        assert sent == ["0", "1", "2", "3", "4"]
+        assert replayed == [(i + 1, {"message_id": i + 1}) for i in range(4)]
+        assert outbox.stats["replayed"] == 4
+        assert outbox.stats["size"] == 0
+        assert outbox.replay_throughput > 0
+
+    @staticmethod
+    def _unreachable_bot(outbox):
+        # Nothing listens on the port
+        bot = NapCatBot(
+            {"api_root": "http://localhost:6799", "access_token": "", "api_timeout": 5},
+            outbox,
+        )
+        bot._logged_in = True
+        bot._connected = True
+        return bot
+
+    def test_buffer_on_disconnect(self):
+        outbox = NapCatOutbox(None, {"outbox_replay_rate": 0})
+        bot = self._unreachable_bot(outbox)
+
+        async def run():
+            # The message is buffered instead of lost
+            response = await bot.call_action("send_msg", user_id=1, message="0")
+            assert is_queued(response)
+            await bot.close()
+
+        asyncio.run(run())
+
+        assert bot.health.state == "down"
+        assert len(outbox) == 1
+        assert outbox.peek()["params"]["message"] == "0"
+
+    def test_buffer_on_circuit_open(self):
+        outbox = NapCatOutbox(None, {"outbox_replay_rate": 0})
+        bot = self._unreachable_bot(outbox)
+        bot._breaker._state = "open"
+        bot._breaker._opened_at = time.monotonic()
+
+        async def run():
+            response = await bot.call_action("send_msg", user_id=1, message="0")
+            assert is_queued(response)
+            await bot.close()
+
+        asyncio.run(run())
+
+        assert bot.retry_stats["circuit_rejected"] == 1
+        assert len(outbox) == 1
@@ -0,0 +1,213 @@
+import asyncio
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.exceptions import (
+    NapCatAPIFailureException,
+    NapCatCircuitOpenException,
+    NapCatDisconnectedException,
+)
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.retry import (
+    CircuitBreaker,
+    RetryPolicies,
+    RetryPolicy,
+    RetryStats,
+)
+
+
+def _stats() -> RetryStats:
+    return RetryStats(retries=0, circuit_opened=0, circuit_rejected=0)
+
+
+class TestRetryPolicy:
+    def test_network_errors(self):
+        policy = RetryPolicy({})
+        refused = NapCatDisconnectedException("refused")
+
+        assert policy.should_retry("get_friend_list", refused, 1)
+        assert policy.should_retry("get_friend_list", refused, 2)
+        assert not policy.should_retry("get_friend_list", refused, 3)
+        # The message may have been sent already
+        assert not policy.should_retry("send_msg", refused, 1)
+        assert not policy.should_retry(
+            "get_friend_list", NapCatCircuitOpenException("open"), 1
+        )
+
+        assert RetryPolicy({"retry_state_changing": True}).should_retry(
+            "send_msg", refused, 1
+        )
+        assert not RetryPolicy({"retry_network_errors": False}).should_retry(
+            "get_friend_list", refused, 1
+        )
+
+    def test_codes(self):
+        policy = RetryPolicy({"retry_retcodes": [1200]})
+        unavailable = NapCatAPIFailureException(503)
+
+        assert policy.should_retry("get_friend_list", unavailable, 1)
+        assert not policy.should_retry(
+            "get_friend_list", NapCatAPIFailureException(403), 1
+        )
+        # The message may have been sent before the gateway failed
+        assert not policy.should_retry("send_msg", unavailable, 1)
+        assert RetryPolicy({"retry_state_changing": True}).should_retry(
+            "send_msg", unavailable, 1
+        )
+        # NapCat rejected the message, it was not sent
+        assert policy.should_retry("send_msg", NapCatAPIFailureException(None, 1200), 1)
+        assert not policy.should_retry(
+            "send_msg", NapCatAPIFailureException(None, 100), 1
+        )
+
+    def test_backoff(self):
+        policy = RetryPolicy({"backoff": 0.1, "backoff_max": 0.3})
+
+        assert 0.09 <= policy.delay(1) <= 0.11
+        assert 0.18 <= policy.delay(2) <= 0.22
+        assert 0.27 <= policy.delay(5) <= 0.33
+
+    def test_per_action(self):
+        policies = RetryPolicies(
+            {
+                "retry_policy": {"max_attempts": 5},
+                "retry_policies": {"send_msg": {"retry_state_changing": True}},
+            }
+        )
+
+        assert policies.get("get_friend_list").max_attempts == 5
+        assert policies.get("send_msg").max_attempts == 5
+        assert policies.get("send_msg").retry_state_changing
+        assert not policies.get("get_friend_list").retry_state_changing
+
+
+class TestCircuitBreaker:
+    def test_open_and_close(self):
+        stats = _stats()
+        breaker = CircuitBreaker(
+            {"circuit_failure_threshold": 3, "circuit_reset_timeout": 0.05}, stats
+        )
+
+        for _ in range(3):
+            breaker.before_call()
+            breaker.record_failure()
+        assert breaker.state == "open"
+
+        with pytest.raises(NapCatCircuitOpenException):
+            breaker.before_call()
+
+        breaker._opened_at -= 0.05
+        # A single probe is let through
+        breaker.before_call()
+        assert breaker.state == "half_open"
+        with pytest.raises(NapCatCircuitOpenException):
+            breaker.before_call()
+
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+        breaker._opened_at -= 0.05
+        breaker.before_call()
+        breaker.record_success()
+        assert breaker.state == "closed"
+        breaker.before_call()
+
+        assert stats == RetryStats(retries=0, circuit_opened=2, circuit_rejected=2)
+
+    def test_abort(self):
+        breaker = CircuitBreaker(
+            {"circuit_failure_threshold": 1, "circuit_reset_timeout": 0}, _stats()
+        )
+        breaker.record_failure()
+
+        breaker.before_call()
+        breaker.record_abort()
+        breaker.before_call()
+
+        assert breaker.state == "half_open"
+
+    def test_reachable_failures(self):
+        breaker = CircuitBreaker({"circuit_failure_threshold": 2}, _stats())
+
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        assert breaker.state == "closed"
+
+
+class TestBotRetry:
+    def _bot(self, **config):
+        return NapCatBot(
+            {
+                "api_root": "http://localhost:6700",
+                "access_token": "",
+                "api_timeout": 1,
+                "retry_policy": {"backoff": 0.001},
+            }
+            | config
+        )
+
+    def test_retry(self):
+        bot = self._bot()
+        calls = []
+
+        async def call_qq_api(action_name, kwargs):
+            calls.append(action_name)
+            if len(calls) < 3:
+                raise NapCatAPIFailureException(502)
+            return []
+
+        bot._call_qq_api = call_qq_api  # type: ignore[method-assign]
+
+        assert asyncio.run(bot._call_action_wrapper("get_friend_list")) == []
+        assert calls == ["get_friend_list"] * 3
+        assert bot.retry_stats["retries"] == 2
+
+    def test_no_retry_state_changing(self):
+        bot = self._bot()
+        calls = []
+
+        async def call_qq_api(action_name, kwargs):
+            calls.append(action_name)
+            raise NapCatAPIFailureException(502)
+
+        bot._call_qq_api = call_qq_api  # type: ignore[method-assign]
+
+        with pytest.raises(NapCatAPIFailureException):
+            asyncio.run(bot._call_action_wrapper("send_msg", message="hi"))
+        assert calls == ["send_msg"]
+        assert bot.retry_stats["retries"] == 0
+
+    def test_fail_fast(self):
+        bot = self._bot(circuit_failure_threshold=2, circuit_reset_timeout=60)
+        calls = []
+
+        async def call_qq_api(action_name, kwargs):
+            calls.append(action_name)
+            if action_name == "get_status":
+                return {"online": True, "good": True}
+            raise NapCatDisconnectedException("refused")
+
+        bot._call_qq_api = call_qq_api  # type: ignore[method-assign]
+
+        async def run():
+            for _ in range(2):
+                with pytest.raises(NapCatDisconnectedException):
+                    await bot._call_action_wrapper("send_msg", message="hi")
+            assert bot.circuit_breaker.state == "open"
+
+            with pytest.raises(NapCatCircuitOpenException):
+                await bot._call_action_wrapper("get_friend_list")
+
+            # The status probe bypasses the breaker and closes it
+            await bot.check_status_periodically(run_once=True)
+
+        asyncio.run(run())
+
+        assert calls == ["send_msg", "send_msg", "get_status"]
+        assert bot.circuit_breaker.state == "closed"
+        assert bot.is_connected()
+        assert bot.retry_stats == RetryStats(
+            retries=0, circuit_opened=1, circuit_rejected=1
+        )
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from efb_qq_plugin_napcat.napcat.http_api import NapCatHttpApi
+from efb_qq_plugin_napcat.napcat.runtime import NapCatFairScheduler, acquire_runtime
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+class TestFairScheduler:
+    def test_round_robin(self):
+        scheduler = NapCatFairScheduler(1)
+        served = []
+
+        async def request(account):
+            await scheduler.acquire(account)
+            served.append(account)
+            await asyncio.sleep(0)
+            scheduler.release()
+
+        async def run():
+            await scheduler.acquire("busy")
+            tasks = [asyncio.ensure_future(request("noisy")) for _ in range(5)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.ensure_future(request("quiet")))
+            await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+
+        # The quiet account is served in its turn, not after the noisy one
+        assert served == ["noisy", "quiet", "noisy", "noisy", "noisy", "noisy"]
+        stats = scheduler.stats
+        assert stats["noisy"]["waited"] == 5
+        assert stats["quiet"]["waited"] == 1
+
+    def test_cancel(self):
+        scheduler = NapCatFairScheduler(1)
+
+        async def run():
+            await scheduler.acquire("a")
+            waiter = asyncio.ensure_future(scheduler.acquire("b"))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            scheduler.release()
+
+            # The slot of the cancelled request is not lost
+            await asyncio.wait_for(scheduler.acquire("c"), 1)
+
+        asyncio.run(run())
+
+
+class TestRuntime:
+    def test_shared(self, tmp_path, httpserver):
+        for token in ("a", "b"):
+            httpserver.expect_request(
+                "/get_login_info", headers={"Authorization": f"Bearer {token}"}
+            ).respond_with_json({"status": "ok", "retcode": 0, "data": {"token": token}})
+
+        config = {"api_root": "http://localhost:6700", "api_timeout": 10}
+        runtime = acquire_runtime("test", "napcat#a", config, tmp_path)
+        assert acquire_runtime("test", "napcat#b", config, tmp_path) is runtime
+        with pytest.raises(ValueError):
+            acquire_runtime("test", "napcat#b", config, tmp_path)
+
+        apis = [
+            NapCatHttpApi(config | {"access_token": token}, runtime, f"napcat#{token}")
+            for token in ("a", "b")
+        ]
+
+        async def call(api):
+            return await api.call_action("get_login_info"), api.client
+
+        runtime.start()
+        results = [
+            asyncio.run_coroutine_threadsafe(call(api), runtime.loop).result(5)
+            for api in apis
+        ]
+
+        assert [res for res, _ in results] == [{"token": "a"}, {"token": "b"}]
+        assert results[0][1] is results[1][1]
+        assert set(runtime.scheduler.stats) == {"napcat#a", "napcat#b"}
+
+        runtime.release("napcat#a")
+        assert runtime.loop.is_running()
+        runtime.release("napcat#b")
+        assert runtime.loop.is_closed()
+        assert (tmp_path / "index.json").exists()
+
+        # A new runtime is created after the last account is released
+        other = acquire_runtime("test", "napcat#a", config, tmp_path)
+        assert other is not runtime
+        other.release("napcat#a")
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import time
+
+import pytest
+from werkzeug import Response
+
+from efb_qq_plugin_napcat.napcat.exceptions import NapCatAPIFailureException
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.outbox import NapCatOutbox
+from efb_qq_plugin_napcat.napcat.send_queue import NapCatSendQueue, TokenBucket
+
+
+def _send_queue(**config) -> NapCatSendQueue:
+    bot = NapCatBot(
+        {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10}
+    )
+    bot._logged_in = True
+    bot._connected = True
+
+    return NapCatSendQueue(
+        bot,
+        {"send_rate": 0, "send_rate_per_chat": 0, "send_merge_window": 0} | config,
+    )
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    return ("localhost", 6700)
+
+
+class _FakeSendMsg:
+    def __init__(self) -> None:
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(json.loads(request.data))
+        return Response(
+            json.dumps(
+                {"status": "ok", "retcode": 0, "data": {"message_id": len(self.requests)}}
+            ),
+            content_type="application/json",
+        )
+
+
+def _text(text):
+    return [{"type": "text", "data": {"text": text}}]
+
+
+class TestSendQueue:
+    def test_order_and_message_id(self, httpserver):
+        send_msg = _FakeSendMsg()
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        send_queue = _send_queue()
+        image = [{"type": "image", "data": {"file": "file:///a.png"}}]
+
+        async def run():
+            return await asyncio.gather(
+                send_queue.send(("group", 1), image),
+                send_queue.send(("group", 1), image),
+                send_queue.send(("private", 2), image),
+            )
+
+        message_ids = asyncio.run(run())
+
+        assert sorted(message_ids) == [1, 2, 3]
+        group_requests = [r for r in send_msg.requests if r.get("group_id") == 1]
+        assert len(group_requests) == 2
+        assert send_msg.requests[message_ids[0] - 1]["message_type"] == "group"
+        assert message_ids[0] < message_ids[1]
+
+    def test_merge_texts(self, httpserver):
+        send_msg = _FakeSendMsg()
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        send_queue = _send_queue(send_merge_texts=True, send_merge_window=0.05)
+
+        async def run():
+            futures = [send_queue.submit(("group", 1), _text(str(i))) for i in range(3)]
+            await asyncio.sleep(0.01)
+            futures.append(send_queue.submit(("group", 1), _text("3")))
+            return await asyncio.gather(*futures)
+
+        message_ids = asyncio.run(run())
+
+        assert message_ids == [1, 1, 1, 1]
+        assert send_msg.requests == [
+            {
+                "message_type": "group",
+                "group_id": 1,
+                "message": _text("0\n1\n2\n3"),
+            }
+        ]
+        assert send_queue.stats["merged"] == 3
+        assert send_queue.stats["calls"] == 1
+
+    def test_no_merge_by_default(self, httpserver):
+        send_msg = _FakeSendMsg()
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        send_queue = _send_queue()
+
+        async def run():
+            return await asyncio.gather(
+                *(send_queue.submit(("group", 1), _text(str(i))) for i in range(3))
+            )
+
+        # Every message has its own id, to be recalled or edited alone
+        assert asyncio.run(run()) == [1, 2, 3]
+        assert [r["message"] for r in send_msg.requests] == [
+            _text("0"),
+            _text("1"),
+            _text("2"),
+        ]
+        assert send_queue.stats["merged"] == 0
+
+    def test_rate_limit(self, httpserver):
+        send_msg = _FakeSendMsg()
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        send_queue = _send_queue(send_rate_per_chat=20, send_burst_per_chat=1)
+        image = [{"type": "image", "data": {"file": "file:///a.png"}}]
+
+        async def run():
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(send_queue.send(("group", 1), image) for _ in range(5))
+            )
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(run())
+
+        # The first message is sent at once, the others wait 1 / 20 seconds
+        assert elapsed >= 0.19
+        assert send_queue.stats["rate_limit_wait_total"] > 0
+        assert send_queue.stats["queue_wait_max"] >= 0.19
+
+    def test_failure(self, httpserver):
+        httpserver.expect_request("/send_msg").respond_with_json(
+            {"status": "failed", "retcode": 1200}
+        )
+        send_queue = _send_queue()
+
+        with pytest.raises(NapCatAPIFailureException):
+            asyncio.run(send_queue.send(("private", 1), _text("hello")))
+
+        assert send_queue.stats["failed"] == 1
+
+    def test_bad_response(self, httpserver):
+        httpserver.expect_ordered_request("/send_msg").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": {}}
+        )
+        httpserver.expect_ordered_request("/send_msg").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": {"message_id": 2}}
+        )
+        send_queue = _send_queue()
+
+        async def run():
+            first = send_queue.send(("private", 1), _text("a"))
+            second = send_queue.send(("private", 1), _text("b"))
+            return await asyncio.gather(first, second, return_exceptions=True)
+
+        # The worker survives a response without a message id
+        first, second = asyncio.run(run())
+        assert isinstance(first, KeyError)
+        assert second == 2
+        assert send_queue.stats["failed"] == 1
+        assert send_queue._chats == {}
+
+        httpserver.expect_request("/send_msg").respond_with_json(
+            {"status": "ok", "retcode": 0, "data": {"message_id": 3}}
+        )
+        assert asyncio.run(send_queue.send(("private", 1), _text("c"))) == 3
+
+    def test_cancelled_not_sent(self, httpserver):
+        send_msg = _FakeSendMsg()
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        send_queue = _send_queue(send_rate_per_chat=10, send_burst_per_chat=1)
+
+        async def run():
+            first = asyncio.ensure_future(send_queue.send(("group", 1), _text("a")))
+            second = asyncio.ensure_future(send_queue.send(("group", 1), _text("b")))
+            third = asyncio.ensure_future(send_queue.send(("group", 1), _text("c")))
+            # The second message waits for the rate limit, its caller gives up
+            await asyncio.sleep(0.05)
+            second.cancel()
+            return await asyncio.gather(first, third)
+
+        assert asyncio.run(run()) == [1, 2]
+        assert [r["message"] for r in send_msg.requests] == [_text("a"), _text("c")]
+
+    def test_prune_idle_buckets(self, httpserver, monkeypatch):
+        send_msg = _FakeSendMsg()
+        httpserver.expect_request("/send_msg").respond_with_handler(send_msg)
+        send_queue = _send_queue(send_rate_per_chat=1000)
+
+        async def run():
+            for user_id in range(5):
+                await send_queue.send(("private", user_id), _text("a"))
+
+        asyncio.run(run())
+        assert len(send_queue._chat_buckets) == 5
+
+        monkeypatch.setattr(send_queue, "_pruned_at", 0)
+        asyncio.run(send_queue.send(("private", 9), _text("a")))
+        # The refilled buckets of the idle chats are dropped
+        assert list(send_queue._chat_buckets) == [("private", 9)]
+
+    def test_offline(self):
+        outbox = NapCatOutbox(None, {})
+        bot = NapCatBot(
+            {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10},
+            outbox,
+        )
+        send_queue = NapCatSendQueue(bot, {"send_merge_window": 0})
+
+        message_id = asyncio.run(send_queue.send(("group", 1), _text("hello")))
+
+        assert message_id == "outbox_1"
+        assert len(outbox) == 1
+
+
+class TestTokenBucket:
+    def test_reserve(self):
+        bucket = TokenBucket(rate=10, burst=2)
+
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+        assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(rate=0, burst=1)
+
+        assert all(bucket.reserve() == 0 for _ in range(100))
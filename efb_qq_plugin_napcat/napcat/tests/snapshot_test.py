@@ -0,0 +1,60 @@
+from pathlib import Path
+
+from efb_qq_plugin_napcat.napcat.friend_manager import NapCatFriendManager
+from efb_qq_plugin_napcat.napcat.napcat_bot import NapCatBot
+from efb_qq_plugin_napcat.napcat.snapshot import dump_snapshot, load_snapshot
+
+
+def _bot() -> NapCatBot:
+    return NapCatBot(
+        {"api_root": "http://localhost:6700", "access_token": "", "api_timeout": 10}
+    )
+
+
+class TestSnapshot:
+    def test_round_trip(self, tmp_path: Path):
+        path = tmp_path / "data" / "contacts.snapshot"
+        sections = {
+            "friends": [(1, "Alice", "Alice"), (2, "Bob", "老板"), (3, "", "")],
+            "groups": [(100, "Group", "Group")],
+        }
+
+        dump_snapshot(path, sections)
+
+        assert load_snapshot(path) == sections
+        assert not path.with_name(path.name + ".tmp").exists()
+
+    def test_missing(self, tmp_path: Path):
+        assert load_snapshot(tmp_path / "missing") == {}
+
+    def test_corrupted(self, tmp_path: Path):
+        path = tmp_path / "contacts.snapshot"
+        dump_snapshot(path, {"friends": [(1, "Alice", "Ally")]})
+        data = path.read_bytes()
+
+        path.write_bytes(data[:-2])
+        assert load_snapshot(path) == {}
+
+        path.write_bytes(b"XXXX" + data[4:])
+        assert load_snapshot(path) == {}
+
+
+class TestRestoreFriends:
+    def test_restore(self, tmp_path: Path):
+        path = tmp_path / "contacts.snapshot"
+
+        friend_manager = NapCatFriendManager(_bot())
+        friend_manager._update_friend_list_callback(
+            [
+                {"user_id": 1, "nickname": "Alice", "remark": ""},
+                {"user_id": 2, "nickname": "Bob", "remark": "Bobby"},
+            ]
+        )
+        dump_snapshot(path, {"friends": friend_manager.snapshot_records()})
+
+        restored = NapCatFriendManager(_bot())
+        restored.restore_snapshot_records(load_snapshot(path)["friends"])
+
+        assert list(restored.friend_list) == list(friend_manager.friend_list)
+        # The restored friends are reconciled with NapCat on the first lookup
+        assert restored._refreshed_at is None
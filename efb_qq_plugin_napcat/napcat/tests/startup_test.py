@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+import efb_qq_plugin_napcat
+
+# The import time of the plugin modules must stay under the budget (in ms),
+# it can be raised by NAPCAT_IMPORT_BUDGET_MS on a slow machine.
+IMPORT_BUDGET_MS = float(os.environ.get("NAPCAT_IMPORT_BUDGET_MS", 60))
+
+# The packages and the plugin modules only needed once the client is polling
+DEFERRED_MODULES = (
+    "aiocqhttp",
+    "httpx",
+    "websockets",
+    "sqlite3",
+    "quart",
+    "efb_qq_plugin_napcat.napcat.codec",
+    "efb_qq_plugin_napcat.napcat.metrics",
+    "efb_qq_plugin_napcat.napcat.snapshot",
+)
+
+# EFB and the QQ slave are loaded before the plugin, they are not counted
+_SCRIPT = """
+import json, sys
+import ehforwarderbot, efb_qq_slave, efb_qq_slave.ChatMgr, efb_qq_slave.CustomTypes
+from efb_qq_plugin_napcat.NapCat import NapCat
+print(json.dumps([m for m in %r if m in sys.modules]))
+""" % (DEFERRED_MODULES,)
+
+
+def _import_plugin() -> tuple[float, list[str]]:
+    """
+    Import the plugin in a new interpreter, return the import time of the
+    plugin modules in ms and the deferred modules imported.
+    """
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        # "import time: <self us> | <cumulative us> | <indented module name>"
+        _, cumulative, name = line.split("|")
+        name = name[1:]
+        # Only the outermost imports, the nested ones are in their cumulative
+        if name.startswith("efb_qq_plugin_napcat"):
+            total_us += int(cumulative)
+
+    return total_us / 1000, json.loads(proc.stdout)
+
+
+class TestStartup:
+    def test_import_budget(self):
+        elapsed_ms, loaded = _import_plugin()
+
+        assert loaded == []
+        assert elapsed_ms < IMPORT_BUDGET_MS, (
+            f"Importing the plugin took {elapsed_ms:.1f} ms, "
+            f"over the budget of {IMPORT_BUDGET_MS:.0f} ms"
+        )
+
+    def test_entry_point(self):
+        # EFB loads the module by the entry point and gets the class from it
+        assert efb_qq_plugin_napcat.NapCat.NapCat.__name__ == "NapCat"
+
+    def test_outbox_prefix(self):
+        # The client keeps its own copy to not import the outbox at startup
+        from efb_qq_plugin_napcat.napcat.outbox import OUTBOX_ID_PREFIX
+
+        assert efb_qq_plugin_napcat.NapCat.OUTBOX_ID_PREFIX == OUTBOX_ID_PREFIX
@@ -0,0 +1,234 @@
+import asyncio
+import json
+
+import pytest
+from aiocqhttp.exceptions import ActionFailed, NetworkError
+from websockets.asyncio.client import connect
+from websockets.asyncio.server import serve
+from websockets.exceptions import InvalidStatus
+
+from efb_qq_plugin_napcat.napcat.ws_api import NapCatWebSocketApi
+
+
+class _FakeNapCat:
+    """
+    A stand-in NapCat WebSocket server. It answers every action with the
+    action name and params, and pushes the given events on connection.
+    """
+
+    def __init__(self, events=(), delays=None) -> None:
+        self.events = list(events)
+        self.delays = delays or {}
+        self.headers = None
+
+    async def __call__(self, ws) -> None:
+        self.headers = ws.request.headers
+        for event in self.events:
+            await ws.send(json.dumps(event))
+
+        async for raw in ws:
+            asyncio.create_task(self._respond(ws, json.loads(raw)))
+
+    async def _respond(self, ws, frame) -> None:
+        await asyncio.sleep(self.delays.get(frame["action"], 0))
+        if frame["action"] == "failed_action":
+            data = {"status": "failed", "retcode": 100, "echo": frame["echo"]}
+        else:
+            data = {
+                "status": "ok",
+                "retcode": 0,
+                "data": {"action": frame["action"], **frame["params"]},
+                "echo": frame["echo"],
+            }
+        await ws.send(json.dumps(data))
+
+
+def _config(**kwargs):
+    config = {"access_token": "token", "api_timeout": 2, "ws_reconnect_interval": 0.1}
+    config.update(kwargs)
+    return config
+
+
+class TestForward:
+    def test_multiplexed_actions(self):
+        napcat = _FakeNapCat(delays={"slow": 0.1})
+
+        async def run():
+            async with serve(napcat, "localhost", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                api = NapCatWebSocketApi(
+                    _config(transport="ws", ws_url=f"ws://localhost:{port}")
+                )
+                await api.start()
+
+                results = await asyncio.gather(
+                    api.call_action("slow", n=1),
+                    api.call_action("fast", n=2),
+                )
+                await api.close()
+                return results
+
+        results = asyncio.run(run())
+
+        assert results == [{"action": "slow", "n": 1}, {"action": "fast", "n": 2}]
+        assert napcat.headers["Authorization"] == "Bearer token"
+
+    def test_events(self):
+        events = [
+            {"post_type": "meta_event", "meta_event_type": "lifecycle"},
+            {"post_type": "message", "message_id": 1},
+            {"post_type": "message", "message_id": 2},
+        ]
+        napcat = _FakeNapCat(events=events)
+        received = []
+
+        async def run():
+            done = asyncio.Event()
+
+            async def handler(event):
+                received.append(event)
+                if len(received) == len(events):
+                    done.set()
+
+            async with serve(napcat, "localhost", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                api = NapCatWebSocketApi(
+                    _config(transport="ws", ws_url=f"ws://localhost:{port}"), handler
+                )
+                await api.start()
+                await asyncio.wait_for(done.wait(), 2)
+                await api.close()
+
+        asyncio.run(run())
+
+        assert received == events
+
+    def test_full_event_queue(self):
+        events = [{"post_type": "message", "message_id": i} for i in range(5)]
+        napcat = _FakeNapCat(events=events)
+        received = []
+
+        async def run():
+            release = asyncio.Event()
+            done = asyncio.Event()
+
+            async def handler(event):
+                received.append(event)
+                await release.wait()
+                if len(received) == len(events):
+                    done.set()
+
+            async with serve(napcat, "localhost", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                api = NapCatWebSocketApi(
+                    _config(
+                        transport="ws",
+                        ws_url=f"ws://localhost:{port}",
+                        ws_event_queue_size=2,
+                    ),
+                    handler,
+                )
+                await api.start()
+                try:
+                    # The handler is stuck and the queue is full, so the
+                    # reader waits, but the response is still read
+                    await asyncio.sleep(0.1)
+                    assert len(received) == 1
+                    result = await api.call_action("get_status")
+                    overflowed = api.overflowed_events
+
+                    release.set()
+                    await asyncio.wait_for(done.wait(), 2)
+                finally:
+                    await api.close()
+                return result, overflowed
+
+        result, overflowed = asyncio.run(run())
+
+        assert result == {"action": "get_status"}
+        assert overflowed == 2
+        # No event is dropped, and they are handled in order
+        assert received == events
+
+    def test_action_failed(self):
+        napcat = _FakeNapCat()
+
+        async def run():
+            async with serve(napcat, "localhost", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                api = NapCatWebSocketApi(
+                    _config(transport="ws", ws_url=f"ws://localhost:{port}")
+                )
+                await api.start()
+                try:
+                    await api.call_action("failed_action")
+                finally:
+                    await api.close()
+
+        with pytest.raises(ActionFailed) as ex_info:
+            asyncio.run(run())
+
+        assert ex_info.value.retcode == 100
+
+    def test_not_connected(self):
+        async def run():
+            api = NapCatWebSocketApi(
+                _config(transport="ws", ws_url="ws://localhost:1", api_timeout=0.3)
+            )
+            await api.start()
+            try:
+                await api.call_action("get_status")
+            finally:
+                await api.close()
+
+        with pytest.raises(NetworkError):
+            asyncio.run(run())
+
+
+class TestReverse:
+    def test_reverse_connection(self):
+        received = []
+
+        async def run():
+            async def handler(event):
+                received.append(event)
+
+            api = NapCatWebSocketApi(
+                _config(transport="ws_reverse", ws_reverse_port=0), handler
+            )
+            await api.start()
+
+            napcat = _FakeNapCat(events=[{"post_type": "notice"}])
+            async with connect(
+                f"ws://127.0.0.1:{api.port}",
+                additional_headers={"Authorization": "Bearer token"},
+            ) as ws:
+                task = asyncio.create_task(napcat(ws))
+                res = await api.call_action("get_status")
+                task.cancel()
+
+            await api.close()
+            return res
+
+        res = asyncio.run(run())
+
+        assert res == {"action": "get_status"}
+        assert received == [{"post_type": "notice"}]
+
+    def test_reject_bad_token(self):
+        async def run():
+            api = NapCatWebSocketApi(_config(transport="ws_reverse", ws_reverse_port=0))
+            await api.start()
+            try:
+                async with connect(
+                    f"ws://127.0.0.1:{api.port}",
+                    additional_headers={"Authorization": "Bearer bad"},
+                ):
+                    pass
+            finally:
+                await api.close()
+
+        with pytest.raises(InvalidStatus) as ex_info:
+            asyncio.run(run())
+
+        assert ex_info.value.response.status_code == 401
@@ -1,13 +1,82 @@
-from typing import TypedDict
+import sys
+from typing import Any, Optional, TypedDict
 
 
-class Friend(TypedDict):
+class Friend:
     """
     A friend in the qq account. Although there are many other fields
     in the response of the "get_friend_list" action, we only need these
     three fields at the moment.
+
+    The accounts may have thousands of friends, so a friend is a
+    `__slots__` record instead of a dict, and the strings are interned,
+    so the remark equal to the nickname costs nothing.
     """
 
+    __slots__ = ("user_id", "nickname", "remark")
+
     user_id: int
     nickname: str
     remark: str
+
+    def __init__(self, user_id: int, nickname: str, remark: str) -> None:
+        self.user_id = user_id
+        self.nickname = sys.intern(nickname)
+        self.remark = sys.intern(remark)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Friend):
+            return NotImplemented
+
+        return (
+            self.user_id == other.user_id
+            and self.nickname == other.nickname
+            and self.remark == other.remark
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Friend(user_id={self.user_id!r}, nickname={self.nickname!r}, "
+            f"remark={self.remark!r})"
+        )
+
+
+class FriendListDiff(TypedDict):
+    """
+    The changes of the friend list between two refreshes.
+    """
+
+    added: list[Friend]
+    """
+    The friends not in the last friend list
+    """
+
+    removed: list[Friend]
+    """
+    The friends deleted from the qq account
+    """
+
+    updated: list[Friend]
+    """
+    The friends whose nickname or remark changed
+    """
+
+
+class ResolvedContact(TypedDict):
+    """
+    A qq user resolved by the bulk contact resolution, a friend or not.
+    """
+
+    user_id: int
+
+    nickname: str
+    """
+    The nickname of the user, the uid if it cannot be found
+    """
+
+    remark: Optional[str]
+    """
+    The remark of a friend (the nickname if empty), None for a stranger
+    """
+
+    is_friend: bool
@@ -0,0 +1,74 @@
+import sys
+from typing import Any
+
+
+class Group:
+    """
+    A group joined by the qq account. We only need these three fields of
+    the response of the "get_group_list" action at the moment.
+    """
+
+    __slots__ = ("group_id", "group_name", "member_count")
+
+    group_id: int
+    group_name: str
+    member_count: int
+
+    def __init__(self, group_id: int, group_name: str, member_count: int) -> None:
+        self.group_id = group_id
+        self.group_name = sys.intern(group_name)
+        self.member_count = member_count
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Group):
+            return NotImplemented
+
+        return (
+            self.group_id == other.group_id
+            and self.group_name == other.group_name
+            and self.member_count == other.member_count
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Group(group_id={self.group_id!r}, group_name={self.group_name!r}, "
+            f"member_count={self.member_count!r})"
+        )
+
+
+class GroupMember:
+    """
+    A member of a group. The card is the name in the group, an empty card
+    means the member uses the nickname.
+    """
+
+    __slots__ = ("user_id", "nickname", "card")
+
+    user_id: int
+    nickname: str
+    card: str
+
+    def __init__(self, user_id: int, nickname: str, card: str) -> None:
+        self.user_id = user_id
+        self.nickname = sys.intern(nickname)
+        self.card = sys.intern(card)
+
+    @property
+    def display_name(self) -> str:
+        return self.card or self.nickname
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, GroupMember):
+            return NotImplemented
+
+        return (
+            self.user_id == other.user_id
+            and self.nickname == other.nickname
+            and self.card == other.card
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"GroupMember(user_id={self.user_id!r}, nickname={self.nickname!r}, "
+            f"card={self.card!r})"
+        )
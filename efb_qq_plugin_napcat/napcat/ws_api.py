@@ -0,0 +1,452 @@
+"""
+WebSocket API for napcat, actions and events share one socket
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from aiocqhttp.api import AsyncApi
+from aiocqhttp.exceptions import ApiNotAvailable, NetworkError
+
+try:
+    from websockets.asyncio.client import ClientConnection, connect
+    from websockets.asyncio.server import Server, ServerConnection, serve
+    from websockets.exceptions import ConnectionClosed, WebSocketException
+except ImportError as e:  # pragma: no cover
+    raise ImportError(
+        "The WebSocket transport needs the 'websockets' package, "
+        "install it with the 'websocket' extra"
+    ) from e
+
+from efb_qq_plugin_napcat.napcat.json_decoder import NapCatJsonDecoder
+
+EventHandler = Callable[[dict[str, Any]], Awaitable[None]]
+
+WS_TRANSPORTS = ("ws", "ws_reverse")
+
+
+class NapCatWebSocketApi(AsyncApi):
+    """
+    The NapCatWebSocketApi talks to NapCat over one persistent WebSocket.
+    It supports two modes:
+
+    1. "ws": forward WebSocket, we connect to the NapCat WebSocket server
+       at `ws_url` and reconnect when the connection is lost.
+    2. "ws_reverse": reverse WebSocket, we listen on `ws_reverse_host`
+       and `ws_reverse_port`, NapCat connects to us.
+
+    Every action is sent with a unique "echo" and the response carrying
+    the same "echo" resolves the call, so many actions are multiplexed
+    over the socket. Every other frame is an event, events are passed to
+    the event handler in the order they are received by a separate task,
+    so the handler can call actions without blocking the socket. At most
+    `ws_event_queue_size` events wait for the handler, then the socket is
+    not read until the handler catches up, so a slow handler pushes back
+    on NapCat instead of growing the memory. No event is ever dropped.
+
+    The responses must still be read while the queue is full, e.g. the
+    handler may wait for an action it called. So while an action waits for
+    its response, the events received are kept in an overflow buffer
+    (counted in `overflowed_events`) instead of blocking the socket, and
+    they are passed to the handler after the queued ones.
+
+    The exceptions raised are the same as the aiocqhttp `HttpApi`, so the
+    caller can handle them in the same way.
+    """
+
+    _mode: str
+    """
+    The transport mode, "ws" or "ws_reverse"
+    """
+
+    _ws_url: Optional[str]
+    """
+    The url of the NapCat WebSocket server in the "ws" mode
+    """
+
+    _host: str
+    """
+    The host to listen on in the "ws_reverse" mode
+    """
+
+    _port: int
+    """
+    The port to listen on in the "ws_reverse" mode
+    """
+
+    _access_token: str
+    """
+    The access token of the NapCat client
+    """
+
+    _timeout_sec: float
+    """
+    The timeout of every action
+    """
+
+    _reconnect_interval: float
+    """
+    The seconds to wait before reconnecting in the "ws" mode
+    """
+
+    _event_handler: Optional[EventHandler]
+    """
+    The handler called for every event
+    """
+
+    _ws: Optional[ClientConnection | ServerConnection]
+    """
+    The current connection, None when disconnected
+    """
+
+    _ws_ready: Optional[asyncio.Event]
+    """
+    Set when there is a connection, created in the running loop
+    """
+
+    _pending: dict[str, "asyncio.Future[Any]"]
+    """
+    The mapping from the echo to the call waiting for its response
+    """
+
+    _echo_seq: "itertools.count[int]"
+    """
+    The sequence to generate echoes
+    """
+
+    _event_queue_size: int
+    """
+    The most events waiting for the event handler
+    """
+
+    _decoder: NapCatJsonDecoder
+    """
+    The decoder of the frames
+    """
+
+    _events: Optional["asyncio.Queue[dict[str, Any]]"]
+    """
+    The events waiting for the event handler, created in the running loop
+    """
+
+    _overflow: "collections.deque[dict[str, Any]]"
+    """
+    The events received while the queue was full and an action waited for
+    its response, they follow the events in the queue
+    """
+
+    _overflowed_events: int
+    """
+    The number of events kept in the overflow buffer
+    """
+
+    _reader_wake: Optional[asyncio.Event]
+    """
+    Set to wake the reader up waiting for the queue: the handler took an
+    event or an action was called, created in the running loop
+    """
+
+    _event_task: Optional["asyncio.Task[None]"]
+    """
+    The task passing the events to the event handler
+    """
+
+    _run_task: Optional["asyncio.Task[None]"]
+    """
+    The task connecting to NapCat in the "ws" mode
+    """
+
+    _server: Optional[Server]
+    """
+    The server NapCat connects to in the "ws_reverse" mode
+    """
+
+    _logger: logging.Logger
+    """
+    The logger instance
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        event_handler: Optional[EventHandler] = None,
+        decoder: Optional[NapCatJsonDecoder] = None,
+    ) -> None:
+        super().__init__()
+
+        self._mode = config["transport"]
+        if self._mode not in WS_TRANSPORTS:
+            raise ValueError(f"Unknown WebSocket transport: {self._mode}")
+
+        self._ws_url = config.get("ws_url")
+        self._host = config.get("ws_reverse_host", "127.0.0.1")
+        self._port = config.get("ws_reverse_port", 8081)
+        self._access_token = config["access_token"]
+        self._timeout_sec = config["api_timeout"]
+        self._reconnect_interval = config.get("ws_reconnect_interval", 3.0)
+        self._event_handler = event_handler
+        self._event_queue_size = config.get("ws_event_queue_size", 1024)
+        self._decoder = decoder or NapCatJsonDecoder(config)
+
+        self._ws = None
+        self._ws_ready = None
+        self._pending = {}
+        self._echo_seq = itertools.count()
+        self._events = None
+        self._overflow = collections.deque()
+        self._overflowed_events = 0
+        self._reader_wake = None
+        self._event_task = None
+        self._run_task = None
+        self._server = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    @property
+    def overflowed_events(self) -> int:
+        return self._overflowed_events
+
+    @property
+    def port(self) -> int:
+        """
+        The port actually listened on in the "ws_reverse" mode, useful
+        when `ws_reverse_port` is 0.
+        """
+
+        if self._server is not None:
+            return self._server.sockets[0].getsockname()[1]
+
+        return self._port
+
+    def _get_reader_wake(self) -> asyncio.Event:
+        if self._reader_wake is None:
+            self._reader_wake = asyncio.Event()
+
+        return self._reader_wake
+
+    def _get_ws_ready(self) -> asyncio.Event:
+        if self._ws_ready is None:
+            self._ws_ready = asyncio.Event()
+
+        return self._ws_ready
+
+    async def start(self) -> None:
+        """
+        Start connecting to NapCat (or listening for NapCat). It should be
+        called in the event loop of the NapCat client.
+        """
+
+        self._get_ws_ready()
+
+        if self._event_task is None or self._event_task.done():
+            self._events = asyncio.Queue(self._event_queue_size)
+            self._overflow.clear()
+            self._event_task = asyncio.create_task(self._consume_events())
+
+        if self._mode == "ws":
+            if not self._ws_url:
+                raise ApiNotAvailable
+            if self._run_task is None or self._run_task.done():
+                self._run_task = asyncio.create_task(self._run_forward())
+        elif self._server is None:
+            self._server = await serve(
+                self._handle_reverse,
+                self._host,
+                self._port,
+                process_request=self._check_reverse_request,
+            )
+            self._logger.info("Waiting for NapCat on ws://%s:%d", self._host, self.port)
+
+    async def _run_forward(self) -> None:
+        """
+        Keep one connection to the NapCat WebSocket server.
+        """
+
+        headers = {}
+        if self._access_token:
+            headers["Authorization"] = "Bearer " + self._access_token
+
+        assert self._ws_url is not None
+        while True:
+            try:
+                async with connect(self._ws_url, additional_headers=headers) as ws:
+                    self._logger.info("Connected to NapCat at %s", self._ws_url)
+                    await self._serve_connection(ws)
+            except (OSError, WebSocketException) as e:
+                self._logger.warning(f"NapCat WebSocket connection failed: {e}")
+
+            await asyncio.sleep(self._reconnect_interval)
+
+    def _check_reverse_request(self, connection: ServerConnection, request: Any) -> Any:
+        """
+        Reject NapCat connections without the right access token.
+        """
+
+        if not self._access_token:
+            return None
+
+        authorization = request.headers.get("Authorization", "")
+        if authorization in (
+            "Bearer " + self._access_token,
+            "Token " + self._access_token,
+        ):
+            return None
+
+        return connection.respond(401, "Unauthorized\n")
+
+    async def _handle_reverse(self, ws: ServerConnection) -> None:
+        if self._ws is not None:
+            self._logger.warning("A new NapCat connection replaces the old one")
+            await self._ws.close()
+
+        self._logger.info("NapCat connected from %s", ws.remote_address)
+        await self._serve_connection(ws)
+
+    async def _serve_connection(self, ws: ClientConnection | ServerConnection) -> None:
+        """
+        Read frames from the connection until it is closed. Responses are
+        matched to the pending calls by echo, the others are events.
+        """
+
+        self._ws = ws
+        self._get_ws_ready().set()
+
+        try:
+            async for raw in ws:
+                try:
+                    echo, frame = self._decoder.decode_frame(raw)
+                except ValueError:
+                    self._logger.warning("Received an invalid frame from NapCat")
+                    continue
+
+                if frame is None:
+                    continue
+
+                if echo is not None:
+                    future = self._pending.pop(echo, None)
+                    if future is not None and not future.done():
+                        future.set_result(frame)
+                    continue
+
+                if self._events is not None:
+                    await self._put_event(self._events, frame)
+        except ConnectionClosed:
+            pass
+        finally:
+            if self._ws is ws:
+                self._ws = None
+                self._get_ws_ready().clear()
+                self._fail_pending("WebSocket connection closed")
+
+    async def _put_event(
+        self, events: "asyncio.Queue[dict[str, Any]]", frame: dict[str, Any]
+    ) -> None:
+        """
+        Queue an event after the overflowed ones. When the queue is full,
+        wait for the handler (so the socket is not read), unless an action
+        waits for its response.
+        """
+
+        wake = self._get_reader_wake()
+        while self._overflow or events.full():
+            if self._pending:
+                if not self._overflow:
+                    self._logger.warning(
+                        "The NapCat event queue is full, buffering the events "
+                        "while waiting for the action responses"
+                    )
+                self._overflow.append(frame)
+                self._overflowed_events += 1
+                return
+
+            wake.clear()
+            await wake.wait()
+
+        events.put_nowait(frame)
+
+    async def _consume_events(self) -> None:
+        assert self._events is not None
+        while True:
+            event = await self._events.get()
+
+            # Refill the queue from the overflow in order, then let the
+            # reader go on
+            while self._overflow and not self._events.full():
+                self._events.put_nowait(self._overflow.popleft())
+            self._get_reader_wake().set()
+
+            if self._event_handler is None:
+                continue
+
+            try:
+                await self._event_handler(event)
+            except Exception:
+                self._logger.exception("Failed to handle the NapCat event")
+
+    def _fail_pending(self, reason: str) -> None:
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(NetworkError(reason))
+
+    async def call_action(self, action: str, **params: Any) -> Any:
+        try:
+            await asyncio.wait_for(self._get_ws_ready().wait(), self._timeout_sec)
+        except asyncio.TimeoutError:
+            raise NetworkError("WebSocket not connected")
+
+        ws = self._ws
+        if ws is None:
+            raise NetworkError("WebSocket not connected")
+
+        echo = str(next(self._echo_seq))
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self._pending[echo] = future
+        # The reader may wait for the event queue, it must read the response
+        self._get_reader_wake().set()
+
+        try:
+            await ws.send(json.dumps({"action": action, "params": params, "echo": echo}))
+            frame = await asyncio.wait_for(future, self._timeout_sec)
+        except ConnectionClosed:
+            raise NetworkError("WebSocket connection closed")
+        except asyncio.TimeoutError:
+            raise NetworkError("WebSocket API call timeout")
+        finally:
+            self._pending.pop(echo, None)
+
+        return self._decoder.decode_result(action, frame)
+
+    async def close(self) -> None:
+        """
+        Close the connection (and the server in the "ws_reverse" mode). It
+        should be called in the event loop of the NapCat client.
+        """
+
+        for task in (self._run_task, self._event_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._run_task = None
+        self._event_task = None
+
+        if self._ws is not None:
+            await self._ws.close()
+
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        self._fail_pending("WebSocket API closed")